@@ -1,3 +1,25 @@
-import core
-import features
-import model
+'''Keystroke dynamics.
+Submodules (ksdyn.core, ksdyn.model, ...) are imported when first used, not when the package is,
+so short-lived processes only pay for what they use'''
+import sys
+import types
+import importlib
+
+class _LazyPackage(types.ModuleType):
+    '''The ksdyn package module, importing submodules on attribute access'''
+    def __getattr__( self, name ):
+        if name.startswith('__'):
+            raise AttributeError( name )
+        try:
+            module= importlib.import_module( __name__+'.'+name )
+        except ImportError as e:
+            if str(e)!="No module named "+name:
+                raise   #the submodule exists, but failed to import
+            raise AttributeError( "module {} has no attribute {}".format(__name__, name) )
+        setattr( self, name, module )
+        return module
+
+_package= _LazyPackage( __name__, __doc__ )
+_package.__dict__.update( (k,v) for k,v in globals().items() if k.startswith('__') )
+_package._original= sys.modules[__name__]   #keeps this module's globals alive
+sys.modules[__name__]= _package
@@ -0,0 +1,165 @@
+'''Benchmarks of the whole pipeline on a synthetic population.
+usage: python -m ksdyn.benchmark [--users N] [--keypresses N] [--save FILE] [--compare BASELINE]
+Results are JSON; comparing against a saved baseline reports (and exits with 1 on) regressions'''
+from ksdyn.core import KeystrokeCaptureData
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import Fingerprint, FingerprintDatabase
+from ksdyn.matrix import MatrixFingerprintDatabase
+from ksdyn.compact import CompactFingerprint
+from ksdyn.synthetic import SyntheticPopulation
+
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import platform
+from timeit import default_timer as timer
+
+import numpy as np
+
+def best_time( f, repeat=3 ):
+    '''the fastest of repeat calls of f, in seconds'''
+    times= []
+    for _ in range(repeat):
+        t= timer()
+        f()
+        times.append( timer()-t )
+    return min(times)
+
+def deep_sizeof( obj, seen=None ):
+    '''approximate memory used by obj and everything it references'''
+    seen= set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add( id(obj) )
+    size= sys.getsizeof( obj )
+    if isinstance( obj, np.ndarray ):
+        return size
+    if isinstance( obj, dict ):
+        size+= sum( deep_sizeof(k, seen)+deep_sizeof(v, seen) for k,v in obj.items() )
+    elif isinstance( obj, (list, tuple, set, frozenset) ):
+        size+= sum( deep_sizeof(x, seen) for x in obj )
+    if hasattr( obj, '__dict__' ):
+        size+= deep_sizeof( obj.__dict__, seen )
+    for attribute in getattr( type(obj), '__slots__', () ):
+        size+= deep_sizeof( getattr(obj, attribute, None), seen )
+    return size
+
+STARTUP_SCRIPTS= {
+    'startup_interpreter':  "pass",
+    'startup_import_ksdyn': "import ksdyn",
+    'startup_import_model': "import ksdyn.model",
+    'startup_first_score':  "from ksdyn.model import GaussianAnomalyModel as G; m= G.from_features('k', [90, 100, 110]); m.similarity(m)",
+    #what importing the package used to cost: core, features and model, with scipy.stats
+    'startup_eager_reference': "import ksdyn.core, ksdyn.features, ksdyn.model, scipy.stats",
+    }
+
+def startup( repeat=3 ):
+    '''Times (in seconds) of fresh interpreters running each of STARTUP_SCRIPTS, including interpreter startup.
+    startup_first_score_no_scipy runs startup_first_score with the erfc based normal cdf'''
+    import subprocess
+    def time_script( script, env=None ):
+        return best_time( lambda: subprocess.check_call([sys.executable, '-c', script], env=env), repeat )
+    results= dict( (name, time_script(script)) for name,script in STARTUP_SCRIPTS.items() )
+    env= dict( os.environ, KSDYN_NO_SCIPY='1' )
+    results['startup_first_score_no_scipy']= time_script( STARTUP_SCRIPTS['startup_first_score'], env )
+    return results
+
+def run( nusers=1000, nkeypresses=5000, seed=0, repeat=3 ):
+    '''Runs every benchmark. Returns a dict of results: times are in seconds'''
+    population= SyntheticPopulation( nusers, seed )
+    results= startup( repeat )
+    typist= population[0]
+    capture= typist.capture_data( nkeypresses )
+    nevents= len(capture.log)
+    results['events_per_capture']= nevents
+
+    directory= tempfile.mkdtemp()
+    try:
+        filename= os.path.join( directory, 'capture' )
+        results['capture_save']= best_time( lambda: capture.save_to_file(filename), repeat )
+        results['capture_load']= best_time( lambda: KeystrokeCaptureData.load_from_file(filename).events['time'].sum(), repeat )
+        legacy= KeystrokeCaptureData( capture.log.tolist() )
+        with open( filename+'.legacy', 'wb' ) as f:
+            f.write( str(legacy.log) )
+        results['capture_load_legacy']= best_time( lambda: KeystrokeCaptureData.load_from_file(filename+'.legacy'), repeat )
+    finally:
+        shutil.rmtree( directory )
+
+    results['extract_on_key']= best_time( lambda: legacy.feed( FeatureExtractor() ), repeat )
+    def extract():
+        fe= FeatureExtractor()
+        fe.on_events( capture.events )
+        return fe.extract_features()
+    results['extract_on_events']= best_time( extract, repeat )
+    features= extract()
+    results['fingerprint_fit']= best_time( lambda: Fingerprint.from_features('user', features), repeat )
+
+    fingerprints= [Fingerprint.from_features( str(i), extract_features(t, nkeypresses) ) for i,t in enumerate(population)]
+    probe= Fingerprint.from_features( 'probe', extract_features(population[nusers//2], nkeypresses, seed=1) )
+    results['fingerprint_pickle_bytes']= np.mean( [len(pickle.dumps(f, pickle.HIGHEST_PROTOCOL)) for f in fingerprints[:100]] )
+    results['fingerprint_memory_bytes']= np.mean( [deep_sizeof(f) for f in fingerprints[:100]] )
+    compact= [CompactFingerprint.from_fingerprint(f) for f in fingerprints[:100]]
+    results['fingerprint_compact_pickle_bytes']= np.mean( [len(pickle.dumps(f, pickle.HIGHEST_PROTOCOL)) for f in compact] )
+    results['fingerprint_compact_memory_bytes']= np.mean( [deep_sizeof(f) for f in compact] )
+    results['best_match_serial']= best_time( lambda: FingerprintDatabase(fingerprints).best_match(probe), 1 )
+    matrix_db= MatrixFingerprintDatabase( fingerprints )
+    results['best_match_matrix_build']= best_time( lambda: MatrixFingerprintDatabase(fingerprints).matrix, 1 )
+    matrix_db.matrix
+    results['best_match_matrix']= best_time( lambda: matrix_db.best_match(probe), repeat )
+    return results
+
+def extract_features( typist, nkeypresses, seed=0 ):
+    fe= FeatureExtractor()
+    fe.on_events( typist.events(nkeypresses, seed) )
+    return fe.extract_features()
+
+def metadata( nusers, nkeypresses, seed ):
+    return {
+        'users': nusers, 'keypresses': nkeypresses, 'seed': seed,
+        'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+        }
+
+def compare( results, baseline, tolerance=0.2 ):
+    '''Returns {name: (baseline, result)} of the results that are worse than the baseline by more than tolerance (relative).
+    Every result is a cost (time or memory), so bigger is worse'''
+    regressions= {}
+    for name, value in results.items():
+        old= baseline.get( name )
+        if old and value > old*(1+tolerance):
+            regressions[name]= (old, value)
+    return regressions
+
+def main( argv=None ):
+    import argparse
+    parser= argparse.ArgumentParser( description="Benchmarks ksdyn on a synthetic population" )
+    parser.add_argument( '--users', type=int, default=1000 )
+    parser.add_argument( '--keypresses', type=int, default=5000, help='key presses per user' )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '--repeat', type=int, default=3 )
+    parser.add_argument( '--save', help='file to save the results to, as JSON' )
+    parser.add_argument( '--compare', help='baseline JSON file to compare the results against' )
+    parser.add_argument( '--tolerance', type=float, default=0.2, help='relative slowdown considered a regression' )
+    args= parser.parse_args( argv )
+
+    results= run( args.users, args.keypresses, args.seed, args.repeat )
+    document= {'meta': metadata(args.users, args.keypresses, args.seed), 'results': results}
+    print json.dumps( document, indent=2, sort_keys=True )
+    if args.save:
+        with open( args.save, 'w' ) as f:
+            json.dump( document, f, indent=2, sort_keys=True )
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline= json.load( f )
+        if baseline['meta']!=document['meta']:
+            print "warning: baseline was obtained with different parameters: {}".format( baseline['meta'] )
+        regressions= compare( results, baseline['results'], args.tolerance )
+        for name, (old, new) in sorted( regressions.items() ):
+            print "REGRESSION {}: {:.6g} -> {:.6g} ({:+.0%})".format( name, old, new, new/old-1 )
+        return 1 if regressions else 0
+    return 0
+
+if __name__=='__main__':
+    sys.exit( main() )
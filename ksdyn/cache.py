@@ -0,0 +1,127 @@
+'''A cache of the steps of scoring keystrokes against a FingerprintDatabase, for when the same
+capture is scored several times (retries, step-up checks, audit replays).
+
+Entries are keyed by the content hash of the KeystrokeCaptureData (or of the probe Fingerprint),
+so equal captures hit the same entries. Score vectors and best matches are also keyed by the database generation,
+so they are invalidated whenever the database changes (enroll, refresh, ...). Changes made to the
+fingerprints themselves (e.g.: Fingerprint.update on a enrolled fingerprint) are not detected.
+Cached objects are shared between callers: don't modify them'''
+from ksdyn.core import KeystrokeCaptureData
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import Fingerprint
+from ksdyn.store import LRUCache
+
+import threading
+import time
+
+class ScoringCache(object):
+    '''Memoizes the features and probe Fingerprint of captures, and their score vectors and best matches against database.
+    Holds at most maxsize captures (and maxsize score vectors and best matches), evicting the least recently used,
+    and, if ttl, drops entries older than ttl seconds. stats() returns the hits and misses.
+    Features are extracted with timing_threshold, max_digraphs and sketch_compression (see FeatureExtractor):
+    use those the database fingerprints were created with (see create_fingerprint_from_capture_data)'''
+    KINDS= ('features', 'probe', 'score', 'best')
+
+    def __init__(self, database, maxsize=1024, ttl=None, max_digraphs=0, clock=time.time, timing_threshold=500, sketch_compression=0):
+        self.database= database
+        self.ttl= ttl
+        self.max_digraphs= max_digraphs
+        self.timing_threshold= timing_threshold
+        self.sketch_compression= sketch_compression
+        self.clock= clock
+        self._captures= LRUCache( maxsize )     #capture hash -> {kind: value}
+        self._scores= LRUCache( maxsize )       #(probe hash, generation) -> scores
+        self._best= LRUCache( maxsize )         #(probe hash, generation) -> best matching fingerprint
+        self._generation= database.generation
+        self._lock= threading.Lock()
+        self.hits= dict.fromkeys( self.KINDS, 0 )
+        self.misses= dict.fromkeys( self.KINDS, 0 )
+        self.invalidations= 0
+
+    def _get( self, cache, key ):
+        '''the value cached under key, or None if there's none or it expired'''
+        entry= cache.get( key )
+        if entry is not None and self.ttl is not None and self.clock() - entry[0] >= self.ttl:
+            cache.discard( key )
+            return None
+        return entry and entry[1]
+
+    def _memoized( self, capture_data, kind, compute ):
+        '''the value of kind for capture_data, computing it (with compute) on a miss'''
+        key= capture_data.content_hash()
+        with self._lock:
+            entries= self._get( self._captures, key )
+            if entries is None:
+                entries= {}
+                self._captures.put( key, (self.clock(), entries) )
+            if kind in entries:
+                self.hits[kind]+= 1
+                return entries[kind]
+            self.misses[kind]+= 1
+        value= compute()
+        with self._lock:
+            entries[kind]= value
+        return value
+
+    def features( self, capture_data ):
+        '''the features of capture_data (see FeatureExtractor.extract_features)'''
+        def extract():
+            extractor= FeatureExtractor( self.timing_threshold, max_digraphs=self.max_digraphs, sketch_compression=self.sketch_compression )
+            extractor.on_events( capture_data.events )
+            return extractor.extract_features()
+        return self._memoized( capture_data, 'features', extract )
+
+    def probe( self, capture_data ):
+        '''the probe Fingerprint of capture_data'''
+        return self._memoized( capture_data, 'probe', lambda: Fingerprint.from_features( "probe", self.features(capture_data) ) )
+
+    def _database_result( self, cache, kind, data, compute ):
+        '''compute(probe) for data (see score), cached in cache by probe hash and database generation'''
+        if isinstance( data, KeystrokeCaptureData ):
+            data= self.probe( data )
+        key= data.content_hash()
+        with self._lock:
+            self._check_generation()
+            generation= self.database.generation
+            value= self._get( cache, (key, generation) )
+            if value is None:
+                self.misses[kind]+= 1
+            else:
+                self.hits[kind]+= 1
+        if value is None:
+            value= compute( data )
+            with self._lock:
+                if self.database.generation==generation:   #else, computed against a newer database
+                    cache.put( (key, generation), (self.clock(), value) )
+        return value
+
+    def score( self, data ):
+        '''database.score of data: a KeystrokeCaptureData (scored through its probe) or a probe Fingerprint.
+        Returns a list with one score per database fingerprint'''
+        return list( self._database_result( self._scores, 'score', data, self.database.score ) )
+
+    def best_match( self, data ):
+        '''database.best_match of data (see score), so indexed or branch and bound databases are searched their own way'''
+        return self._database_result( self._best, 'best', data, self.database.best_match )
+
+    def _check_generation( self ):
+        '''drops the score vectors and best matches of older database generations'''
+        if self.database.generation!=self._generation:
+            self._scores.clear()
+            self._best.clear()
+            self._generation= self.database.generation
+            self.invalidations+= 1
+
+    def clear( self ):
+        with self._lock:
+            self._captures.clear()
+            self._scores.clear()
+            self._best.clear()
+
+    def stats( self ):
+        '''hits and misses of each kind of entry, and the number of entries'''
+        with self._lock:
+            return {
+                'hits': dict(self.hits), 'misses': dict(self.misses), 'invalidations': self.invalidations,
+                'captures': len(self._captures), 'scores': len(self._scores), 'best': len(self._best),
+                }
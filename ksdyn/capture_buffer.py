@@ -0,0 +1,136 @@
+'''The parts of keystroke capture that don't need a X server: decoding of X RECORD replies,
+keycode names, and a ring buffer that decouples capture from the KeypressEventReceivers'''
+from ksdyn.core import KeystrokeCaptureData
+
+import threading
+import numpy as np
+
+class RecordDecoder(object):
+    '''Decodes the data of X RECORD replies into (key, event_type, time) events.
+    parse_event(data) must return (event, remaining data), like Xlib's rq.EventField(None).parse_binary_value'''
+    #X protocol constants (Xlib.ext.record.FromServer, Xlib.X.KeyPress, Xlib.X.KeyRelease)
+    FROM_SERVER= 0
+    KEY_PRESS, KEY_RELEASE= 2, 3
+    EVENT_TYPES= {KEY_PRESS: KeystrokeCaptureData.KEY_DOWN, KEY_RELEASE: KeystrokeCaptureData.KEY_UP}
+
+    def __init__(self, parse_event, stop_keycode=9):
+        '''stop_keycode (escape, by default) ends the capture'''
+        self.parse_event= parse_event
+        self.stop_keycode= stop_keycode
+        self.swapped= 0     #replies ignored because of swapped protocol data
+
+    def decode( self, reply ):
+        '''Returns (events, stop). If stop, the stop key was pressed, and events are the ones before it'''
+        events= []
+        if reply.category!=self.FROM_SERVER:
+            return events, False
+        if reply.client_swapped:
+            self.swapped+= 1
+            return events, False
+        data= reply.data
+        if not len(data) or ord(data[0]) < 2:
+            return events, False
+        while len(data):
+            event, data= self.parse_event( data )
+            if event.type in self.EVENT_TYPES:
+                if event.detail==self.stop_keycode:
+                    return events, True
+                events.append( (event.detail, self.EVENT_TYPES[event.type], event.time) )
+        return events, False
+
+
+class KeycodeTable(object):
+    '''Keycode -> key name, computed once instead of searching XK on every lookup'''
+    def __init__(self, names):
+        self.names= names
+
+    @classmethod
+    def from_display( cls, display, xk, keycodes=range(8, 256) ):
+        '''display must have keycode_to_keysym (a Xlib display); xk is the Xlib.XK module'''
+        keysym_names= {}
+        for name in dir(xk):
+            if name[:3]=="XK_":
+                keysym_names.setdefault( getattr(xk, name), name[3:] )
+        names= {}
+        for keycode in keycodes:
+            keysym= display.keycode_to_keysym( keycode, 0 )
+            if keysym:
+                names[keycode]= keysym_names.get( keysym, "[%d]" % keysym )
+        return cls( names )
+
+    def lookup( self, keycode ):
+        '''the key name, or None if the keycode isn't mapped'''
+        return self.names.get( keycode )
+
+
+class EventRingBuffer(object):
+    '''A bounded, preallocated FIFO of events, between a producer (the capture thread)
+    and a consumer. When full, new events are dropped and counted in overflows'''
+    def __init__(self, capacity=65536):
+        self.capacity= capacity
+        self._events= np.zeros( capacity, dtype=KeystrokeCaptureData.EVENT_DTYPE )
+        self._written= 0
+        self._read= 0
+        self.overflows= 0
+        self._lock= threading.Lock()
+        self._not_empty= threading.Condition( self._lock )
+
+    def __len__( self ):
+        return self._written - self._read
+
+    def push( self, key, event_type, time ):
+        '''Adds a event. Returns False (and counts a overflow) if the buffer is full'''
+        with self._lock:
+            if self._written - self._read >= self.capacity:
+                self.overflows+= 1
+                return False
+            self._events[ self._written % self.capacity ]= (key, event_type, time)
+            self._written+= 1
+            self._not_empty.notify()
+        return True
+
+    def pop_batch( self, max_events=None, timeout=None ):
+        '''Removes and returns (a copy of) the oldest events, at most max_events of them.
+        If the buffer is empty, waits up to timeout seconds for events (forever if None).
+        The result may be empty'''
+        with self._lock:
+            if self._written==self._read and timeout!=0:
+                self._not_empty.wait( timeout )
+            n= self._written - self._read
+            if max_events is not None:
+                n= min( n, max_events )
+            positions= (self._read + np.arange(n)) % self.capacity
+            batch= self._events[ positions ]
+            self._read+= n
+        return batch
+
+
+class BufferedDispatcher(threading.Thread):
+    '''A consumer thread, that delivers the events of a EventRingBuffer in batches to KeypressEventReceivers'''
+    def __init__(self, buffer, receivers, batch_size=1024, poll_interval=0.05):
+        threading.Thread.__init__( self )
+        self.daemon= True
+        self.buffer= buffer
+        self.receivers= list(receivers)
+        self.batch_size= batch_size
+        self.poll_interval= poll_interval
+        self.delivered= 0
+        self.batches= 0
+        self._stopping= threading.Event()
+
+    def run( self ):
+        while not self._stopping.is_set() or len(self.buffer):
+            batch= self.buffer.pop_batch( self.batch_size, self.poll_interval )
+            if len(batch):
+                self.deliver( batch )
+
+    def deliver( self, batch ):
+        for receiver in self.receivers:
+            receiver.on_events( batch )
+        self.delivered+= len(batch)
+        self.batches+= 1
+
+    def stop( self ):
+        '''Delivers the remaining events, and stops the thread'''
+        self._stopping.set()
+        self.join()
@@ -1,6 +1,7 @@
 #!/usr/bin/python
-#import sys
+import sys
 #import os
+from ksdyn.capture_buffer import RecordDecoder, KeycodeTable, EventRingBuffer, BufferedDispatcher
 from Xlib import X, XK, display
 from Xlib.ext import record
 from Xlib.protocol import rq
@@ -28,43 +29,31 @@ ctx = record_dpy.record_create_context(
             }])
 
 
+keycode_table= None
+
 def lookup_keycode(keycode):
-    keysym = local_dpy.keycode_to_keysym(keycode, 0)
-    if keysym:
-        for name in dir(XK):
-            if name[:3] == "XK_" and getattr(XK, name) == keysym:
-                return name[3:]
-        return "[%d]" % keysym
-    else:
-        return None
-    
+    global keycode_table
+    if keycode_table is None:
+        keycode_table= KeycodeTable.from_display(local_dpy, XK)
+    return keycode_table.lookup(keycode)
+
+
+def parse_event(data):
+    return rq.EventField(None).parse_binary_value(data, record_dpy.display, None, None)
+
+decoder= RecordDecoder(parse_event)
 
+def stop_recording():
+    local_dpy.record_disable_context(ctx)
+    local_dpy.flush()
 
 def record_callback(reply):
-    if reply.category != record.FromServer:
-        return
-    if reply.client_swapped:
-        print "* received swapped protocol data, cowardly ignored"
-        return
-    if not len(reply.data) or ord(reply.data[0]) < 2:
-        return
+    events, stop= decoder.decode(reply)
+    for event in events:
+        myrecordcallback(*event)
+    if stop:
+        stop_recording()
 
-    data = reply.data
-    while len(data):
-        event, data = rq.EventField(None).parse_binary_value(data, record_dpy.display, None, None)
-        if event.type in [X.KeyPress, X.KeyRelease]:
-            key=event.detail
-            
-            if key == 9: #escape
-                local_dpy.record_disable_context(ctx)
-                local_dpy.flush()
-                return
-                
-            if event.type==X.KeyPress:
-                myrecordcallback(key,0, event.time)
-            if event.type==X.KeyRelease:
-                myrecordcallback(key,1, event.time)
-                
 def start(mycallback):
     # Enable the context; this only returns after a call to record_disable_context,
     # while calling the callback function in the meantime
@@ -73,3 +62,22 @@ def start(mycallback):
     record_dpy.record_enable_context(ctx, record_callback)
     record_dpy.record_free_context(ctx)
 
+def start_buffered(receivers, capacity=65536, batch_size=1024):
+    '''Like start, but the RECORD callback only pushes events into a ring buffer, and a consumer thread
+    delivers them in batches to the KeypressEventReceivers, so slow receivers never block the X connection.
+    Returns the (stopped) BufferedDispatcher; its buffer counts overflows'''
+    buffer= EventRingBuffer(capacity)
+    dispatcher= BufferedDispatcher(buffer, receivers, batch_size)
+    dispatcher.start()
+    def buffered_callback(reply):
+        events, stop= decoder.decode(reply)
+        for event in events:
+            buffer.push(*event)
+        if stop:
+            stop_recording()
+    try:
+        record_dpy.record_enable_context(ctx, buffered_callback)
+        record_dpy.record_free_context(ctx)
+    finally:
+        dispatcher.stop()
+    return dispatcher
@@ -0,0 +1,186 @@
+'''Append-only capture files, for long capture sessions.
+Events are written in chunks as they arrive, so memory is bounded and a crash loses
+at most the last (unflushed or partially written) chunk.
+
+File format: FILE_MAGIC, FILE_HEADER (format version), then any number of chunks,
+each a CHUNK_HEADER (chunk magic, number of events, crc32 of the events) followed by
+the events as KeystrokeCaptureData.EVENT_DTYPE. Reading stops at the first incomplete or corrupt chunk.'''
+from ksdyn.core import KeypressEventReceiver, KeystrokeCaptureData
+
+import os
+import zlib
+import threading
+import struct
+import numpy as np
+from timeit import default_timer as clock
+
+EVENT_DTYPE= KeystrokeCaptureData.EVENT_DTYPE
+FILE_EXTENSION= ".keystream"
+FILE_MAGIC= '\x93KSSTRM'
+FILE_HEADER= struct.Struct('<H')        #format version
+FILE_VERSION= 1
+CHUNK_MAGIC= 'KSCK'
+CHUNK_HEADER= struct.Struct('<4sII')    #chunk magic, number of events, crc32 of the events
+
+def _crc( data ):
+    return zlib.crc32( data ) & 0xffffffff
+
+def _read_file_header( f, filename ):
+    magic= f.read( len(FILE_MAGIC) )
+    if magic!=FILE_MAGIC:
+        raise TypeError("{} is not a keystroke stream".format(filename))
+    version,= FILE_HEADER.unpack( f.read(FILE_HEADER.size) )
+    if version!=FILE_VERSION:
+        raise TypeError("Unsupported keystroke stream version: {}".format(version))
+
+def _read_chunks( f ):
+    '''yields (array of events, file offset after the chunk) of the valid chunks of f, which must be after the file header'''
+    while True:
+        header= f.read( CHUNK_HEADER.size )
+        if len(header)<CHUNK_HEADER.size:
+            return
+        magic, n, crc= CHUNK_HEADER.unpack( header )
+        if magic!=CHUNK_MAGIC:
+            return
+        data= f.read( n*EVENT_DTYPE.itemsize )
+        if len(data)<n*EVENT_DTYPE.itemsize or _crc(data)!=crc:
+            return
+        yield np.frombuffer( data, dtype=EVENT_DTYPE ), f.tell()
+
+
+class CaptureStreamWriter(KeypressEventReceiver):
+    '''Receives keypress events and appends them to a keystroke stream file.
+    Events are buffered, and written as a chunk when chunk_size events are buffered,
+    or flush_interval seconds after the last write (by a timer, even if no more events arrive), or on flush()/close().
+    Appending to a existing stream first discards its incomplete tail (from a crash), if any'''
+    def __init__(self, filename, chunk_size=4096, flush_interval=1.0, fsync=False):
+        '''fsync also forces every chunk to disk, not only to the OS'''
+        if not filename.endswith( FILE_EXTENSION ):
+            filename+= FILE_EXTENSION
+        self.filename= filename
+        self.chunk_size= chunk_size
+        self.flush_interval= flush_interval
+        self.fsync= fsync
+        self._buffer= np.zeros( chunk_size, dtype=EVENT_DTYPE )
+        self._buffered= 0
+        self.written= 0     #events written to the file
+        self.chunks= 0      #chunks written to the file
+        self._file= self._open( filename )
+        self._last_flush= clock()
+        self._lock= threading.RLock()  #the timer flushes from another thread
+        self._timer= None
+
+    @staticmethod
+    def _open( filename ):
+        if os.path.exists( filename ) and os.path.getsize( filename ):
+            f= open( filename, 'r+b' )
+            _read_file_header( f, filename )
+            end= f.tell()
+            for _, end in _read_chunks( f ):
+                pass
+            f.seek( end )
+            f.truncate()
+        else:
+            f= open( filename, 'wb' )
+            f.write( FILE_MAGIC + FILE_HEADER.pack(FILE_VERSION) )
+        return f
+
+    def on_key(self, key, event_type, time_ms):
+        with self._lock:
+            self._buffer[self._buffered]= (key, event_type, time_ms)
+            self._buffered+= 1
+            if self._buffered==self.chunk_size or clock()-self._last_flush >= self.flush_interval:
+                self.flush()
+            elif self._timer is None:
+                self._schedule()
+
+    def on_events(self, events):
+        events= np.asarray( events )
+        if events.dtype!=EVENT_DTYPE:
+            events= np.array( [tuple(e) for e in events], dtype=EVENT_DTYPE )
+        with self._lock:
+            while len(events):
+                n= min( len(events), self.chunk_size-self._buffered )
+                self._buffer[self._buffered:self._buffered+n]= events[:n]
+                self._buffered+= n
+                events= events[n:]
+                if self._buffered==self.chunk_size:
+                    self.flush()
+            if clock()-self._last_flush >= self.flush_interval:
+                self.flush()
+            elif self._buffered and self._timer is None:
+                self._schedule()
+
+    def _schedule( self ):
+        '''arms the timer that flushes the buffered events flush_interval seconds after the last write'''
+        self._timer= threading.Timer( max(0, self._last_flush + self.flush_interval - clock()), self._on_timer )
+        self._timer.daemon= True
+        self._timer.start()
+
+    def _on_timer( self ):
+        with self._lock:
+            if self._timer is threading.current_thread() and not self._file.closed:
+                self.flush()
+
+    def flush( self ):
+        '''Writes the buffered events as a chunk'''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer= None
+            if self._buffered:
+                data= self._buffer[:self._buffered].tobytes()
+                self._file.write( CHUNK_HEADER.pack(CHUNK_MAGIC, self._buffered, _crc(data)) + data )
+                self.written+= self._buffered
+                self.chunks+= 1
+                self._buffered= 0
+            self._file.flush()
+            if self.fsync:
+                os.fsync( self._file.fileno() )
+            self._last_flush= clock()
+
+    def close( self ):
+        with self._lock:
+            if not self._file.closed:
+                self.flush()
+                self._file.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.close()
+
+
+class CaptureStreamReader(object):
+    '''Reads a keystroke stream lazily, one chunk at a time'''
+    def __init__(self, filename):
+        if not os.path.exists( filename ):
+            filename+= FILE_EXTENSION
+        self.filename= filename
+
+    def chunks( self ):
+        '''yields the (valid) chunks, as arrays of EVENT_DTYPE'''
+        with open( self.filename, 'rb' ) as f:
+            _read_file_header( f, self.filename )
+            for events, _ in _read_chunks( f ):
+                yield events
+
+    def __iter__( self ):
+        '''yields the events, as (key, event_type, time_ms) tuples'''
+        for events in self.chunks():
+            for event in events.tolist():
+                yield event
+
+    def feed( self, event_receiver ):
+        '''feeds the events into a KeypressEventReceiver, one chunk at a time. Returns the event_receiver'''
+        for events in self.chunks():
+            event_receiver.on_events( events )
+        return event_receiver
+
+    def to_capture_data( self ):
+        '''loads the whole stream into memory, as KeystrokeCaptureData'''
+        chunks= list( self.chunks() )
+        if not chunks:
+            return KeystrokeCaptureData()
+        return KeystrokeCaptureData( np.concatenate(chunks) )
@@ -0,0 +1,123 @@
+'''A compact, array-backed representation of Fingerprints, for keeping (and pickling) many of them'''
+from ksdyn.core import normal_similarity, DictTree
+from ksdyn.features import digraph_name
+from ksdyn.model import Fingerprint, FingerprintComparer, GaussianAnomalyModel
+
+import numpy as np
+
+KEY_DTYPE= np.int32
+DIGRAPH_ID= 1<<30   #flag of digraph ids: DIGRAPH_ID | previous key<<15 | key
+
+def key_id( path ):
+    '''the integer id of the leaf path of a fingerprint model (a dwell time or a digraph).
+    Raises ValueError for paths with no id'''
+    if len(path)==1:
+        return int( path[0] )
+    if len(path)==2 and path[0]=="digraphs":
+        previous_key, key= map( int, path[1].split("-") )
+        if max(previous_key, key) < 1<<15:
+            return DIGRAPH_ID | previous_key<<15 | key
+    raise ValueError("No key id for path {}".format(path))
+
+def key_path( key_id ):
+    '''the leaf path of a key id (inverse of key_id)'''
+    if key_id & DIGRAPH_ID:
+        return ( "digraphs", digraph_name( (key_id>>15) & 0x7fff, key_id & 0x7fff ) )
+    return ( str(key_id), )
+
+
+class CompactFingerprint(object):
+    '''A Fingerprint of GaussianAnomalyModels, as a sorted array of key ids and parallel
+    arrays of the models' means, stddevs and number of samples'''
+    __slots__= ('name', 'keys', 'means', 'stddevs', 'nsamples')
+    COMPACT= True       #see FingerprintComparer.similarity
+    FLOAT_DTYPE= np.float32
+    NSAMPLES_DTYPE= np.int32
+
+    def __init__(self, name, keys, means, stddevs, nsamples):
+        '''keys must be sorted and unique'''
+        self.name= str(name)
+        self.keys=     np.asarray( keys,     dtype=KEY_DTYPE )
+        self.means=    np.asarray( means,    dtype=self.FLOAT_DTYPE )
+        self.stddevs=  np.asarray( stddevs,  dtype=self.FLOAT_DTYPE )
+        self.nsamples= np.asarray( nsamples, dtype=self.NSAMPLES_DTYPE )
+
+    @classmethod
+    def from_fingerprint( cls, fingerprint ):
+        '''Packs a Fingerprint. Means and stddevs are rounded to FLOAT_DTYPE;
+        pending moments (of keys with too few samples) are not kept'''
+        leaves= sorted( (key_id(path), m) for path,m in fingerprint.leaves() )
+        return cls( fingerprint.name,
+            [k for k,_ in leaves],
+            [m.mean for _,m in leaves],
+            [m.stddev for _,m in leaves],
+            [m.nsamples for _,m in leaves] )
+
+    def to_fingerprint( self ):
+        '''Unpacks into a Fingerprint of GaussianAnomalyModels.
+        from_fingerprint( f.to_fingerprint() ) is equal to f'''
+        fingerprint= Fingerprint( self.name )
+        for k, mean, stddev, n in zip( self.keys.tolist(), self.means.tolist(), self.stddevs.tolist(), self.nsamples.tolist() ):
+            path= key_path( k )
+            models= fingerprint
+            for name in path[:-1]:
+                if name not in models:
+                    models[name]= DictTree( name )
+                models= models[name]
+            model= GaussianAnomalyModel( path[-1] )
+            model.mean, model.stddev, model.nsamples= mean, stddev, n
+            models[path[-1]]= model
+        return fingerprint
+
+    def __len__( self ):
+        return len(self.keys)
+
+    def __eq__( self, other ):
+        return isinstance( other, CompactFingerprint ) and self.__getstate__()==other.__getstate__()
+
+    def __ne__( self, other ):
+        return not self==other
+
+    def __repr__( self ):
+        return "{}( {} )".format( self.__class__.__name__, self.name )
+
+    def __getstate__( self ):
+        return ( self.name, self.keys.tobytes(), self.means.tobytes(), self.stddevs.tobytes(), self.nsamples.tobytes() )
+
+    def __setstate__( self, state ):
+        name, keys, means, stddevs, nsamples= state
+        self.name= name
+        self.keys=     np.frombuffer( keys,     dtype=KEY_DTYPE )
+        self.means=    np.frombuffer( means,    dtype=self.FLOAT_DTYPE )
+        self.stddevs=  np.frombuffer( stddevs,  dtype=self.FLOAT_DTYPE )
+        self.nsamples= np.frombuffer( nsamples, dtype=self.NSAMPLES_DTYPE )
+
+    @staticmethod
+    def intersect( a, b ):
+        '''Returns (indexes in a, indexes in b) of the keys common to both, in key order.
+        A merge of the sorted keys (by binary search), instead of set intersections'''
+        positions= np.searchsorted( b.keys, a.keys )
+        positions[positions==len(b.keys)]= 0
+        common= (b.keys[positions]==a.keys) if len(b.keys) else np.zeros( len(a.keys), dtype=bool )
+        return np.flatnonzero( common ), positions[common]
+
+    def key_similarities( self, other ):
+        '''the similarities of the models of the keys common to self and other, in key order.
+        Same formula as GaussianDistribution.similarity'''
+        ia, ib= self.intersect( self, other )
+        means= self.means[ia].astype(float) - other.means[ib]
+        stddevs= (self.stddevs[ia].astype(float) + other.stddevs[ib]) / 2.0
+        return normal_similarity( means, stddevs )
+
+    def similarity( self, other, reducer=None ):
+        '''Same score as FingerprintComparer(reducer).similarity (0 if there are no common keys).
+        reducer must be one of the FingerprintComparer reducers'''
+        reducer= reducer or FingerprintComparer._multiplication_reducer
+        similarities= self.key_similarities( other )
+        if len(similarities)==0:
+            return 0.0
+        if reducer is FingerprintComparer._multiplication_reducer:
+            return float( np.prod(similarities) )
+        if reducer is FingerprintComparer._mean_reducer:
+            return float( np.mean(similarities) )
+        raise NotImplementedError("No vectorized version of reducer {}".format(reducer))
@@ -0,0 +1,123 @@
+from ksdyn.core import KeypressEventReceiver
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import FingerprintComparer
+
+import math
+from collections import deque
+
+class SlidingWindowScorer(FeatureExtractor):
+    '''Continuously scores the last window_size keystrokes against some fingerprints,
+    for re-verifying a user during a session.
+    Scores are the ones a FingerprintComparer would give to a Fingerprint fit to the
+    keystrokes in the window, but each event only updates the (at most two) keys
+    whose window statistics changed. Memory is bounded by window_size and the number of keys.
+    Only the dwell time models of the fingerprints are used (not digraphs).'''
+    RESYNC_EVERY= 4096  #updates between exact recomputations of the running scores
+
+    def __init__(self, fingerprints, callback, window_size=100, emit_every=10, reducer=None, timing_threshold=500):
+        '''callback is called with the list of scores (one per fingerprint) every emit_every keystrokes.
+        reducer is one of the FingerprintComparer reducers'''
+        FeatureExtractor.__init__( self, timing_threshold )
+        reducer= reducer or FingerprintComparer._multiplication_reducer
+        if reducer not in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            raise NotImplementedError("No incremental version of reducer {}".format(reducer))
+        self.multiplicative= reducer is FingerprintComparer._multiplication_reducer
+        self.fingerprints= list(fingerprints)
+        self.callback= callback
+        self.emit_every= emit_every
+        self.window= deque()            #(key, dwell_time) of the last window_size keystrokes
+        self.window_size= window_size
+        self.window_stats= {}           #key -> [nsamples, sum, sum of squares] of the window
+        self.nkeystrokes= 0
+        n= len(self.fingerprints)
+        self._similarities= [{} for _ in range(n)] #key -> similarity, for every key in common
+        self._log_sum= [0.0]*n          #sum of the logs of the non-zero similarities
+        self._zeros=   [0]*n            #number of zero (underflowing) similarities
+        self._sum=     [0.0]*n
+        self._updates= 0
+
+    on_events= KeypressEventReceiver.on_events #the batch FeatureExtractor path bypasses the window
+
+    def _add_flight_time( self, key, previous_key, flight_time ):
+        pass    #not used by the fingerprints
+
+    def _add_dwell_time( self, key, dwell_time ):
+        self.window.append( (key, dwell_time) )
+        self._update_stats( key, dwell_time, 1 )
+        if len(self.window)>self.window_size:
+            old_key, old_dwell_time= self.window.popleft()
+            self._update_stats( old_key, old_dwell_time, -1 )
+            if old_key!=key:
+                self._update_key( old_key )
+        self._update_key( key )
+        self.nkeystrokes+= 1
+        if self.nkeystrokes % self.emit_every == 0:
+            self.callback( self.scores() )
+
+    def _update_stats( self, key, x, sign ):
+        stats= self.window_stats.setdefault( key, [0, 0, 0] )
+        stats[0]+= sign
+        stats[1]+= sign*x
+        stats[2]+= sign*x*x
+        if stats[0]==0:
+            del self.window_stats[key]
+
+    def window_parameters( self, key ):
+        '''(mean, stddev) of the window samples of key, as GaussianDistribution.estimate_parameters.
+        None if there are too few samples'''
+        n, s, sq= self.window_stats.get( key, (0, 0, 0) )
+        if n<2:
+            return None
+        mean= s/float(n)
+        stddev= math.sqrt( max(0.0, (n*sq - s*s)/float(n*n)) )
+        return mean, max( mean*0.01, stddev )
+
+    def _update_key( self, key ):
+        parameters= self.window_parameters( key )
+        name= str(key)
+        for i, fingerprint in enumerate( self.fingerprints ):
+            model= fingerprint.get( name )
+            if model is None:
+                continue
+            old= self._similarities[i].pop( key, None )
+            if old is not None:
+                self._account( i, old, -1 )
+            if parameters is not None:
+                mean, stddev= parameters
+                #same as GaussianDistribution.similarity: 2*cdf(-x) == erfc(x/sqrt(2))
+                x= abs(model.mean - mean) / ((model.stddev + stddev) / 2.0)
+                new= math.erfc( x / math.sqrt(2) )
+                self._similarities[i][key]= new
+                self._account( i, new, 1 )
+        self._updates+= 1
+        if self._updates>=self.RESYNC_EVERY:
+            self._resync()
+
+    def _account( self, i, similarity, sign ):
+        self._sum[i]+= sign*similarity
+        if similarity>0:
+            self._log_sum[i]+= sign*math.log( similarity )
+        else:
+            self._zeros[i]+= sign
+
+    def _resync( self ):
+        '''recomputes the running sums, so floating point error doesn't accumulate'''
+        for i, similarities in enumerate( self._similarities ):
+            self._sum[i]= self._log_sum[i]= 0.0
+            self._zeros[i]= 0
+            for s in similarities.values():
+                self._account( i, s, 1 )
+        self._updates= 0
+
+    def scores( self ):
+        '''the current score of each fingerprint. Fingerprints with no keys in common with the window score 0'''
+        scores= []
+        for i, similarities in enumerate( self._similarities ):
+            n= len(similarities)
+            if n==0 or (self.multiplicative and self._zeros[i]):
+                scores.append( 0.0 )
+            elif self.multiplicative:
+                scores.append( math.exp(self._log_sum[i]) )
+            else:
+                scores.append( self._sum[i]/n )
+        return scores
@@ -1,6 +1,11 @@
+from ksdyn.instrumentation import instrumented
+
+import os
+import math
 import pickle
+import hashlib
+import struct
 import numpy as np
-import scipy.stats
 from abc import ABCMeta, abstractmethod
 
 class KeypressEventReceiver(object):
@@ -16,6 +21,14 @@ class KeypressEventReceiver(object):
         '''
         pass
 
+    def on_events(self, events):
+        '''Receives many events at once: a array of KeystrokeCaptureData.EVENT_DTYPE,
+        or a sequence of (key, event_type, time_ms). Subclasses can override this with faster batch processing'''
+        if isinstance( events, np.ndarray ):
+            events= events.tolist()
+        for event in events:
+            self.on_key( *event )
+
 class VersionedSerializableClass( object ):
     __metaclass__=ABCMeta
     FILE_EXTENSION=".pickle"
@@ -25,8 +38,17 @@ class VersionedSerializableClass( object ):
         self._class_version= self.CLASS_VERSION
     
     def save_to_file(self, filename):
-        with open(filename+self.FILE_EXTENSION, 'wb') as f:
-            self._serialize_to_file( f )
+        '''Writes to a temporary file, then renames it over filename, so that readers never see
+        a partial file, and saving data memory-mapped from filename doesn't truncate it first'''
+        filename+= self.FILE_EXTENSION
+        temporary= "{}.{}.tmp".format( filename, os.getpid() )
+        try:
+            with open(temporary, 'wb') as f:
+                self._serialize_to_file( f )
+            os.rename( temporary, filename )
+        finally:
+            if os.path.exists( temporary ):
+                os.remove( temporary )
 
     @classmethod
     def load_from_file( cls, filename):
@@ -35,16 +57,19 @@ class VersionedSerializableClass( object ):
             filename+=cls.FILE_EXTENSION
         with open(filename, 'rb') as f:
             instance= cls._deserialize_from_file( f )
+        cls._check_loaded( instance, filename )
+        return instance
 
+    @classmethod
+    def _check_loaded( cls, instance, source ):
+        '''raises TypeError if a instance deserialized from source is not of this class and version'''
         load_error=None
         if not isinstance( instance, cls ):
             load_error= 'Unexpected instance type'
         elif instance._class_version!=cls.CLASS_VERSION:
             load_error= 'Class version mismatch (expected "{}", got "{}")'.format( cls.CLASS_VERSION, instance._class_version)
         if load_error:
-            raise TypeError("Failed to load serialized data from {}: {}".format(filename, load_error))
-
-        return instance
+            raise TypeError("Failed to load serialized data from {}: {}".format(source, load_error))
 
     @classmethod
     def load_from_dir( cls, directory ):
@@ -65,32 +90,78 @@ class VersionedSerializableClass( object ):
 
  
 class KeystrokeCaptureData(KeypressEventReceiver, VersionedSerializableClass):
-    '''Recorded data of actual keystrokes pressed by a user'''
+    '''Recorded data of actual keystrokes pressed by a user.
+    The log is either a list of (key, event_type, time_ms) tuples or, when
+    loaded from a file, a (read-only, memory-mapped) array of EVENT_DTYPE'''
     FILE_EXTENSION=".keypresses"
     CLASS_VERSION= 0
+    EVENT_DTYPE= np.dtype([('key','<u2'), ('event_type','u1'), ('time','<i8')])
+    FILE_MAGIC= '\x93KSDYN'
+    FILE_HEADER= struct.Struct('<HQ')   #format version, number of events
+    FILE_VERSION= 1
+    FEED_CHUNK= 65536                   #events converted at a time when feeding a memory-mapped log
 
     def __init__(self, existing_data=None):
         VersionedSerializableClass.__init__(self)
-        self.log= list(existing_data) if existing_data else []
+        if isinstance( existing_data, np.ndarray ):
+            self.log= existing_data
+        else:
+            self.log= list(existing_data) if existing_data else []
 
     def on_key(self, key, event_type, time_ms):
         '''Append a keypress event to this capture data'''
+        if not isinstance( self.log, list ):
+            self.log= self.log.tolist()
         self.log.append( (key, event_type, time_ms) )
 
+    @property
+    def events(self):
+        '''The log, as a array of EVENT_DTYPE'''
+        if isinstance( self.log, np.ndarray ):
+            return self.log
+        return np.array( self.log, dtype=self.EVENT_DTYPE )
+
     def feed(self, event_receiver):
         '''feeds this data into a KeypressEventReceiver.
         Returns the event_receiver'''
-        for event in self.log:
-            event_receiver.on_key( *event )
+        if isinstance( self.log, list ):
+            for event in self.log:
+                event_receiver.on_key( *event )
+        else:
+            for i in xrange(0, len(self.log), self.FEED_CHUNK):
+                for event in self.log[i:i+self.FEED_CHUNK].tolist():
+                    event_receiver.on_key( *event )
         return event_receiver
 
+    def content_hash(self):
+        '''A hash (hex string) of the events, the same for equal logs whether they're lists or arrays'''
+        h= hashlib.sha1()
+        events= self.events
+        for i in xrange(0, len(events), self.FEED_CHUNK):
+            h.update( events[i:i+self.FEED_CHUNK].tobytes() )
+        return h.hexdigest()
+
     def _serialize_to_file( self, f ):
-        f.write( str(self.log) )
+        events= self.events
+        f.write( self.FILE_MAGIC )
+        f.write( self.FILE_HEADER.pack(self.FILE_VERSION, len(events)) )
+        f.write( events.tobytes() )
 
     @classmethod
-    def _deserialize_from_file( self, f ):
-        from ast import literal_eval
-        data= literal_eval(f.read())
+    def _deserialize_from_file( cls, f ):
+        if f.read(len(cls.FILE_MAGIC))!=cls.FILE_MAGIC:
+            #legacy format: the repr of the log list
+            from ast import literal_eval
+            f.seek(0)
+            data= literal_eval(f.read())
+            return KeystrokeCaptureData(data)
+        version, n= cls.FILE_HEADER.unpack( f.read(cls.FILE_HEADER.size) )
+        if version!=cls.FILE_VERSION:
+            raise TypeError("Unsupported {} file version: {}".format(cls.__name__, version))
+        if n==0:
+            return KeystrokeCaptureData()
+        offset= len(cls.FILE_MAGIC) + cls.FILE_HEADER.size
+        data= np.memmap( f, dtype=cls.EVENT_DTYPE, mode='r', offset=offset, shape=(n,) )
         return KeystrokeCaptureData(data)
 
 class InsufficientData(ValueError):
@@ -98,6 +169,109 @@ class InsufficientData(ValueError):
     An example would be a low number of samples for normal distribution estimation'''
     pass
 
+#W. J. Cody's rational approximations of erf and erfc (Math. Comp. 1969), as in his CALERF
+_ERF_THRESHOLD= 0.46875
+_ERF_A= (3.16112374387056560e00, 1.13864154151050156e02, 3.77485237685302021e02, 3.20937758913846947e03, 1.85777706184603153e-1)
+_ERF_B= (2.36012909523441209e01, 2.44024637934444173e02, 1.28261652607737228e03, 2.84423683343917062e03)
+_ERFC_C= (5.64188496988670089e-1, 8.88314979438837594e00, 6.61191906371416295e01, 2.98635138197400131e02,
+    8.81952221241769090e02, 1.71204761263407058e03, 2.05107837782607147e03, 1.23033935479799725e03, 2.15311535474403846e-8)
+_ERFC_D= (1.57449261107098347e01, 1.17693950891312499e02, 5.37181101862009858e02, 1.62138957456669019e03,
+    3.29079923573345963e03, 4.36261909014324716e03, 3.43936767414372164e03, 1.23033935480374942e03)
+_ERFC_P= (3.05326634961232344e-1, 3.60344899949804439e-1, 1.25781726111229246e-1, 1.60837851487422766e-2,
+    6.58749161529837803e-4, 1.63153871373020978e-2)
+_ERFC_Q= (2.56852019228982242e00, 1.87295284992346725e00, 5.27905102951428412e-1, 6.05183413124413191e-2, 2.33520497626869185e-3)
+_SQRT_1_PI= 5.6418958354775628695e-1
+_LOG_SQRT_2PI= 0.5*math.log( 2*math.pi )
+
+def _erf_small( x ):
+    '''erf(x), for |x|<=_ERF_THRESHOLD'''
+    x2= x*x
+    num, den= _ERF_A[4]*x2, x2
+    for a, b in zip( _ERF_A[:3], _ERF_B[:3] ):
+        num, den= (num + a)*x2, (den + b)*x2
+    return x*(num + _ERF_A[3]) / (den + _ERF_B[3])
+
+def _erfcx( y ):
+    '''erfc(y)*exp(y**2), for y>_ERF_THRESHOLD'''
+    result= np.empty_like( y )
+    mid= y<=4.0
+    ym= y[mid]
+    num, den= _ERFC_C[8]*ym, ym
+    for c, d in zip( _ERFC_C[:7], _ERFC_D[:7] ):
+        num, den= (num + c)*ym, (den + d)*ym
+    result[mid]= (num + _ERFC_C[7]) / (den + _ERFC_D[7])
+    yl= y[~mid]
+    z= 1/(yl*yl)
+    num, den= _ERFC_P[5]*z, z
+    for p, q in zip( _ERFC_P[:4], _ERFC_Q[:4] ):
+        num, den= (num + p)*z, (den + q)*z
+    result[~mid]= (_SQRT_1_PI - z*(num + _ERFC_P[4]) / (den + _ERFC_Q[4])) / yl
+    return result
+
+def _exp_minus_square( y ):
+    '''exp(-y**2), splitting y**2 to keep the precision of erfc'''
+    rounded= np.trunc( y*16 )/16
+    return np.exp( -rounded*rounded ) * np.exp( -(y - rounded)*(y + rounded) )
+
+def _erfc( x ):
+    '''erfc of a 1-d float array'''
+    y= np.abs( x )
+    result= np.empty_like( x )
+    small= y<=_ERF_THRESHOLD
+    result[small]= 1 - _erf_small( x[small] )
+    big= ~small
+    yb= y[big]
+    erfc_y= _erfcx( yb ) * _exp_minus_square( yb )
+    result[big]= np.where( x[big]<0, 2 - erfc_y, erfc_y )
+    return result
+
+def erfc_ndtr( x ):
+    '''The standard normal cdf, from a numpy erfc (accurate to about double precision, but slower than scipy's ndtr)'''
+    x= np.asarray( x, dtype=float )
+    return (0.5*_erfc( -x.ravel()/math.sqrt(2) )).reshape( x.shape )[()]
+
+def erfc_log_ndtr( x ):
+    '''log of the standard normal cdf, from a numpy erfc. Where erfc underflows, log(erfc(y)) is log(erfcx(y)) - y**2'''
+    x= np.asarray( x, dtype=float )
+    shape, x= x.shape, x.ravel()
+    result= np.empty_like( x )
+    y= -x/math.sqrt(2)
+    upper= x>0     #log1p is accurate near 0
+    result[upper]= np.log1p( -0.5*_erfc( -y[upper] ) )
+    small= ~upper & (y<=_ERF_THRESHOLD)
+    result[small]= np.log( 0.5*(1 - _erf_small( y[small] )) )
+    lower= ~upper & ~small
+    yl= y[lower]
+    result[lower]= math.log(0.5) + np.log( _erfcx(yl) ) - yl*yl
+    return result.reshape( shape )[()]
+
+_ndtr= _log_ndtr= None
+
+def _load_ndtr():
+    '''picks scipy's normal cdf if it's available, or the erfc based one. Done on first use, so that importing
+    ksdyn doesn't import scipy. The KSDYN_NO_SCIPY environment variable forces the erfc based one'''
+    global _ndtr, _log_ndtr
+    try:
+        if os.environ.get( 'KSDYN_NO_SCIPY' ):
+            raise ImportError("scipy disabled by KSDYN_NO_SCIPY")
+        import scipy.special
+        _ndtr, _log_ndtr= scipy.special.ndtr, scipy.special.log_ndtr
+    except ImportError:
+        _ndtr, _log_ndtr= erfc_ndtr, erfc_log_ndtr
+
+def normal_similarity( difference, stddev ):
+    '''Probability of a normal variable being further from its mean than difference: 2*cdf(-|difference|/stddev).
+    A single ufunc call, so difference and stddev can be arrays, and are broadcast'''
+    if _ndtr is None:
+        _load_ndtr()
+    return 2*_ndtr( -np.abs(difference)/stddev )
+
+def log_normal_similarity( difference, stddev ):
+    '''log of normal_similarity, accurate even where normal_similarity underflows to 0'''
+    if _log_ndtr is None:
+        _load_ndtr()
+    return np.log(2) + _log_ndtr( -np.abs(difference)/stddev )
+
 class GaussianDistribution(object):
     def __init__(self, mean=0.0, stddev=1.0, nsamples=None):
         self.mean, self.stddev= mean, stddev
@@ -105,24 +279,62 @@ class GaussianDistribution(object):
 
     @staticmethod
     def estimate_parameters( samples ):
+        return GaussianDistribution.parameters_from_moments( GaussianDistribution.estimate_moments(samples) )
+
+    @staticmethod
+    def estimate_moments( samples ):
+        '''Returns the sufficient statistics (nsamples, mean, m2) of samples,
+        m2 being the sum of squared differences from the mean'''
         nsamples= len(samples)
+        if nsamples==0:
+            return 0, 0.0, 0.0
+        samples= np.asarray( samples, dtype=float )
+        mean= np.mean( samples )
+        return nsamples, mean, np.sum( (samples-mean)**2 )
+
+    @staticmethod
+    def merge_moments( a, b ):
+        '''Combines the (nsamples, mean, m2) of two sets of samples into those of their union (Chan et al.)'''
+        (na, mean_a, m2a), (nb, mean_b, m2b)= a, b
+        nsamples= na+nb
+        if nsamples==0:
+            return 0, 0.0, 0.0
+        delta= mean_b - mean_a
+        mean= mean_a + delta*nb/float(nsamples)
+        m2= m2a + m2b + delta**2 * na*nb/float(nsamples)
+        return nsamples, mean, m2
+
+    @staticmethod
+    def parameters_from_moments( moments ):
+        nsamples, mean, m2= moments
         if nsamples<2:
             raise InsufficientData()
-        mean=   np.mean( samples )
-        stddev= np.std(samples) #TODO: use proper Normal stddev estimation formula
+        stddev= np.sqrt( m2/nsamples ) #TODO: use proper Normal stddev estimation formula
         stddev= max( mean*0.01, stddev ) #avoid stddev==0
         return mean, stddev, nsamples
 
+    @instrumented('core.similarity')
     def similarity( self, other_normal ):
         '''quick-and-dirty hack. don't take this too seriously'''
         stddev= (self.stddev + other_normal.stddev) / 2.0
         difference= abs(self.mean - other_normal.mean)
-        return 2*scipy.stats.norm.cdf(-difference/stddev)
+        return normal_similarity( difference, stddev )
 
     def similarity_number( self, number ):
-        stddev= self.stddev
-        difference= abs(self.mean - number)
-        return 2*scipy.stats.norm.cdf(-difference/stddev)
+        return normal_similarity( self.mean - number, self.stddev )
+
+    def similarity_numbers( self, numbers, log=False ):
+        '''Vectorized similarity_number: returns a array with the similarity of each number.
+        If log, returns the log of the similarities'''
+        return GaussianDistribution.similarities( self.mean, self.stddev, numbers, log )
+
+    @staticmethod
+    def similarities( means, stddevs, numbers, log=False ):
+        '''similarity_number of many distributions (given by their means and stddevs) and numbers, in a single ufunc call.
+        Arguments are broadcast, so means[:,None], stddevs[:,None] and numbers[None,:]
+        give a (distributions x numbers) array'''
+        f= log_normal_similarity if log else normal_similarity
+        return f( np.subtract(means, numbers), stddevs )
 
     def __repr__(self):
         return "{}({:.2f}, {:.2f}, {})".format( self.__class__.__name__, self.mean, self.stddev, self.nsamples )
@@ -156,6 +368,7 @@ class DictTree(dict, Named):
             return default
 
     @classmethod
+    @instrumented('core.intersect')
     def intersect( cls, *trees  ):
         '''Given N DictTrees, returns N DictTrees, such that
         each outputed tree is a exact copy of the input, but only
@@ -166,10 +379,12 @@ class DictTree(dict, Named):
             '''returns the child with child_name for every tree'''
             childs= [tree[child_name] for tree in trees]
             if recursive and childs and isinstance(childs[0], DictTree):
-                return cls.getCommonFeatures( childs )
+                return DictTree.intersect( *childs )
             else:
                 return childs
-        all_childs= zip(*map( get_childs, common_names ))
+        all_childs= map( get_childs, sorted(common_names) ) #sorted, so results don't depend on dict order
+        all_childs= [c for c in all_childs if DictTree._isleave(c[0]) or len(c[0])] #without empty subtrees
+        all_childs= zip(*all_childs) or [()]*len(trees)
         return [cls(tree.name, childs) for tree,childs in zip(trees, all_childs)]
 
     @staticmethod
@@ -177,6 +392,7 @@ class DictTree(dict, Named):
         return not isinstance(x, DictTree)
 
     @classmethod
+    @instrumented('core.map')
     def map( cls, f_leave, *trees ):
         def map_child( *c ):
             return f_leave(*c) if DictTree._isleave(c[0]) else cls.map( f_leave, *c) 
@@ -185,6 +401,17 @@ class DictTree(dict, Named):
         filtered_children= filter( lambda x: x is not cls.IGNORE_CHILD, children )
         return cls( trees[0].name, filtered_children )
 
+    def leaves( self, prefix=() ):
+        '''Yields (path, leaf) for every leaf in this tree, where path is
+        the tuple of names leading from this tree to the leaf'''
+        for name, c in self.items():
+            path= prefix+(name,)
+            if DictTree._isleave(c):
+                yield path, c
+            else:
+                for x in c.leaves( path ):
+                    yield x
+
     def reduce( self, reduce_f ):
         return reduce(reduce_f, (c if DictTree._isleave(c) else c.reduce(reduce_f) for c in self.values()))
 
@@ -0,0 +1,132 @@
+'''Bulk enrollment: creates (or refreshes) the fingerprints of every capture file in a directory.
+usage: python -m ksdyn.enroll CAPTURE_DIR [-o FINGERPRINT_DIR] [-j WORKERS] [--force]
+CAPTURE_DIR can be "-", to read capture filenames from stdin, one per line'''
+from ksdyn.core import KeystrokeCaptureData
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import Fingerprint
+
+import os
+import sys
+import time
+import multiprocessing
+from collections import defaultdict
+
+STAGES= ('load', 'extract', 'fit', 'save')
+
+def user_name( capture_filename ):
+    return os.path.basename( capture_filename )[:-len(KeystrokeCaptureData.FILE_EXTENSION)]
+
+def fingerprint_filename( capture_filename, fingerprint_dir ):
+    return os.path.join( fingerprint_dir, user_name(capture_filename) + Fingerprint.FILE_EXTENSION )
+
+def is_up_to_date( capture_filename, fingerprint_dir ):
+    '''True if the fingerprint is newer than the capture file'''
+    try:
+        return os.path.getmtime( fingerprint_filename(capture_filename, fingerprint_dir) ) >= os.path.getmtime( capture_filename )
+    except OSError:
+        return False
+
+def enroll_file( capture_filename, fingerprint_dir, max_digraphs=0 ):
+    '''load -> FeatureExtractor -> Fingerprint.fit -> save, for a single capture file.
+    max_digraphs is passed to the FeatureExtractor, and bounds later updates of the fingerprint.
+    Returns (name, number of events, {stage: seconds}, error message or None)'''
+    name= user_name( capture_filename )
+    timings= {}
+    nevents= 0
+    try:
+        t= time.time()
+        data= KeystrokeCaptureData.load_from_file( capture_filename )
+        events= data.events
+        nevents= len(events)
+        timings['load'], t= time.time()-t, time.time()
+        extractor= FeatureExtractor( max_digraphs=max_digraphs )
+        extractor.on_events( events )
+        features= extractor.extract_features()
+        timings['extract'], t= time.time()-t, time.time()
+        fingerprint= Fingerprint.from_features( name, features )
+        fingerprint.max_digraphs= max_digraphs
+        timings['fit'], t= time.time()-t, time.time()
+        fingerprint.save_to_file( os.path.join(fingerprint_dir, name) )
+        timings['save']= time.time()-t
+    except Exception as e:
+        return name, nevents, timings, "{}: {}".format( e.__class__.__name__, e )
+    return name, nevents, timings, None
+
+def _enroll_file( args ):
+    return enroll_file( *args )
+
+class EnrollmentReport(object):
+    '''Counts and per-stage throughput of a bulk enrollment'''
+    def __init__(self):
+        self.enrolled, self.skipped= 0, 0
+        self.failed= {}     #name -> error message
+        self.nevents= 0
+        self.stage_time= defaultdict(float)    #summed over workers
+        self.wall_time= 0.0
+
+    def add( self, name, nevents, timings, error ):
+        if error:
+            self.failed[name]= error
+            return
+        self.enrolled+= 1
+        self.nevents+= nevents
+        for stage, t in timings.items():
+            self.stage_time[stage]+= t
+
+    def __str__( self ):
+        lines= ["enrolled {}, skipped {} (up to date), failed {} in {:.2f}s".format( self.enrolled, self.skipped, len(self.failed), self.wall_time )]
+        for stage in STAGES:
+            t= self.stage_time[stage] or float('nan')
+            lines.append( "  {:<8} {:8.2f}s  {:10.1f} users/s  {:12.1f} events/s (per worker)".format( stage, t, self.enrolled/t, self.nevents/t ) )
+        if self.wall_time:
+            lines.append( "  {:<8} {:8.2f}s  {:10.1f} users/s  {:12.1f} events/s".format( 'total', self.wall_time, self.enrolled/self.wall_time, self.nevents/self.wall_time ) )
+        for name, error in sorted( self.failed.items() ):
+            lines.append( "  failed {}: {}".format(name, error) )
+        return "\n".join( lines )
+
+def enroll( capture_filenames, fingerprint_dir, workers=None, force=False, chunk_size=16, max_digraphs=0 ):
+    '''Creates the fingerprint of each capture file in fingerprint_dir, with parallel worker processes.
+    Unless force, skips users whose fingerprint is newer than their capture file.
+    Returns a EnrollmentReport'''
+    report= EnrollmentReport()
+    start= time.time()
+    pending= []
+    for filename in capture_filenames:
+        if not force and is_up_to_date( filename, fingerprint_dir ):
+            report.skipped+= 1
+        else:
+            pending.append( (filename, fingerprint_dir, max_digraphs) )
+    if pending:
+        pool= multiprocessing.Pool( workers )
+        try:
+            for result in pool.imap_unordered( _enroll_file, pending, chunk_size ):
+                report.add( *result )
+        finally:
+            pool.close()
+            pool.join()
+    report.wall_time= time.time()-start
+    return report
+
+def capture_filenames( source ):
+    '''the capture files in directory source or, if source is "-", the filenames read from stdin'''
+    if source=='-':
+        return (line.strip() for line in sys.stdin if line.strip())
+    ext= KeystrokeCaptureData.FILE_EXTENSION
+    return sorted( os.path.join(source, f) for f in os.listdir(source) if f.endswith(ext) )
+
+def main( argv=None ):
+    import argparse
+    parser= argparse.ArgumentParser( description="Creates the fingerprints of many capture files" )
+    parser.add_argument( 'source', help='directory of {} files, or "-" to read filenames from stdin'.format(KeystrokeCaptureData.FILE_EXTENSION) )
+    parser.add_argument( '-o', '--output', help='fingerprint directory (defaults to the source directory)' )
+    parser.add_argument( '-j', '--workers', type=int, default=None, help='worker processes (defaults to the number of cores)' )
+    parser.add_argument( '--force', action='store_true', help='re-enroll users with up to date fingerprints' )
+    parser.add_argument( '--digraphs', type=int, default=0, help='also model the flight times of (at most) this many most frequent digraphs per user' )
+    args= parser.parse_args( argv )
+    output= args.output or (args.source if args.source!='-' else '.')
+    report= enroll( capture_filenames(args.source), output, args.workers, args.force, max_digraphs=args.digraphs )
+    print report
+    return 1 if report.failed else 0
+
+if __name__=='__main__':
+    sys.exit( main() )
@@ -2,7 +2,7 @@ from functools import partial
 
 from ksdyn.core import KeystrokeCaptureData
 from ksdyn.model import Fingerprint, FingerprintDatabase
-from ksdyn.sugar import create_fingerprint_from_capture_data
+from ksdyn.sugar import create_fingerprint_from_capture_data, extract_features_from_capture_data
 
 DATA_DIR= "data/"
 
@@ -33,8 +33,8 @@ def create_fingerprint():
 def match_fingerprint():
     db= FingerprintDatabase().load_from_dir( DATA_DIR )
     data= get_some_keystrokes()
-    f= create_fingerprint_from_capture_data( "NoName", data )
-    best= db.best_match( f )
+    features= extract_features_from_capture_data( data )
+    best= db.best_match( features )
     print "Best match: ", best.name
 
 if __name__=='__main__':
@@ -1,8 +1,11 @@
 from ksdyn.core import KeypressEventReceiver, Named, DictTree
+from ksdyn.instrumentation import instrumented
+from ksdyn.sketch import QuantileSketch
 
 import numpy as np
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from functools import partial
 
 
 class Feature(Named):
@@ -19,14 +22,80 @@ class FloatSeq(Feature):
         Feature.__init__(self, name)
         self.data= data
 
+class SampleSketch( Feature ):
+    '''A sequence of real numbers, summarized by a QuantileSketch (in the "sketch" attribute)'''
+    def __init__(self, name, sketch):
+        Feature.__init__(self, name)
+        self.sketch= sketch
+
 class KeyDwellTimes( FloatSeq ):
     '''A sequence of times time while a certain keyboard key is pressed.
     The "name" attribute of this feature is the key name'''
     pass
+
+class DigraphFlightTimes( FloatSeq ):
+    '''A sequence of times between the presses of two consecutive keys (a digraph).
+    The "name" attribute of this feature is the digraph name (see digraph_name)'''
+    pass
+
+def digraph_name( previous_key, key ):
+    return "{}-{}".format( previous_key, key )
+
+class DigraphStore(object):
+    '''Flight times of the most frequent digraphs, in bounded memory: at most max_digraphs digraphs,
+    with at most max_samples (the latest) flight times each.
+    When full, a new digraph evicts the least frequent one and inherits its count
+    (the Space-Saving algorithm), so that frequent digraphs end up being kept.
+    Digraphs are also kept in buckets by count, so finding the least frequent one takes O(1)'''
+    def __init__(self, max_digraphs=64, max_samples=256):
+        self.max_digraphs= max_digraphs
+        self.max_samples= max_samples
+        self.counts= {}     #(previous key, key) -> (approximate) number of occurrences
+        self.times= {}      #(previous key, key) -> deque of flight times
+        self.evictions= 0
+        self._buckets= {}   #count -> digraphs with that count, oldest first (a OrderedDict used as a set)
+        self._min= 0        #smallest count
+
+    def add( self, previous_key, key, flight_time ):
+        digraph= (previous_key, key)
+        if digraph not in self.counts:
+            count= 0
+            if len(self.counts)>=self.max_digraphs:
+                evicted, _= self._buckets[self._min].popitem( last=False )
+                count= self.counts.pop( evicted )
+                del self.times[evicted]
+                self.evictions+= 1
+            self.counts[digraph]= count
+            self.times[digraph]= deque( maxlen=self.max_samples )
+        self._increment( digraph )
+        self.times[digraph].append( flight_time )
+
+    def _increment( self, digraph ):
+        '''adds 1 to the count of digraph, moving it to the next bucket'''
+        count= self.counts[digraph]
+        bucket= self._buckets.get( count )
+        if bucket is not None:
+            bucket.pop( digraph, None )     #not there if it replaces a evicted digraph
+            if not bucket:
+                del self._buckets[count]
+        self.counts[digraph]= count+1
+        self._buckets.setdefault( count+1, OrderedDict() )[digraph]= True
+        if count==0:
+            self._min= 1
+        elif count==self._min and count not in self._buckets:
+            self._min= count+1
+
+    def extract_features( self ):
+        '''Returns a CompositeFeature of DigraphFlightTimes'''
+        digraphs= [DigraphFlightTimes(digraph_name(*d), list(t)) for d,t in self.times.items()]
+        return CompositeFeature( "digraphs", digraphs )
  
 class FeatureExtractor(KeypressEventReceiver):
     '''Extracts features from keypress data'''
-    def __init__(self, timing_threshold=500):
+    def __init__(self, timing_threshold=500, max_digraphs=0, max_digraph_samples=256, sketch_compression=0):
+        '''If max_digraphs, also extracts the flight times of (at most) the max_digraphs most frequent digraphs.
+        If sketch_compression, keeps the dwell and flight times of each key in a QuantileSketch of that compression
+        instead of a list, so memory doesn't grow with the number of keystrokes'''
         self.pt=0           #last press  time
         self.pk=0           #last pressed key
         self.press_time={}  #dictionary that associates currently depressed keys and
@@ -34,16 +103,73 @@ class FeatureExtractor(KeypressEventReceiver):
                             #before the preceding key is released
         
         self.timing_threshold= timing_threshold   # if timing betweeen events is bigger than this, ignore those events
-        self.dwell_times=           defaultdict(list)
-        self.flight_times_before=   defaultdict(list)
-        self.flight_times_after=    defaultdict(list)
+        samples= partial( QuantileSketch, sketch_compression ) if sketch_compression else list
+        self.dwell_times=           defaultdict(samples)
+        self.flight_times_before=   defaultdict(samples)
+        self.flight_times_after=    defaultdict(samples)
+        self.sketch_compression= sketch_compression
+        self.digraphs= DigraphStore( max_digraphs, max_digraph_samples ) if max_digraphs else None
+        #state of chunk extractors, see for_chunk and merge
+        self.touched= None      #keys with events so far, or None if the initial state is known
+        self.first_ups= {}      #key -> time of its first release, if it came before any press of the key
+        self.first_press= None  #(key, time) of the first press, if the previous press is unknown
 
+    @classmethod
+    def for_chunk( cls, timing_threshold=500, sketch_compression=0 ):
+        '''A extractor for a chunk of events that doesn't start the log: the previous press and
+        the keys depressed before the chunk are unknown. Features that depend on them are
+        kept aside, until the extractor of the previous events merges this one (see merge)'''
+        fe= cls( timing_threshold, sketch_compression=sketch_compression )
+        fe.pt= fe.pk= None
+        fe.touched= set()
+        return fe
+
+    def merge( self, other ):
+        '''Merges other, a extractor (see for_chunk) of the events right after the ones this extractor received.
+        Afterwards, this extractor is exactly as if it had received those events too
+        (but for the rounding of merged sketches, if sketching). Returns self'''
+        if other.touched is None:
+            raise ValueError("Only extractors created with for_chunk can be merged into others")
+        if self.digraphs is not None or other.digraphs is not None:
+            raise NotImplementedError("Digraph eviction depends on the order of events, so it can't be merged")
+        if other.first_press is not None:
+            key, time= other.first_press
+            if self.pt is None:
+                self.first_press= other.first_press     #no presses here either
+            elif time - self.pt < self.timing_threshold:
+                self._add_flight_time( key, self.pk, time - self.pt )
+        for key, time in other.first_ups.items():
+            if key in self.press_time:
+                if time - self.press_time[key] < self.timing_threshold:
+                    self._add_dwell_time( key, time - self.press_time[key] )
+            elif self.touched is not None and key not in self.touched:
+                self.first_ups[key]= time
+        for name in ('dwell_times', 'flight_times_before', 'flight_times_after'):
+            lists= getattr( self, name )
+            for key, values in getattr( other, name ).items():
+                lists[key].extend( values )
+        if other.pt is not None:
+            self.pt, self.pk= other.pt, other.pk
+        for key in other.touched:
+            self.press_time.pop( key, None )
+        self.press_time.update( other.press_time )
+        if self.touched is not None:
+            self.touched.update( other.touched )
+        return self
+
+    @instrumented('features.on_key')
     def on_key(self, key, type, time):
+        if self.touched is not None and key not in self.touched and type in (self.KEY_DOWN, self.KEY_UP):
+            self.touched.add( key )
+            if type==self.KEY_UP:
+                self.first_ups[key]= time   #a release of a key pressed before this chunk, maybe
         if type==self.KEY_DOWN:
-            flight_time= time - self.pt
-            if flight_time<self.timing_threshold:
-                self.flight_times_before[key].append(flight_time)
-                self.flight_times_after[self.pk].append(flight_time)
+            if self.pt is None:
+                self.first_press= (key, time)   #flight time from a unknown press
+            else:
+                flight_time= time - self.pt
+                if flight_time<self.timing_threshold:
+                    self._add_flight_time( key, self.pk, flight_time )
             self.press_time[key]=time
             self.pt=time
             self.pk=key
@@ -55,11 +181,102 @@ class FeatureExtractor(KeypressEventReceiver):
                 #can happen because we initiated capture with a key pressed down
                 return
             if dwell_time<self.timing_threshold:
-                self.dwell_times[key].append(dwell_time)
+                self._add_dwell_time( key, dwell_time )
+
+    def _add_flight_time( self, key, previous_key, flight_time ):
+        self.flight_times_before[key].append(flight_time)
+        self.flight_times_after[previous_key].append(flight_time)
+        if self.digraphs is not None:
+            self.digraphs.add( previous_key, key, flight_time )
+
+    def _add_dwell_time( self, key, dwell_time ):
+        self.dwell_times[key].append(dwell_time)
+
+    @instrumented('features.on_events')
+    def on_events(self, events):
+        '''Batch equivalent of calling on_key for every event, in order.
+        events is a array of KeystrokeCaptureData.EVENT_DTYPE (see KeystrokeCaptureData.events)'''
+        events= np.asarray( events )
+        keys=  events['key'].astype( np.int64 )
+        times= events['time'].astype( np.int64 )
+        down= events['event_type']==self.KEY_DOWN
+        up=   events['event_type']==self.KEY_UP
+        if self.touched is not None:
+            self._touch( keys[down|up], up[down|up], times[down|up] )
+
+        #flight times: between consecutive presses
+        dk, dt= keys[down], times[down]
+        if len(dt):
+            unknown= self.pt is None
+            if unknown:
+                self.first_press= (int(dk[0]), int(dt[0]))
+            previous_t= np.concatenate( ([dt[0] if unknown else self.pt], dt[:-1]) )
+            previous_k= np.concatenate( ([dk[0] if unknown else self.pk], dk[:-1]) )
+            flight= dt - previous_t
+            ok= flight<self.timing_threshold
+            ok[0]&= not unknown
+            self._extend( self.flight_times_before, dk[ok], flight[ok] )
+            self._extend( self.flight_times_after, previous_k[ok], flight[ok] )
+            if self.digraphs is not None:
+                #eviction depends on the order of the digraphs
+                for previous_key, key, flight_time in zip( previous_k[ok].tolist(), dk[ok].tolist(), flight[ok].tolist() ):
+                    self.digraphs.add( previous_key, key, flight_time )
+            self.pt, self.pk= int(dt[-1]), int(dk[-1])
+
+        #dwell times: group events by key, keeping their order. Keys still depressed
+        #from previous calls come first in their group, as presses
+        pending= self.press_time.items()
+        relevant= down | up
+        ek= np.concatenate( (np.array([k for k,_ in pending], dtype=np.int64), keys[relevant]) )
+        et= np.concatenate( (np.array([t for _,t in pending], dtype=np.int64), times[relevant]) )
+        eu= np.concatenate( (np.zeros(len(pending), dtype=bool), up[relevant]) )
+        if len(ek)==0:
+            return
+        order= np.argsort( ek, kind='mergesort' )
+        ek, et, eu= ek[order], et[order], eu[order]
+        i= np.arange( len(ek) )
+        starts= np.concatenate( ([True], ek[1:]!=ek[:-1]) )
+        ends=   np.concatenate( (starts[1:], [True]) )
+        group_start= np.maximum.accumulate( np.where(starts, i, 0) )
+        last_down=   np.maximum.accumulate( np.where(~eu, i, -1) )
+        last_up=     np.maximum.accumulate( np.where(eu, i, -1) )
+        previous_up= np.concatenate( ([-1], last_up[:-1]) )
+        #a release matches the last press of its key, unless another release already did
+        matched= eu & (last_down>=group_start) & (last_down>previous_up)
+        dwell= et[matched] - et[last_down[matched]]
+        ok= dwell<self.timing_threshold
+        self._extend( self.dwell_times, ek[matched][ok], dwell[ok] )
+        still_pressed= ends & (last_down>=group_start) & (last_down>last_up)
+        self.press_time= dict(zip( ek[still_pressed].tolist(), et[last_down[still_pressed]].tolist() ))
+
+    def _touch( self, keys, up, times ):
+        '''the on_key bookkeeping of touched and first_ups, for arrays of events'''
+        unique, first= np.unique( keys, return_index=True )
+        for key, i in zip( unique.tolist(), first.tolist() ):
+            if key not in self.touched:
+                self.touched.add( key )
+                if up[i]:
+                    self.first_ups[key]= int(times[i])
+
+    @staticmethod
+    def _extend( lists, keys, values ):
+        '''appends every value to lists[key], keeping their order'''
+        if len(keys)==0:
+            return
+        order= np.argsort( keys, kind='mergesort' )
+        keys, values= keys[order], values[order]
+        bounds= np.flatnonzero( keys[1:]!=keys[:-1] ) + 1
+        for k, v in zip( keys[np.concatenate(([0], bounds))].tolist(), np.split(values, bounds) ):
+            lists[k].extend( v.tolist() )
     
+    @instrumented('features.extract_features')
     def extract_features( self ):
         '''Extracts the features from the processed data.
-        Returns a CompositeFeature, composed of multiple other CompositeFeatures.'''
-        dwell_times= [KeyDwellTimes(k, v) for k,v in self.dwell_times.items()]
+        Returns a CompositeFeature of the KeyDwellTimes (or of their SampleSketch, if sketching) and,
+        if extracting digraphs, a "digraphs" CompositeFeature of DigraphFlightTimes.'''
+        feature= SampleSketch if self.sketch_compression else KeyDwellTimes
+        dwell_times= [feature(k, v) for k,v in self.dwell_times.items()]
+        if self.digraphs is not None:
+            dwell_times.append( self.digraphs.extract_features() )
 
         return CompositeFeature( "dwell_times", dwell_times ) 
@@ -0,0 +1,194 @@
+from ksdyn.features import CompositeFeature
+from ksdyn.matrix import FingerprintMatrix, MatrixFingerprintDatabase
+from ksdyn.model import synchronized
+
+import numpy as np
+
+class CoarseQuantizerIndex(object):
+    '''An approximate index over the per-key means of a FingerprintMatrix.
+    Users are clustered (k-means) into nlist inverted lists; a query only
+    looks at the users in the nprobe lists closest to it.
+    Higher nprobe means better recall and higher latency; nprobe==nlist is an exhaustive search.
+
+    Means are standardized by the typical stddev of each key, so distances
+    are roughly comparable to the GaussianDistribution similarity.
+    Missing keys are imputed with the key's population mean.'''
+    def __init__(self, matrix, nlist=None, nprobe=4, niter=10, seed=0):
+        assert isinstance( matrix, FingerprintMatrix )
+        self.matrix= matrix
+        self.nlist= nlist
+        self.nprobe= nprobe
+        self.niter= niter
+        self.seed= seed
+        self.train()
+
+    def train( self ):
+        '''(re)builds the centroids and inverted lists from all the users currently in the matrix'''
+        m= self.matrix
+        n= len(m)
+        self.ncols= len(m.keys)
+        mask= m.mask
+        counts= np.maximum( mask.sum(axis=0), 1 )
+        self.center= np.where( mask, m.means, 0.0 ).sum(axis=0) / counts
+        stddevs= np.where( mask, m.stddevs, np.nan )
+        self.scale= np.ones( self.ncols )
+        if n:
+            scale= np.nanmedian( stddevs, axis=0 )
+            self.scale= np.where( np.isfinite(scale) & (scale>0), scale, 1.0 )
+        vectors= self._vectors( m.means, mask )
+        nlist= self.nlist or int(np.ceil(np.sqrt(n)))
+        nlist= min( nlist, n )
+        self.trained= n     #number of users the centroids were trained on
+        self.centroids= self._kmeans( vectors, nlist )
+        self.lists= [[] for _ in range(nlist)]
+        self.unassigned= []     #users added before there were any centroids
+        for row, c in enumerate( self._nearest(vectors, 1)[:,0] if n else () ):
+            self.lists[c].append( row )
+
+    def _vectors( self, means, mask ):
+        '''standardized vectors, restricted to the columns known at training time'''
+        means, mask= means[:, :self.ncols], mask[:, :self.ncols]
+        return np.where( mask, (means - self.center) / self.scale, 0.0 )
+
+    def _kmeans( self, vectors, k ):
+        if k==0:
+            return np.zeros( (0, vectors.shape[1]) )
+        rng= np.random.RandomState( self.seed )
+        centroids= vectors[ rng.choice(len(vectors), k, replace=False) ].copy()
+        for _ in range(self.niter):
+            assignment= self._distances( vectors, centroids ).argmin( axis=1 )
+            for c in range(k):
+                members= vectors[assignment==c]
+                if len(members):
+                    centroids[c]= members.mean( axis=0 )
+        return centroids
+
+    @staticmethod
+    def _distances( vectors, centroids ):
+        '''squared euclidean distance between every vector and every centroid'''
+        return (vectors**2).sum(axis=1)[:,None] - 2*vectors.dot(centroids.T) + (centroids**2).sum(axis=1)[None,:]
+
+    def _nearest( self, vectors, n ):
+        '''indexes of the n closest centroids to each vector'''
+        d= self._distances( vectors, self.centroids )
+        if n>=d.shape[1]:
+            return np.tile( np.arange(d.shape[1]), (len(d),1) )
+        return np.argpartition( d, n-1, axis=1 )[:, :n]
+
+    def add( self, row ):
+        '''Adds a matrix row (a newly enrolled user) to the index, without retraining.
+        Keys unknown at training time are not used for routing'''
+        if len(self.centroids)==0:
+            self.unassigned.append( row )
+            return
+        m= self.matrix
+        vector= self._vectors( m.means[row:row+1], m.mask[row:row+1] )
+        self.lists[ self._nearest(vector, 1)[0,0] ].append( row )
+
+    def replace( self, row ):
+        '''Re-routes a matrix row whose user was replaced (see FingerprintMatrix.replace)'''
+        for rows in self.lists + [self.unassigned]:
+            if row in rows:
+                rows.remove( row )
+        self.add( row )
+
+    def remove( self, rows ):
+        '''Removes matrix rows, renumbering the others as FingerprintMatrix.remove does'''
+        removed= np.unique( np.asarray(list(rows), dtype=int) )
+        if not len(removed):
+            return
+        def renumbered( rows ):
+            rows= np.asarray( rows, dtype=int )
+            rows= rows[ ~np.in1d(rows, removed) ]
+            return (rows - np.searchsorted(removed, rows)).tolist()
+        self.lists= [renumbered(rows) for rows in self.lists]
+        self.unassigned= renumbered( self.unassigned )
+
+    def candidates( self, fingerprint, nprobe=None ):
+        '''Returns the matrix rows of the users that are likely to best match fingerprint'''
+        nprobe= nprobe or self.nprobe
+        if len(self.centroids)==0:
+            return np.array( self.unassigned, dtype=int )
+        cols, means= self._probe_means( fingerprint )
+        known= cols < self.ncols
+        vector= np.zeros( (1, self.ncols) )
+        vector[0, cols[known]]= (means[known] - self.center[cols[known]]) / self.scale[cols[known]]
+        rows= [r for c in self._nearest(vector, nprobe)[0] for r in self.lists[c]]
+        return np.array( sorted(rows + self.unassigned), dtype=int )
+
+    def _probe_means( self, fingerprint ):
+        '''(columns, means) of the probe keys known to the matrix. The means of raw probe
+        features (a CompositeFeature) are those of their samples'''
+        if not isinstance( fingerprint, CompositeFeature ):
+            return self.matrix.probe_vectors( fingerprint )[:2]
+        cols, samples, starts= self.matrix.feature_vectors( fingerprint )
+        if not len(cols):
+            return cols, samples
+        return cols, np.add.reduceat( samples, starts ) / np.diff( np.append(starts, len(samples)) )
+
+
+class IndexedFingerprintDatabase(MatrixFingerprintDatabase):
+    '''A MatrixFingerprintDatabase that only scores the candidates returned by a CoarseQuantizerIndex.
+    Candidates are scored exactly, so results only differ from a full scan
+    when the best user is not among the candidates (see nprobe)'''
+    def __init__(self, fingerprints=(), comparer=None, nlist=None, nprobe=4):
+        MatrixFingerprintDatabase.__init__( self, fingerprints, comparer )
+        self.nlist, self.nprobe= nlist, nprobe
+        self._index= None
+
+    @property
+    def index(self):
+        '''the CoarseQuantizerIndex of the matrix, (re)built when the matrix is'''
+        matrix= self.matrix
+        if self._index is None or self._index.matrix is not matrix:
+            self._index= CoarseQuantizerIndex( matrix, self.nlist, self.nprobe )
+        return self._index
+
+    @synchronized
+    def best_match_k( self, data, k=1, nprobe=None ):
+        '''Returns the (at most) k fingerprints that best match data, best first'''
+        rows= self.index.candidates( data, nprobe )
+        if len(rows)==0:
+            rows= np.arange( len(self.matrix) )
+        scores= self.matrix.score( data, rows )
+        order= np.argsort( -scores, kind='mergesort' )[:k]
+        return [self.fingerprints[i] for i in rows[order]]
+
+    @synchronized
+    def best_match( self, data ):
+        if len(self.fingerprints)==0:
+            raise Exception("No fingerprints available for matching")
+        return self.best_match_k( data, 1 )[0]
+
+    @synchronized
+    def enroll( self, fingerprint ):
+        '''Adds a new fingerprint, inserting it in the existing index (see enroll_many)'''
+        self.enroll_many( [fingerprint] )
+
+    @synchronized
+    def enroll_many( self, fingerprints ):
+        '''Adds new fingerprints, inserting them in the existing index. The index is retrained
+        instead once the users have more than doubled since it was trained, so that
+        enrolling into a empty (or small) database doesn't leave them all unassigned'''
+        index= self.index
+        start= len(self.fingerprints)
+        for fingerprint in fingerprints:
+            MatrixFingerprintDatabase.enroll( self, fingerprint )
+        if len(self.fingerprints) > 2*index.trained:
+            index.train()
+        else:
+            for row in xrange( start, len(self.fingerprints) ):
+                index.add( row )
+
+    @synchronized
+    def replace( self, i, fingerprint ):
+        '''Replaces the i-th fingerprint, re-routing it in the existing index'''
+        index= self.index
+        MatrixFingerprintDatabase.replace( self, i, fingerprint )
+        index.replace( i )
+
+    @synchronized
+    def remove( self, indexes ):
+        index= self.index
+        MatrixFingerprintDatabase.remove( self, indexes )
+        index.remove( indexes )
@@ -0,0 +1,147 @@
+'''Opt-in instrumentation: timers, counters and histograms of the hot paths.
+
+Methods marked with @instrumented(name) are only wrapped (timed) between enable() and disable(),
+so they have no overhead at all while instrumentation is disabled.
+enable() patches the classes of every ksdyn module imported at that time.
+timer(name) times a block of code, and count/observe record counters and histograms;
+they cost a function call while disabled.
+snapshot() returns everything recorded so far.'''
+import sys
+import math
+import functools
+from timeit import default_timer as clock
+from contextlib import contextmanager
+
+_enabled= False
+_counters= {}
+_histograms= {}
+_patched= []    #(owner, attribute name, original value)
+
+class Histogram(object):
+    '''Count, sum, min, max and power-of-2 buckets of observed values. Fixed memory'''
+    def __init__(self):
+        self.count= 0
+        self.total= 0.0
+        self.min= float('inf')
+        self.max= float('-inf')
+        self.buckets= {}    #exponent -> count of values in [2**(exponent-1), 2**exponent)
+
+    def add( self, value ):
+        self.count+= 1
+        self.total+= value
+        self.min= min( self.min, value )
+        self.max= max( self.max, value )
+        exponent= math.frexp( value )[1] if value>0 else None
+        self.buckets[exponent]= self.buckets.get( exponent, 0 ) + 1
+
+    def quantile( self, q ):
+        '''upper bound of the bucket holding the q-quantile'''
+        seen= 0
+        for exponent in sorted( self.buckets, key=lambda e: float('-inf') if e is None else e ):
+            seen+= self.buckets[exponent]
+            if seen >= q*self.count:
+                return 0.0 if exponent is None else min( 2.0**exponent, self.max )
+        return self.max
+
+    def snapshot( self ):
+        return {
+            'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+            'mean': self.total/self.count if self.count else float('nan'),
+            'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+            }
+
+def is_enabled():
+    return _enabled
+
+def count( name, n=1 ):
+    if _enabled:
+        _counters[name]= _counters.get( name, 0 ) + n
+
+def observe( name, value ):
+    if _enabled:
+        histogram= _histograms.get( name )
+        if histogram is None:
+            histogram= _histograms[name]= Histogram()
+        histogram.add( value )
+
+@contextmanager
+def _timer( name ):
+    t= clock()
+    try:
+        yield
+    finally:
+        observe( name, clock()-t )
+
+@contextmanager
+def _null_timer():
+    yield
+
+def timer( name ):
+    '''context manager that records the time spent in its block in the histogram name'''
+    return _timer( name ) if _enabled else _null_timer()
+
+def instrumented( name ):
+    '''Marks a function (or method) to be timed into the histogram name while instrumentation is enabled.
+    Must be applied below @classmethod/@staticmethod. Returns the function itself'''
+    def decorator( f ):
+        f.__instrumented__= name
+        return f
+    return decorator
+
+def _timed( f, name ):
+    @functools.wraps( f )
+    def wrapper( *args, **kwargs ):
+        t= clock()
+        try:
+            return f( *args, **kwargs )
+        finally:
+            observe( name, clock()-t )
+    return wrapper
+
+def _wrap( value ):
+    '''the timed version of a class attribute, or None if it's not instrumented'''
+    if isinstance( value, (classmethod, staticmethod) ):
+        name= getattr( value.__func__, '__instrumented__', None )
+        return name and type(value)( _timed(value.__func__, name) )
+    name= getattr( value, '__instrumented__', None )
+    return name and _timed( value, name )
+
+def enable():
+    '''Starts recording, patching the instrumented methods of the currently imported ksdyn modules
+    (core, features and model are always imported)'''
+    global _enabled
+    if _enabled:
+        return
+    import ksdyn.core, ksdyn.features, ksdyn.model
+    for module_name, module in sys.modules.items():
+        if module is None or not module_name.startswith('ksdyn.'):
+            continue
+        for cls in vars(module).values():
+            if not isinstance( cls, type ) or cls.__module__!=module_name:
+                continue
+            for attribute, value in vars(cls).items():
+                wrapped= _wrap( value )
+                if wrapped:
+                    _patched.append( (cls, attribute, value) )
+                    setattr( cls, attribute, wrapped )
+    _enabled= True
+
+def disable():
+    '''Stops recording, restoring the original methods. Recorded values are kept'''
+    global _enabled
+    while _patched:
+        cls, attribute, value= _patched.pop()
+        setattr( cls, attribute, value )
+    _enabled= False
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
+
+def snapshot():
+    '''Returns {'counters': {name: count}, 'histograms': {name: {count, sum, min, max, mean, p50, p99}}}.
+    Times are in seconds'''
+    return {
+        'counters': dict(_counters),
+        'histograms': dict( (name, h.snapshot()) for name,h in _histograms.items() ),
+        }
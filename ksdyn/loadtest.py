@@ -0,0 +1,101 @@
+'''Load test of the scoring service, on a synthetic population.
+usage: python -m ksdyn.loadtest [--users N] [--sessions N] [--keypresses N] [--chunk N]
+Starts a service on a temporary Unix socket (or uses --socket, of a running service enrolled with
+the same population), streams the keystrokes of concurrent sessions to it, and identifies each one
+after every chunk. Prints latency percentiles, throughput and accuracy, as JSON'''
+from ksdyn.benchmark import extract_features
+from ksdyn.model import Fingerprint
+from ksdyn.matrix import MatrixFingerprintDatabase
+from ksdyn.service import ScoringService, ScoringClient, ServiceBusy, make_server
+from ksdyn.synthetic import SyntheticPopulation
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+
+def _enroll( population, nkeypresses ):
+    return [Fingerprint.from_features( str(i), extract_features(t, nkeypresses) ) for i,t in enumerate(population)]
+
+def _session( address, population, session, nkeypresses, chunk, results ):
+    '''streams the keystrokes of a user as session, identifying it after every chunk'''
+    user= session % len(population)
+    events= population[user].events( nkeypresses, seed=session+1 )
+    latencies, busy, correct, identified= [], 0, 0, 0
+    with ScoringClient( address ) as client:
+        name= "session{}".format( session )
+        client.open_session( name )
+        for i in xrange( 0, len(events), chunk ):
+            client.send_events( name, events[i:i+chunk] )
+            t= timer()
+            try:
+                matches= client.identify( name )
+            except ServiceBusy:
+                busy+= 1
+                continue
+            latencies.append( timer()-t )
+            identified+= 1
+            correct+= matches[0][0]==str(user)
+        client.close_session( name )
+    results.append( (latencies, busy, identified, correct) )
+
+def run( address, population, nsessions=64, nkeypresses=2000, chunk=200 ):
+    '''Runs nsessions concurrent sessions against the service at address. Returns a dict of results'''
+    results= []
+    threads= [threading.Thread( target=_session, args=(address, population, i, nkeypresses, chunk, results) ) for i in range(nsessions)]
+    start= timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed= timer()-start
+    latencies= np.concatenate( [r[0] for r in results] ) if results else np.zeros(0)
+    identified= sum( r[2] for r in results )
+    return {
+        'sessions': len(results), 'elapsed': elapsed,
+        'identify_requests': identified, 'identify_per_second': identified/elapsed,
+        'busy': sum( r[1] for r in results ),
+        'latency_p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'latency_p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'accuracy': sum( r[3] for r in results ) / float(max(1, identified)),
+        }
+
+def main( argv=None ):
+    import argparse
+    parser= argparse.ArgumentParser( description="Load test of the scoring service" )
+    parser.add_argument( '--users', type=int, default=1000 )
+    parser.add_argument( '--sessions', type=int, default=64, help='concurrent sessions' )
+    parser.add_argument( '--keypresses', type=int, default=2000, help='key presses per session' )
+    parser.add_argument( '--chunk', type=int, default=200, help='events sent between identify requests' )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '--socket', help='Unix socket of a running service (defaults to starting one)' )
+    args= parser.parse_args( argv )
+
+    population= SyntheticPopulation( args.users, args.seed )
+    if args.socket:
+        results= run( args.socket, population, args.sessions, args.keypresses, args.chunk )
+    else:
+        directory= tempfile.mkdtemp()
+        service= ScoringService( MatrixFingerprintDatabase( _enroll(population, 5000) ) ).start()
+        server= make_server( service, os.path.join(directory, 'socket') )
+        thread= threading.Thread( target=server.serve_forever )
+        thread.daemon= True
+        thread.start()
+        try:
+            results= run( server.server_address, population, args.sessions, args.keypresses, args.chunk )
+            results['service']= service.op_stats( {} )
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.stop()
+            shutil.rmtree( directory )
+    print json.dumps( results, indent=2, sort_keys=True )
+    return 0
+
+if __name__=='__main__':
+    sys.exit( main() )
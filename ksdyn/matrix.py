@@ -0,0 +1,396 @@
+from ksdyn.core import normal_similarity, log_normal_similarity, GaussianDistribution
+from ksdyn import instrumentation
+from ksdyn.instrumentation import instrumented
+from ksdyn.features import CompositeFeature
+from ksdyn.model import Fingerprint, FingerprintComparer, FingerprintDatabase, synchronized
+
+import numpy as np
+
+class FingerprintMatrix(object):
+    '''Packs many Fingerprints into dense (users x keys) matrices, so that
+    a probe can be scored against all of them with a few array operations.
+    Keys are the leaf paths of the fingerprints (see DictTree.leaves)'''
+    MULTIPLICATION, MEAN= 'multiplication', 'mean'
+    REDUCERS= {
+        FingerprintComparer._multiplication_reducer: MULTIPLICATION,
+        FingerprintComparer._mean_reducer: MEAN,
+        }
+
+    def __init__(self, fingerprints=(), reducer=None):
+        '''reducer is one of the FingerprintComparer reducers, and defaults to multiplication'''
+        reducer= reducer or FingerprintComparer._multiplication_reducer
+        if reducer not in self.REDUCERS:
+            raise NotImplementedError("No vectorized version of reducer {}".format(reducer))
+        self.reducer= self.REDUCERS[reducer]
+        self.fingerprints= []
+        self.keys= []       #column -> key path
+        self.key_index= {}  #key path -> column
+        self._means=   np.zeros( (0,0) )
+        self._stddevs= np.ones(  (0,0) )
+        self._mask=    np.zeros( (0,0), dtype=bool )
+        self._discrimination= None
+        for f in fingerprints:
+            self.append( f )
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    @property
+    def means(self):
+        return self._means[:len(self), :len(self.keys)]
+
+    @property
+    def stddevs(self):
+        return self._stddevs[:len(self), :len(self.keys)]
+
+    @property
+    def mask(self):
+        return self._mask[:len(self), :len(self.keys)]
+
+    def _grow( self, rows, cols ):
+        '''makes sure the backing arrays can hold at least rows x cols.
+        Grows geometrically (only the dimension that overflowed), so appending is amortized O(keys)'''
+        old_rows, old_cols= self._means.shape
+        if rows<=old_rows and cols<=old_cols:
+            return
+        new_shape= (max(rows, 2*old_rows) if rows>old_rows else old_rows,
+                     max(cols, old_cols + old_cols//2) if cols>old_cols else old_cols)
+        def grown( a, fill ):
+            b= np.full( new_shape, fill, dtype=a.dtype )
+            b[:old_rows, :old_cols]= a
+            return b
+        self._means=   grown( self._means,   0.0 )
+        self._stddevs= grown( self._stddevs, 1.0 )
+        self._mask=    grown( self._mask,    False )
+
+    def _column( self, path ):
+        try:
+            return self.key_index[path]
+        except KeyError:
+            self.key_index[path]= len(self.keys)
+            self.keys.append( path )
+            return self.key_index[path]
+
+    def _set_row( self, i, fingerprint ):
+        leaves= list(fingerprint.leaves())
+        cols= [self._column(path) for path,_ in leaves]
+        self._grow( len(self.fingerprints), len(self.keys) )
+        self._means[i]= 0.0
+        self._stddevs[i]= 1.0
+        self._mask[i]= False
+        self._means[i, cols]=   [m.mean   for _,m in leaves]
+        self._stddevs[i, cols]= [m.stddev for _,m in leaves]
+        self._mask[i, cols]= True
+        self._discrimination= None
+
+    def append( self, fingerprint ):
+        '''Adds a fingerprint as the last row'''
+        assert isinstance( fingerprint, Fingerprint )
+        self.fingerprints.append( fingerprint )
+        self._set_row( len(self.fingerprints)-1, fingerprint )
+
+    def replace( self, row, fingerprint ):
+        '''Replaces the fingerprint of a row, rewriting only that row'''
+        assert isinstance( fingerprint, Fingerprint )
+        self.fingerprints[row]= fingerprint
+        self._set_row( row, fingerprint )
+
+    def remove( self, rows ):
+        '''Removes rows, moving the following ones up. Columns are kept, even if no user has them anymore'''
+        removed= np.zeros( len(self), dtype=bool )
+        removed[ list(rows) ]= True
+        if not removed.any():
+            return
+        keep= np.flatnonzero( ~removed )
+        for a in (self._means, self._stddevs, self._mask):
+            a[:len(keep)]= a[keep]
+        self.fingerprints= [self.fingerprints[i] for i in keep]
+        self._discrimination= None
+
+    def probe_vectors( self, fingerprint ):
+        '''Returns (columns, means, stddevs) for the keys of fingerprint
+        that appear in this matrix. Keys unknown to the matrix can't be
+        common to any user, so they are dropped'''
+        known= [(self.key_index[path], m) for path,m in fingerprint.leaves() if path in self.key_index]
+        cols=    np.array( [c        for c,_ in known], dtype=int )
+        means=   np.array( [m.mean   for _,m in known], dtype=float )
+        stddevs= np.array( [m.stddev for _,m in known], dtype=float )
+        return cols, means, stddevs
+
+    def key_similarities( self, fingerprint, rows=None, log=False ):
+        '''Returns (similarities, common) for the probe keys against every user
+        (or only against the given rows), both with shape (users x probe keys).
+        Same formula as GaussianDistribution.similarity. If log, returns the log of the similarities'''
+        return self._key_similarities( self.probe_vectors(fingerprint), rows, log )
+
+    def _key_similarities( self, probe, rows=None, log=False ):
+        '''key_similarities, given the probe_vectors of the probe'''
+        cols, means, stddevs= probe
+        if rows is None:
+            rows= slice(0, len(self))
+        if isinstance( rows, slice ):
+            m, s, common= self._means[rows][:, cols], self._stddevs[rows][:, cols], self._mask[rows][:, cols]
+        else:
+            cells= np.ix_( rows, cols )     #without copying whole rows
+            m, s, common= self._means[cells], self._stddevs[cells], self._mask[cells]
+        f= log_normal_similarity if log else normal_similarity
+        similarities= f( m - means, (s + stddevs) / 2.0 )
+        return similarities, common
+
+    def feature_vectors( self, features ):
+        '''Returns (columns, samples, starts) for the FloatSeq leaves of features (a CompositeFeature)
+        that have samples and appear in this matrix: the samples of all of them concatenated,
+        those of columns[i] starting at starts[i]'''
+        known= [(self.key_index[path], f.data) for path,f in features.leaves() if path in self.key_index and len(f.data)]
+        cols=    np.array( [c for c,_ in known], dtype=int )
+        lengths= np.array( [len(d) for _,d in known], dtype=int )
+        samples= np.concatenate( [np.asarray(d, dtype=float) for _,d in known] ) if known else np.zeros( 0 )
+        starts=  np.cumsum( lengths ) - lengths
+        return cols, samples, starts
+
+    def feature_similarities( self, features, rows=None, max_block=1<<22 ):
+        '''Returns (similarities, common) for the keys of raw probe features (a CompositeFeature) against every user
+        (or only against the given rows), both with shape (users x probe keys).
+        Same formula as FingerprintComparer.samples_similarity. Users are processed in blocks
+        of at most max_block (users x samples) elements'''
+        cols, samples, starts= self.feature_vectors( features )
+        rows= np.arange( len(self) )[ slice(None) if rows is None else rows ]
+        lengths= np.diff( np.append(starts, len(samples)) )
+        sample_cols= np.repeat( cols, lengths )
+        similarities= np.ones( (len(rows), len(cols)) )
+        block= max( 1, max_block // max(1, len(samples)) )
+        for start in xrange( 0, len(rows) if len(cols) else 0, block ):
+            cells= np.ix_( rows[start:start+block], sample_cols )     #without copying whole rows
+            logs= GaussianDistribution.similarities( self._means[cells], self._stddevs[cells], samples, log=True )
+            similarities[start:start+block]= np.exp( np.add.reduceat( logs, starts, axis=1 ) / lengths )
+        return similarities, self._mask[ np.ix_(rows, cols) ]
+
+    @instrumented('matrix.score')
+    def score( self, fingerprint, rows=None ):
+        '''Scores a probe Fingerprint, or the raw features of a probe (a CompositeFeature),
+        against every user (or only against the given rows).
+        Returns a float array with one score per user, equal to what
+        FingerprintComparer.similarity returns with the same reducer.
+        Users with no keys in common with the probe score 0'''
+        if isinstance(fingerprint, CompositeFeature):
+            return self._reduce( *self.feature_similarities(fingerprint, rows) )
+        if not isinstance(fingerprint, Fingerprint):
+            raise NotImplementedError
+        return self._score( self.probe_vectors(fingerprint), rows )
+
+    def _score( self, probe, rows=None ):
+        '''score, given the probe_vectors of the probe'''
+        return self._reduce( *self._key_similarities( probe, rows ) )
+
+    def _reduce( self, similarities, common ):
+        '''the scores of (users x keys) similarities, of which only the common ones count'''
+        ncommon= common.sum( axis=1 )
+        if self.reducer==self.MULTIPLICATION:
+            scores= np.prod( np.where(common, similarities, 1.0), axis=1 )
+        else:
+            summed= np.sum( np.where(common, similarities, 0.0), axis=1 )
+            scores= summed / np.maximum( ncommon, 1 )
+        scores[ncommon==0]= 0.0
+        return scores
+
+    @instrumented('matrix.score_many')
+    def score_many( self, fingerprints, max_block=1<<22 ):
+        '''Scores many probe Fingerprints in a single pass over the matrix.
+        Returns a (probes x users) float array, equal (up to rounding) to calling score for each probe.
+        Users are processed in blocks of at most max_block (users x probes x keys) elements.
+        Probes of raw features are scored one at a time, in blocks of at most max_block (users x samples) elements'''
+        nkeys= len(self.keys)
+        pmeans=   np.zeros( (len(fingerprints), nkeys) )
+        pstddevs= np.ones(  (len(fingerprints), nkeys) )
+        pmask=    np.zeros( (len(fingerprints), nkeys), dtype=bool )
+        raw= []     #(index, features) of raw feature probes
+        for i, fingerprint in enumerate( fingerprints ):
+            if isinstance(fingerprint, CompositeFeature):
+                raw.append( (i, fingerprint) )
+                continue
+            if not isinstance(fingerprint, Fingerprint):
+                raise NotImplementedError
+            cols, means, stddevs= self.probe_vectors( fingerprint )
+            pmeans[i, cols]= means
+            pstddevs[i, cols]= stddevs
+            pmask[i, cols]= True
+        scores= np.zeros( (len(fingerprints), len(self)) )
+        block= max( 1, max_block // max(1, len(fingerprints)*nkeys) )
+        for start in xrange( 0, len(self), block ):
+            rows= slice( start, min(start+block, len(self)) )
+            scores[:, rows]= block_scores( pmeans, pstddevs, pmask,
+                self.means[rows], self.stddevs[rows], self.mask[rows], self.reducer )
+        for i, features in raw:
+            scores[i]= self._reduce( *self.feature_similarities(features, max_block=max_block) )
+        return scores
+
+    def discrimination( self ):
+        '''How well each key discriminates between users: the variance of the users' means
+        over the mean of their variances (a Fisher ratio). 0 for keys of less than 2 users'''
+        if self._discrimination is None:
+            mask= self.mask
+            n= mask.sum( axis=0 )
+            means= np.where( mask, self.means, 0.0 )
+            center= means.sum( axis=0 ) / np.maximum( n, 1 )
+            between= np.where( mask, (self.means - center)**2, 0.0 ).sum( axis=0 ) / np.maximum( n, 1 )
+            within= np.where( mask, self.stddevs**2, 0.0 ).sum( axis=0 ) / np.maximum( n, 1 )
+            self._discrimination= np.where( n>1, between / np.where(within>0, within, 1.0), 0.0 )
+        return self._discrimination
+
+    @instrumented('matrix.best_k')
+    def best_k( self, fingerprint, k=1, chunk=4, stats=None ):
+        '''The rows of the k users with the best multiplication scores, best first (ties in row order):
+        exactly the first k rows of a stable descending sort of score(fingerprint).
+        Branch and bound: similarities are at most 1, so a partial product over some keys bounds
+        the score. Keys are processed chunk at a time, most discriminating first, and users
+        whose bound falls below the k-th best score are abandoned. Only the remaining ones are scored.
+        stats, if given, is a dict updated with the number of users pruned and of key similarities
+        computed, and of both in a full scan'''
+        if self.reducer!=self.MULTIPLICATION:
+            raise NotImplementedError("Branch and bound needs the multiplication reducer")
+        if k<=0:
+            return []
+        probe= self.probe_vectors( fingerprint )
+        order= np.argsort( -self.discrimination()[probe[0]], kind='mergesort' )
+        cols, means, stddevs= [x[order] for x in probe]
+        n= len(self)
+        bounds= np.zeros( n )       #log of the partial products
+        alive= np.arange( n )
+        computed= 0
+        def advance( rows, start ):
+            c= slice( start, start+chunk )
+            cells= np.ix_( rows, cols[c] )
+            logs= log_normal_similarity( self._means[cells] - means[c], (self._stddevs[cells] + stddevs[c]) / 2.0 )
+            bounds[rows]+= np.sum( np.where(self._mask[cells], logs, 0.0), axis=1 )
+            return logs.size
+        best= []        #(score, row) of the users scored exactly
+        pruned= 0
+        for start in xrange( 0, max(1, len(cols)), chunk ):
+            computed+= advance( alive, start )
+            #the users with the best bounds are likely winners: score them exactly, raising the threshold
+            seeds= alive[ np.argsort( -bounds[alive], kind='mergesort' )[:k] ]
+            best.extend( zip(self._score(probe, seeds).tolist(), seeds.tolist()) )
+            computed+= len(seeds)*len(cols)
+            best.sort( key=lambda x: (-x[0], x[1]) )
+            best= best[:k]
+            alive= np.setdiff1d( alive, seeds )
+            threshold= best[-1][0] if len(best)==k else 0.0
+            if threshold>0:
+                log_threshold= np.log( threshold )
+                margin= 1e-9 * (1 + abs(log_threshold))    #bounds and scores are rounded differently
+                keep= bounds[alive] >= log_threshold - margin
+                pruned+= len(alive) - keep.sum()
+                alive= alive[keep]
+            if not len(alive):
+                break
+        if len(alive):
+            best.extend( zip(self._score(probe, alive).tolist(), alive.tolist()) )
+            computed+= len(alive)*len(cols)
+        best.sort( key=lambda x: (-x[0], x[1]) )
+        if stats is not None:
+            for name, value in (('pruned', pruned), ('similarities', computed), ('users', n), ('full_similarities', n*len(cols))):
+                stats[name]= stats.get( name, 0 ) + int(value)
+        instrumentation.count( 'matrix.best_k.pruned', int(pruned) )
+        instrumentation.count( 'matrix.best_k.similarities', int(computed) )
+        instrumentation.count( 'matrix.best_k.full_similarities', n*len(cols) )
+        return [row for _,row in best[:k]]
+
+    def log_score( self, fingerprint, rows=None ):
+        '''log of the multiplication reducer score, which doesn't underflow when
+        multiplying many similarities. Users with no keys in common score -inf'''
+        if not isinstance(fingerprint, Fingerprint):
+            raise NotImplementedError
+        similarities, common= self.key_similarities( fingerprint, rows, log=True )
+        scores= np.sum( np.where(common, similarities, 0.0), axis=1 )
+        scores[common.sum(axis=1)==0]= -np.inf
+        return scores
+
+
+def block_scores( means_a, stddevs_a, mask_a, means_b, stddevs_b, mask_b, reducer, log=False ):
+    '''Scores every row of a against every row of b, where rows are fingerprints over the same key columns
+    (as in FingerprintMatrix). reducer is FingerprintMatrix.MULTIPLICATION or MEAN.
+    Returns a (len(a) x len(b)) array. Pairs with no keys in common score 0.
+    If log, returns the log of the multiplication scores (-inf for no common keys)'''
+    common= mask_a[:, None, :] & mask_b[None]
+    differences= means_a[:, None, :] - means_b[None]
+    stddevs= (stddevs_a[:, None, :] + stddevs_b[None]) / 2.0
+    ncommon= common.sum( axis=2 )
+    if log:
+        if reducer!=FingerprintMatrix.MULTIPLICATION:
+            raise ValueError("Log scores are only defined for the multiplication reducer")
+        scores= np.sum( np.where(common, log_normal_similarity(differences, stddevs), 0.0), axis=2 )
+        scores[ncommon==0]= -np.inf
+        return scores
+    similarities= normal_similarity( differences, stddevs )
+    if reducer==FingerprintMatrix.MULTIPLICATION:
+        scores= np.prod( np.where(common, similarities, 1.0), axis=2 )
+    else:
+        scores= np.sum( np.where(common, similarities, 0.0), axis=2 ) / np.maximum( ncommon, 1 )
+    scores[ncommon==0]= 0.0
+    return scores
+
+class MatrixFingerprintDatabase(FingerprintDatabase):
+    '''A FingerprintDatabase that scores using a FingerprintMatrix instead of
+    calling the comparer once per fingerprint'''
+    def __init__(self, fingerprints=(), comparer=None):
+        FingerprintDatabase.__init__( self, list(fingerprints), comparer )
+        self._matrix= None
+        self._matrix_generation= None  #generation the matrix is up to date with
+
+    @property
+    def matrix(self):
+        '''the FingerprintMatrix of self.fingerprints, (re)built when they change (see generation).
+        Lazily loaded fingerprints (see load_from_store) are not compared, so they're only read once'''
+        if self._matrix is None or self._matrix_generation!=self.generation:
+            self._matrix= FingerprintMatrix( self.fingerprints, self.comparer._reducer )
+            self._matrix_generation= self.generation
+        return self._matrix
+
+    @synchronized
+    def score( self, data ):
+        return list(self.matrix.score( data ))
+
+    @synchronized
+    def score_many( self, datas ):
+        return self.matrix.score_many( datas ).tolist()
+
+    @synchronized
+    def best_match_k( self, data, k=1, stats=None ):
+        '''Returns the k fingerprints that best match data, best first.
+        With the multiplication reducer, uses FingerprintMatrix.best_k (same result, fewer similarities).
+        stats is passed to it'''
+        matrix= self.matrix
+        if matrix.reducer!=FingerprintMatrix.MULTIPLICATION or not len(matrix) or not isinstance( data, Fingerprint ):
+            return FingerprintDatabase.best_match_k( self, data, k )
+        return [self.fingerprints[i] for i in matrix.best_k( data, k, stats=stats )]
+
+    @synchronized
+    def best_match( self, data ):
+        if len(self.fingerprints)==0:
+            raise Exception("No fingerprints available for matching")
+        instrumentation.count('database.best_match')
+        return self.best_match_k( data, 1 )[0]
+
+    @synchronized
+    def enroll( self, fingerprint ):
+        '''Adds a new fingerprint, appending it to the matrix instead of rebuilding it'''
+        matrix= self.matrix
+        FingerprintDatabase.enroll( self, fingerprint )
+        matrix.append( fingerprint )
+        self._matrix_generation= self.generation
+
+    @synchronized
+    def replace( self, i, fingerprint ):
+        '''Replaces the i-th fingerprint, rewriting only its matrix row'''
+        matrix= self.matrix
+        FingerprintDatabase.replace( self, i, fingerprint )
+        matrix.replace( i, fingerprint )
+        self._matrix_generation= self.generation
+
+    @synchronized
+    def remove( self, indexes ):
+        '''Removes the fingerprints at indexes, compacting the matrix in place'''
+        matrix= self.matrix
+        FingerprintDatabase.remove( self, indexes )
+        matrix.remove( indexes )
+        self._matrix_generation= self.generation
@@ -1,8 +1,15 @@
 from ksdyn.core import VersionedSerializableClass, GaussianDistribution, KeystrokeCaptureData, Named, DictTree, InsufficientData
-from features import FeatureExtractor, CompositeFeature, FloatSeq
+from features import FeatureExtractor, CompositeFeature, FloatSeq, SampleSketch
+from ksdyn.sketch import QuantileSketch
+from ksdyn import instrumentation
+from ksdyn.instrumentation import instrumented
 
+import os
+import hashlib
+import threading
 import numpy as np
 from abc import ABCMeta, abstractmethod
+from functools import wraps
 
 class Model(Named):
     '''A model (in the machine learning sense).'''
@@ -38,12 +45,68 @@ class GaussianAnomalyModel( Model, GaussianDistribution ):
         '''data must be a iterable of numbers. '''
         if labels is not None:
             raise NotImplementedError( "Don't provide labels - all data should represent non-anomalies")
-        parameters= GaussianDistribution.estimate_parameters( data )
+        self._set_moments( GaussianDistribution.estimate_moments(data) )
+
+    def partial_fit( self, data ):
+        '''Updates the model with more samples, as if fit was called with every sample seen so far.
+        data must be a iterable of numbers'''
+        self._set_moments( GaussianDistribution.merge_moments(self.get_moments(), GaussianDistribution.estimate_moments(data)) )
+
+    def merge( self, other ):
+        '''Updates the model with the samples another model was fit to'''
+        self._set_moments( GaussianDistribution.merge_moments(self.get_moments(), other.get_moments()) )
+
+    def get_moments( self ):
+        '''Returns the (nsamples, mean, m2) of the samples this model was fit to'''
+        try:
+            return self.moments
+        except AttributeError:
+            nsamples= getattr( self, 'nsamples', None ) or 0
+            if nsamples==0:
+                return 0, 0.0, 0.0
+            #model pickled before moments were kept. Exact unless stddev was floored
+            return nsamples, self.mean, self.stddev**2 * nsamples
+
+    def _set_moments( self, moments ):
+        parameters= GaussianDistribution.parameters_from_moments( moments )
         GaussianDistribution.__init__( self, *parameters )
+        self.moments= moments
 
     def predict(self, data):
         '''data must be a iterable of numbers'''
-        return map(self.similarity_number, data )
+        return list( self.predict_array(data) )
+
+    def predict_array(self, data, log=False):
+        '''data must be a array of numbers. Returns a array of similarities (or their logs, if log)'''
+        return self.similarity_numbers( np.asarray(data, dtype=float), log )
+
+class RobustAnomalyModel( GaussianAnomalyModel ):
+    '''A anomaly detection model of the median and interquartile range of the samples, which long pauses
+    and other outliers barely move. They are estimated by a QuantileSketch, so the model can be updated
+    and merged with bounded memory. mean and stddev are the median and the stddev of the normal distribution
+    with the same interquartile range, so it's scored like (and can be mixed with) GaussianAnomalyModels'''
+    IQR_STDDEVS= 1.349  #interquartile range of the standard normal distribution
+    COMPRESSION= 100
+
+    def fit( self, data, labels=None ):
+        '''data must be a iterable of numbers, or a QuantileSketch'''
+        if labels is not None:
+            raise NotImplementedError( "Don't provide labels - all data should represent non-anomalies")
+        self.sketch= QuantileSketch( self.COMPRESSION )
+        self.partial_fit( data )
+
+    def partial_fit( self, data ):
+        '''Updates the model with more samples: a iterable of numbers, or a QuantileSketch'''
+        self.sketch.extend( data )
+        if self.sketch.count<2:
+            raise InsufficientData()
+        q1, median, q3= self.sketch.quantiles( (0.25, 0.5, 0.75) )
+        stddev= max( median*0.01, (q3-q1) / self.IQR_STDDEVS ) #avoid stddev==0
+        GaussianDistribution.__init__( self, median, stddev, self.sketch.count )
+
+    def merge( self, other ):
+        '''Updates the model with the samples another RobustAnomalyModel was fit to'''
+        self.partial_fit( other.sketch )
 
 class KeyDwellTime( GaussianAnomalyModel ):
     '''A model representing (the probability distribution of)
@@ -56,11 +119,19 @@ class Fingerprint(CompositeModel, VersionedSerializableClass):
     thus being able to uniquely identify them'''
     FILE_EXTENSION=".fingerprint"
     CLASS_VERSION= 1
+    max_digraphs= 0     #if set, update keeps (at most) this many digraphs, those with the most samples
     def __init__(self, name):
         '''Name argument is the typist's name'''
         VersionedSerializableClass.__init__(self)
         CompositeModel.__init__(self, name)
+        self.pending_moments= {}    #key path -> moments of features with too few samples for a model
 
+    def content_hash( self ):
+        '''A hash (hex string) of the name and models (their paths, class and parameters), independent of dict order'''
+        models= sorted( (path, m.__class__.__name__, float(m.mean), float(m.stddev), m.nsamples) for path,m in self.leaves() )
+        return hashlib.sha1( repr( (self.name, models) ) ).hexdigest()
+
+    @instrumented('model.fit')
     def fit( self, data, labels=None ):
         def feature_map(*features):
             assert len(features)==1
@@ -68,6 +139,8 @@ class Fingerprint(CompositeModel, VersionedSerializableClass):
             try:
                 if isinstance( f, FloatSeq ):
                     return GaussianAnomalyModel.from_features( f.name, f.data )
+                elif isinstance( f, SampleSketch ):
+                    return RobustAnomalyModel.from_features( f.name, f.sketch )
                 else:
                     raise Exception("Unknown feature: {}".format(f))
             except InsufficientData:
@@ -75,7 +148,105 @@ class Fingerprint(CompositeModel, VersionedSerializableClass):
         assert isinstance( data, CompositeFeature)
         newmodel= DictTree.map( feature_map, data)
         self.clear()
-        self.update( newmodel )
+        dict.update( self, newmodel )
+        modelled= set( path for path,_ in self.leaves() )
+        self.pending_moments= {}
+        self.pending_sketches= {}   #key path -> sketch of features with too few samples for a model
+        pending= [(path, f) for path,f in data.leaves() if path not in modelled]
+        self._add_pending( (path, f.data) for path,f in pending if isinstance(f, FloatSeq) )
+        self._add_pending_sketches( (path, f.sketch) for path,f in pending if isinstance(f, SampleSketch) )
+
+    def _add_pending( self, samples ):
+        '''keeps the moments of (path, samples) too small to fit a model, so that update can use them'''
+        for path, data in samples:
+            moments= GaussianDistribution.estimate_moments( data )
+            old= self.pending_moments.get( path, (0, 0.0, 0.0) )
+            self.pending_moments[path]= GaussianDistribution.merge_moments( old, moments )
+
+    def _add_pending_sketches( self, sketches ):
+        '''keeps (a copy of) the (path, sketch) too small to fit a model, so that update can use them'''
+        for path, sketch in sketches:
+            self.pending_sketches.setdefault( path, QuantileSketch(RobustAnomalyModel.COMPRESSION) ).merge( sketch )
+
+    @instrumented('model.update')
+    def update( self, data, max_digraphs=None ):
+        '''Updates the models with new features, as if fit was called with every feature seen so far.
+        Only needs the new features: the moments (or sketches) of features with too few samples are kept
+        in pending_moments (or pending_sketches).
+        max_digraphs, if given, replaces the max_digraphs of this fingerprint (see _limit_digraphs)'''
+        assert isinstance( data, CompositeFeature)
+        if not hasattr( self, 'pending_moments' ):
+            self.pending_moments= {}  #fingerprint pickled before pending moments were kept
+        if not hasattr( self, 'pending_sketches' ):
+            self.pending_sketches= {}
+        if max_digraphs is not None:
+            self.max_digraphs= max_digraphs
+        for path, f in data.leaves():
+            if not isinstance( f, (FloatSeq, SampleSketch) ):
+                raise Exception("Unknown feature: {}".format(f))
+            models= self
+            for name in path[:-1]:
+                models= models.get( name, {} )
+            name= path[-1]
+            if name in models:
+                models[name].partial_fit( f.sketch if isinstance(f, SampleSketch) else f.data )
+                continue
+            if isinstance( f, SampleSketch ):
+                model= self._update_sketch( path, f )
+            else:
+                model= self._update_samples( path, f )
+            if model is not None:
+                self._parent( path )[name]= model
+        self._limit_digraphs()
+
+    def _update_samples( self, path, f ):
+        '''update, for a FloatSeq feature with no model yet. Returns its new model, or None if there are still too few samples'''
+        self._add_pending( [(path, f.data)] )
+        try:
+            model= GaussianAnomalyModel( f.name )
+            model._set_moments( self.pending_moments[path] )
+        except InsufficientData:
+            return None
+        del self.pending_moments[path]
+        return model
+
+    def _update_sketch( self, path, f ):
+        '''update, for a SampleSketch feature with no model yet. Returns its new model, or None if there are still too few samples'''
+        self._add_pending_sketches( [(path, f.sketch)] )
+        try:
+            model= RobustAnomalyModel.from_features( f.name, self.pending_sketches[path] )
+        except InsufficientData:
+            return None
+        del self.pending_sketches[path]
+        return model
+
+    def _parent( self, path ):
+        '''the DictTree that holds (or will hold) the model of path, creating it if needed'''
+        models= self
+        for name in path[:-1]:
+            if name not in models:
+                models[name]= DictTree( name )
+            models= models[name]
+        return models
+
+    def _limit_digraphs( self ):
+        '''If max_digraphs, keeps only the max_digraphs digraphs (modelled or pending) with the most samples,
+        forgetting the others, so that updating over many sessions doesn't grow the fingerprint'''
+        if not self.max_digraphs:
+            return
+        models= self.get( "digraphs", {} )
+        counts= [(m.nsamples, ("digraphs", name)) for name,m in models.items()]
+        counts+= [(moments[0], path) for path,moments in self.pending_moments.items() if path[0]=="digraphs"]
+        counts+= [(sketch.count, path) for path,sketch in self.pending_sketches.items() if path[0]=="digraphs"]
+        if len(counts)<=self.max_digraphs:
+            return
+        counts.sort( key=lambda (n, path): (-n, path) )   #ties broken by path, so it's deterministic
+        for _, path in counts[self.max_digraphs:]:
+            models.pop( path[1], None )
+            self.pending_moments.pop( path, None )
+            self.pending_sketches.pop( path, None )
+        if "digraphs" in self and not self["digraphs"]:
+            del self["digraphs"]
 
 class FingerprintComparer(object):
     def __init__(self, reducer=None):
@@ -87,45 +258,191 @@ class FingerprintComparer(object):
 
     @staticmethod
     def _mean_reducer( feature_similarities ):
-        score_tree= feature_similarities.map( lambda x: (1,x.score) )
-        summed= score_tree.reduce( lambda (na,sa),(nb,sb): (na+nb), (sa+sb))
-        return summed[1]/summed[0]
+        score_tree= DictTree.map( lambda x: (1,x), feature_similarities )
+        summed= score_tree.reduce( lambda a,b: (a[0]+b[0], a[1]+b[1]) )
+        return summed[1]/float(summed[0])
 
+    @instrumented('comparer.fingerprint_similarity')
     def _fingerprint_similarity( self, f1, f2 ):
-        print "computing similarity for fingerprints:    {}    {}".format(f1, f2)
+        instrumentation.count('comparer.fingerprint_similarity')
         f1,f2= DictTree.intersect( f1, f2 )
         def feature_map(*features):
             f1,f2= features
             return f1.similarity(f2)
         similarities= DictTree.map( feature_map, f1, f2 )
-        return self._reducer( similarities )   
+        with instrumentation.timer('comparer.reducer'):
+            return self._reducer( similarities )
+
+    @staticmethod
+    def samples_similarity( model, samples ):
+        '''similarity of a model to raw samples: the geometric mean of the similarity of each sample to the model'''
+        return float( np.exp( np.mean( model.predict_array(samples, log=True) ) ) )
+
+    @instrumented('comparer.feature_similarity')
+    def _feature_similarity( self, f1, features ):
+        '''similarity of a fingerprint and a CompositeFeature of FloatSeq, scoring the samples
+        of each feature against its model (see samples_similarity). 0 if there are no common samples'''
+        instrumentation.count('comparer.feature_similarity')
+        f1,features= DictTree.intersect( f1, features )
+        def feature_map(*leaves):
+            model, feature= leaves
+            if not isinstance( feature, FloatSeq ):
+                raise Exception("Unknown feature: {}".format(feature))
+            if len(feature.data)==0:
+                return DictTree.IGNORE_CHILD
+            return self.samples_similarity( model, feature.data )
+        similarities= DictTree.map( feature_map, f1, features )
+        if not any( True for _ in similarities.leaves() ):
+            return 0.0
+        with instrumentation.timer('comparer.reducer'):
+            return self._reducer( similarities )
 
     def similarity(self, f1, x):
-        assert isinstance(f1, Fingerprint)
+        '''similarity of fingerprint f1 and x, a probe Fingerprint or the raw features of the probe
+        (a CompositeFeature, see FeatureExtractor.extract_features). Raw features need no fit, so
+        every sample counts, even of keys with too few samples for a model.
+        CompactFingerprints (see ksdyn.compact) are compared as such, or unpacked if mixed with other kinds'''
+        if getattr(f1, 'COMPACT', False):
+            if getattr(x, 'COMPACT', False):
+                return f1.similarity( x, self._reducer )
+            f1= f1.to_fingerprint()
+        elif getattr(x, 'COMPACT', False):
+            x= x.to_fingerprint()
+        if not isinstance(f1, Fingerprint):
+            raise TypeError("Can't score against {}".format(f1))
         if isinstance(x, Fingerprint):
             return self._fingerprint_similarity( f1, x )
-        else: #assume x is a feature
-            raise NotImplementedError
+        if isinstance(x, CompositeFeature):
+            return self._feature_similarity( f1, x )
+        raise NotImplementedError("Can't score {}".format(x))
+
+def synchronized( method ):
+    '''makes a FingerprintDatabase method hold the database lock, so it never sees a half-applied refresh'''
+    @wraps( method )
+    def wrapper( self, *args, **kwargs ):
+        with self._lock:
+            return method( self, *args, **kwargs )
+    return wrapper
 
 class FingerprintDatabase(object):
-    def __init__(self, fingerprints=[], comparer=None):
+    def __init__(self, fingerprints=(), comparer=None):
         comparer= comparer or FingerprintComparer()
-        self.fingerprints= fingerprints
+        self.fingerprints= list(fingerprints)
         self.comparer= comparer
+        self._lock= threading.RLock()
+        self._manifest= {}  #absolute path -> (stat, fingerprint) of the files loaded by refresh
+        self.generation= 0  #incremented on every change of the fingerprints, to invalidate caches (see ksdyn.cache)
 
+    @instrumented('database.score')
+    @synchronized
     def score( self, data ):
         return [self.comparer.similarity( f, data ) for f in self.fingerprints]
 
+    @synchronized
+    def score_many( self, datas ):
+        '''score of each of many probes. Subclasses may score them all in a single pass'''
+        return [self.score( data ) for data in datas]
+
+    @synchronized
     def best_match( self, data ):
         if len(self.fingerprints)==0:
             raise Exception("No fingerprints available for matching")
         scores= self.score(data)
-        for f,score in zip(self.fingerprints, scores):
-            print "Score for {}: {}".format(f.name, score)
         best_i= scores.index(max(scores))
+        instrumentation.count('database.best_match')
+        instrumentation.observe('database.best_match.score', scores[best_i])
         best= self.fingerprints[best_i]
         return best
 
+    @synchronized
+    def best_match_k( self, data, k=1 ):
+        '''Returns the k fingerprints that best match data, best first'''
+        scores= self.score(data)
+        order= sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+        return [self.fingerprints[i] for i in order[:k]]
+
+    @synchronized
+    def enroll( self, fingerprint ):
+        '''Adds a new fingerprint to the database'''
+        self.fingerprints.append( fingerprint )
+        self.generation+= 1
+
+    @synchronized
+    def enroll_many( self, fingerprints ):
+        '''Adds several new fingerprints (see enroll)'''
+        for fingerprint in fingerprints:
+            self.enroll( fingerprint )
+
+    @synchronized
+    def replace( self, i, fingerprint ):
+        '''Replaces the i-th fingerprint (e.g.: with a re-enrolled one)'''
+        self.fingerprints[i]= fingerprint
+        self.generation+= 1
+
+    @synchronized
+    def remove( self, indexes ):
+        '''Removes the fingerprints at indexes. The others keep their order'''
+        indexes= set( indexes )
+        if indexes:
+            self.fingerprints[:]= [f for i,f in enumerate(self.fingerprints) if i not in indexes]
+            self.generation+= 1
+
     def load_from_dir( self, directory ):
-        self.fingerprints.extend( Fingerprint.load_from_dir(directory).values() )
+        '''Loads the .fingerprint files in directory. Calling it again only loads what changed (see refresh)'''
+        self.refresh( directory )
+        return self
+
+    def refresh( self, directory ):
+        '''Brings the database up to date with the .fingerprint files in directory, loading only the files
+        that are new or changed (by inode, size or mtime) since the last refresh, and removing the fingerprints
+        of deleted files. Fingerprints not loaded from directory are left alone.
+        Files are loaded without holding the database lock; the changes are then applied under it,
+        so scoring in other threads sees either the old or the new set of fingerprints.
+        Files that fail to load (e.g.: being written) are skipped, and retried on the next refresh.
+        Returns a dict of the file names added, updated, removed and failed.
+        Raises NotImplementedError for lazily loaded fingerprints (see load_from_store), which can't be replaced or removed'''
+        if not isinstance( self.fingerprints, list ):
+            raise NotImplementedError("Can't refresh lazily loaded fingerprints (see load_from_store)")
+        extension= Fingerprint.FILE_EXTENSION
+        directory= os.path.abspath( directory )
+        stats= {}       #path -> (inode, size, mtime)
+        for filename in os.listdir( directory ):
+            if filename.endswith( extension ):
+                path= os.path.join( directory, filename )
+                s= os.stat( path )
+                stats[path]= (s.st_ino, s.st_size, s.st_mtime)
+        old= self._manifest
+        ours= set( path for path in old if os.path.dirname(path)==directory )  #loaded from directory
+        loaded, failed= {}, []
+        for path in sorted( stats ):
+            if path in ours and old[path][0]==stats[path]:
+                continue
+            try:
+                loaded[path]= Fingerprint.load_from_file( path )
+            except Exception:   #truncated pickles raise about anything
+                failed.append( path )
+        removed= [path for path in ours if path not in stats]
+        with self._lock:
+            rows= dict( (id(f), i) for i,f in enumerate(self.fingerprints) )
+            updated= [path for path in sorted(loaded) if path in ours and id(old[path][1]) in rows]
+            for path in updated:
+                self.replace( rows[id(old[path][1])], loaded[path] )
+            removed_rows= [rows[id(old[path][1])] for path in removed if id(old[path][1]) in rows]
+            if removed_rows:
+                self.remove( removed_rows )
+            added= [path for path in sorted(loaded) if path not in updated]
+            if added:
+                self.enroll_many( [loaded[path] for path in added] )
+            manifest= dict( (path, entry) for path,entry in old.items() if path not in ours or path in stats )
+            manifest.update( (path, (stats[path], f)) for path,f in loaded.items() )
+            self._manifest= manifest
+        names= lambda paths: sorted( os.path.basename(path) for path in paths )
+        return {'added': names(added), 'updated': names(updated), 'removed': names(removed), 'failed': names(failed)}
+
+    def load_from_store( self, filename, cache_size=1024 ):
+        '''Uses the fingerprints in a FingerprintStore file. They are loaded lazily,
+        and at most cache_size of them are kept in memory'''
+        from ksdyn.store import FingerprintStore, LazyFingerprintList
+        self.fingerprints= LazyFingerprintList( FingerprintStore(filename), cache_size )
+        self.generation+= 1
         return self
@@ -0,0 +1,81 @@
+'''The matrix of similarities between every pair of fingerprints of a database,
+for detecting duplicate enrollments and calibrating thresholds.
+
+The (N x N) result is a .npy file, memory-mapped, so N can be larger than what fits in memory.
+It's computed in square tiles of block_size fingerprints, by worker processes. Similarity is symmetric,
+so only the tiles on and above the diagonal are computed, each also written to its mirror tile.
+Completed tiles are recorded in a progress file, so a interrupted computation resumes where it stopped.'''
+from ksdyn.matrix import FingerprintMatrix, block_scores
+
+import os
+import json
+import multiprocessing
+import numpy as np
+
+PROGRESS_EXTENSION= ".progress.npy"
+PARAMETERS_EXTENSION= ".json"
+
+_shared= {}     #matrix arrays and parameters, for the (forked) workers
+
+def _compute_tile( tile ):
+    '''computes tile (i,j) and its mirror into the output file'''
+    i, j= tile
+    s= _shared
+    a= slice( i*s['block_size'], (i+1)*s['block_size'] )
+    b= slice( j*s['block_size'], (j+1)*s['block_size'] )
+    scores= block_scores( s['means'][a], s['stddevs'][a], s['mask'][a],
+        s['means'][b], s['stddevs'][b], s['mask'][b], s['reducer'], s['log'] )
+    out= np.load( s['filename'], mmap_mode='r+' )
+    out[a, b]= scores
+    out[b, a]= scores.T
+    out.flush()
+    del out
+    return tile
+
+def _open_output( filename, parameters, n, nblocks, dtype ):
+    '''Returns the progress array, creating the output and progress files if needed'''
+    progress_filename= filename + PROGRESS_EXTENSION
+    parameters_filename= filename + PARAMETERS_EXTENSION
+    if os.path.exists( filename ) and os.path.exists( progress_filename ) and os.path.exists( parameters_filename ):
+        with open( parameters_filename ) as f:
+            old= json.load( f )
+        if old!=parameters:
+            raise ValueError("{} was computed with different parameters: {}. Delete it to start over".format(filename, old))
+        return np.load( progress_filename, mmap_mode='r+' )
+    np.lib.format.open_memmap( filename, mode='w+', dtype=dtype, shape=(n, n) ).flush()
+    with open( parameters_filename, 'w' ) as f:
+        json.dump( parameters, f )
+    progress= np.lib.format.open_memmap( progress_filename, mode='w+', dtype=np.uint8, shape=(nblocks, nblocks) )
+    progress.flush()
+    return progress
+
+def pairwise_similarities( fingerprints, filename, reducer=None, workers=None, block_size=256, dtype=np.float64, log=False ):
+    '''Computes into filename (a .npy file) the (N x N) matrix of FingerprintComparer(reducer).similarity
+    between every pair of fingerprints (up to rounding), or of their log if log (multiplication reducer only).
+    If filename holds a interrupted computation with the same parameters, resumes it.
+    Returns the result, as a read-only memory-mapped array.
+    Memory use is about block_size**2 * keys * 8 bytes per worker; workers=1 computes in this process'''
+    matrix= FingerprintMatrix( fingerprints, reducer )
+    n= len(matrix)
+    nblocks= -(-n // block_size)
+    parameters= {'n': n, 'block_size': block_size, 'reducer': matrix.reducer, 'log': log, 'dtype': np.dtype(dtype).str,
+        'names': [f.name for f in matrix.fingerprints]}
+    progress= _open_output( filename, parameters, n, nblocks, dtype )
+    pending= [(i, j) for i in range(nblocks) for j in range(i, nblocks) if not progress[i, j]]
+    _shared.update( means=matrix.means, stddevs=matrix.stddevs, mask=matrix.mask,
+        reducer=matrix.reducer, log=log, block_size=block_size, filename=filename )
+    pool= None if workers==1 else multiprocessing.Pool( workers )    #forked after _shared is set
+    try:
+        if pool:
+            results= pool.imap_unordered( _compute_tile, pending )
+        else:
+            results= (_compute_tile(tile) for tile in pending)
+        for i, j in results:
+            progress[i, j]= 1
+            progress.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        _shared.clear()
+    return np.load( filename, mmap_mode='r' )
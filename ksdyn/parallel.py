@@ -0,0 +1,151 @@
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import Fingerprint, FingerprintDatabase, synchronized
+from ksdyn.store import FingerprintDirectory, LazyFingerprintList
+
+import multiprocessing
+import numpy as np
+
+def _worker( connection, comparer ):
+    '''Keeps a shard of (index, fingerprint) resident, and scores probes against it'''
+    shard= []
+    while True:
+        command, argument= connection.recv()
+        if command=='add':
+            shard.extend( argument )
+        elif command=='load':
+            shard.extend( (i, Fingerprint.load_from_file(filename)) for i,filename in argument )
+            connection.send( len(shard) )
+        elif command=='score':
+            connection.send( [(i, comparer.similarity(f, argument)) for i,f in shard] )
+        elif command=='stop':
+            break
+    connection.close()
+
+class ParallelFingerprintDatabase(FingerprintDatabase):
+    '''A FingerprintDatabase that shards its fingerprints across worker processes.
+    Workers keep their shard resident, so scoring only sends the probe to them.
+    Fingerprints are assigned to workers round-robin, in chunks of chunk_size.
+    Scores are the same, and in the same order, as FingerprintDatabase.score'''
+    def __init__(self, fingerprints=(), comparer=None, workers=None, chunk_size=256):
+        FingerprintDatabase.__init__( self, [], comparer )
+        self.nworkers= workers or multiprocessing.cpu_count()
+        self.chunk_size= chunk_size
+        self._workers= []   #(process, connection)
+        for f in fingerprints:
+            self.enroll( f )
+
+    def _start( self ):
+        if self._workers:
+            return
+        for _ in range(self.nworkers):
+            ours, theirs= multiprocessing.Pipe()
+            process= multiprocessing.Process( target=_worker, args=(theirs, self.comparer) )
+            process.daemon= True
+            process.start()
+            theirs.close()
+            self._workers.append( (process, ours) )
+
+    def _connection( self, index ):
+        '''connection to the worker that holds the fingerprint with the given index'''
+        return self._workers[ (index // self.chunk_size) % self.nworkers ][1]
+
+    def close( self ):
+        for process, connection in self._workers:
+            connection.send( ('stop', None) )
+            connection.close()
+            process.join()
+        self._workers= []
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.close()
+
+    @synchronized
+    def enroll( self, fingerprint ):
+        self._start()
+        index= len(self.fingerprints)
+        FingerprintDatabase.enroll( self, fingerprint )
+        self._connection( index ).send( ('add', [(index, fingerprint)]) )
+
+    def replace( self, i, fingerprint ):
+        raise NotImplementedError("Workers can't replace fingerprints")
+
+    def remove( self, indexes ):
+        raise NotImplementedError("Workers can't remove fingerprints")
+
+    def refresh( self, directory ):
+        '''Not supported: workers can't replace or remove fingerprints. Use load_from_dir on a new database instead'''
+        raise NotImplementedError("Workers can't replace or remove fingerprints: load_from_dir into a new database instead")
+
+    @synchronized
+    def score( self, data ):
+        self._start()
+        for _, connection in self._workers:
+            connection.send( ('score', data) )
+        scores= [None]*len(self.fingerprints)
+        for _, connection in self._workers:
+            for i, score in connection.recv():
+                scores[i]= score
+        return scores
+
+    @synchronized
+    def load_from_dir( self, directory ):
+        '''Each worker loads its own shard of the .fingerprint files in directory, in parallel.
+        This process only loads a fingerprint when it's accessed (e.g.: returned by best_match)'''
+        if len(self.fingerprints):
+            raise Exception("Can only load into a empty database")
+        self._start()
+        fingerprint_dir= FingerprintDirectory( directory )
+        names= fingerprint_dir.names()     #listed once, so that rows match the workers' indexes
+        shards= [[] for _ in self._workers]
+        for i, name in enumerate( names ):
+            shards[ (i // self.chunk_size) % self.nworkers ].append( (i, fingerprint_dir.filename(name)) )
+        for (_, connection), shard in zip( self._workers, shards ):
+            connection.send( ('load', shard) )
+        for _, connection in self._workers:
+            connection.recv()
+        self.fingerprints= LazyFingerprintList( fingerprint_dir, names=names )
+        self.generation+= 1
+        return self
+
+
+_shared= {}     #events and parameters, for the (forked) workers of parallel_extract
+
+def _extract_chunk( bounds ):
+    '''the extractor of events[start:end]'''
+    start, end= bounds
+    s= _shared
+    if start==0:
+        extractor= FeatureExtractor( s['timing_threshold'] )
+    else:
+        extractor= FeatureExtractor.for_chunk( s['timing_threshold'] )
+    extractor.on_events( s['events'][start:end] )
+    return extractor
+
+def chunk_bounds( n, nchunks ):
+    '''[(start, end)] of nchunks consecutive, nearly equal chunks of n events'''
+    edges= np.linspace( 0, n, max(1, nchunks)+1 ).astype(int).tolist()
+    return zip( edges[:-1], edges[1:] )
+
+def parallel_extract( events, timing_threshold=500, workers=None, nchunks=None ):
+    '''Feature extraction of a single large log on several cores. Returns a FeatureExtractor fed with events
+    (a array of KeystrokeCaptureData.EVENT_DTYPE, see KeystrokeCaptureData.events), identical to a sequential pass.
+    The log is cut into nchunks (defaults to workers) consecutive chunks, extracted by worker processes
+    and merged in log order (see FeatureExtractor.merge). workers=1 extracts them in this process'''
+    workers= workers or multiprocessing.cpu_count()
+    bounds= chunk_bounds( len(events), nchunks or workers )
+    _shared.update( events=events, timing_threshold=timing_threshold )
+    pool= None if workers==1 else multiprocessing.Pool( workers )    #forked after _shared is set
+    try:
+        if pool:
+            extractors= pool.map( _extract_chunk, bounds )
+        else:
+            extractors= map( _extract_chunk, bounds )
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        _shared.clear()
+    return reduce( FeatureExtractor.merge, extractors )
@@ -0,0 +1,350 @@
+'''A local scoring service: keeps a fingerprint database resident, receives streamed keystroke
+events for many concurrent sessions, and answers identify/verify requests.
+
+The protocol is one JSON object per line, each request answered by one response line:
+    {"op": "open", "session": ID}
+    {"op": "events", "session": ID, "events": [[key, event_type, time_ms], ...]}
+    {"op": "identify", "session": ID, "k": 3}          -> {"matches": [[name, score], ...]}
+    {"op": "verify", "session": ID, "user": NAME}      -> {"score": s, "rank": r, "match": rank==0}
+    {"op": "close", "session": ID}
+    {"op": "stats"}
+Responses have "ok": true, or "ok": false and a "error" message.
+
+Score requests from all sessions are queued to a single scoring thread, which micro-batches
+them into one database pass (see FingerprintMatrix.score_many). The queue is bounded: when it's
+full, requests fail with a "busy" error instead of queueing without limit.
+
+usage: python -m ksdyn.service FINGERPRINT_DIR (--socket PATH | --port PORT)'''
+from ksdyn.core import KeystrokeCaptureData, InsufficientData
+from ksdyn.features import FeatureExtractor
+from ksdyn.model import Fingerprint
+from ksdyn.matrix import MatrixFingerprintDatabase
+
+import os
+import sys
+import json
+import socket
+import threading
+import SocketServer
+import Queue
+from timeit import default_timer as clock
+
+import numpy as np
+
+class ServiceError(Exception):
+    '''A request that the service refused or failed to answer'''
+    pass
+
+class ServiceBusy(ServiceError):
+    pass
+
+
+class ScoreRequest(object):
+    '''A probe waiting to be scored by a MicroBatcher'''
+    def __init__(self, probe):
+        self.probe= probe
+        self.scores= None
+        self.error= None
+        self._done= threading.Event()
+
+    def set_result( self, scores=None, error=None ):
+        self.scores, self.error= scores, error
+        self._done.set()
+
+    def result( self, timeout=None ):
+        '''waits for and returns the list of scores (one per database fingerprint)'''
+        if not self._done.wait( timeout ):
+            raise ServiceBusy("Timed out waiting for scoring")
+        if self.error:
+            raise ServiceError( self.error )
+        return self.scores
+
+
+class MicroBatcher(threading.Thread):
+    '''Scores the probes submitted to it in batches: waits at most max_delay seconds
+    after a request for others, and scores up to max_batch of them in one database.score_many pass'''
+    def __init__(self, database, max_batch=64, max_delay=0.005, max_pending=1024):
+        threading.Thread.__init__( self )
+        self.daemon= True
+        self.database= database
+        self.max_batch= max_batch
+        self.max_delay= max_delay
+        self._queue= Queue.Queue( max_pending )
+        self.batches= 0
+        self.scored= 0
+
+    def submit( self, probe, timeout=1.0 ):
+        '''Queues a probe. Returns a ScoreRequest, or raises ServiceBusy if the queue stays full for timeout seconds'''
+        request= ScoreRequest( probe )
+        try:
+            self._queue.put( request, timeout=timeout )
+        except Queue.Full:
+            raise ServiceBusy("Too many pending score requests")
+        return request
+
+    def run( self ):
+        while True:
+            request= self._queue.get()
+            if request is None:
+                return
+            batch= [request]
+            deadline= clock() + self.max_delay
+            while len(batch)<self.max_batch:
+                try:
+                    request= self._queue.get( timeout=max(0, deadline-clock()) )
+                except Queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put( None )    #stop after this batch
+                    break
+                batch.append( request )
+            self._score( batch )
+
+    def _score( self, batch ):
+        try:
+            scores= self.database.score_many( [r.probe for r in batch] )
+        except Exception as e:
+            for r in batch:
+                r.set_result( error="{}: {}".format(e.__class__.__name__, e) )
+            return
+        for r, s in zip( batch, scores ):
+            r.set_result( scores=s )
+        self.batches+= 1
+        self.scored+= len(batch)
+
+    def stop( self ):
+        self._queue.put( None )
+        self.join()
+
+
+class Session(object):
+    '''The keystroke state of a client session'''
+    def __init__(self, name):
+        self.name= name
+        self.extractor= FeatureExtractor()
+        self.nevents= 0
+        self.lock= threading.Lock()
+
+    def probe( self ):
+        '''a Fingerprint of the session keystrokes so far'''
+        with self.lock:
+            features= self.extractor.extract_features()
+            fingerprint= Fingerprint.from_features( self.name, features )
+        if not len(fingerprint):
+            raise InsufficientData("Not enough keystrokes in session {}".format(self.name))
+        return fingerprint
+
+
+class ScoringService(object):
+    '''Answers the requests of the protocol (see the module documentation).
+    Memory is bounded by max_sessions and max_session_events (events received per session)'''
+    def __init__(self, database, max_sessions=1024, max_session_events=100000, max_batch=64, max_delay=0.005, max_pending=1024, timeout=5.0):
+        self.database= database
+        self.max_sessions= max_sessions
+        self.max_session_events= max_session_events
+        self.timeout= timeout
+        self.sessions= {}
+        self._lock= threading.Lock()
+        self.batcher= MicroBatcher( database, max_batch, max_delay, max_pending )
+        self.requests= 0
+        self.errors= 0
+
+    def start( self ):
+        self.batcher.start()
+        return self
+
+    def stop( self ):
+        self.batcher.stop()
+
+    def _session( self, request ):
+        try:
+            return self.sessions[ request['session'] ]
+        except KeyError:
+            raise ServiceError("Unknown session: {}".format(request['session']))
+
+    def handle( self, request ):
+        '''Returns the response (a dict) to a request (a dict)'''
+        self.requests+= 1
+        try:
+            op= request.get( 'op' )
+            method= getattr( self, 'op_'+str(op), None )
+            if method is None:
+                raise ServiceError("Unknown op: {}".format(op))
+            response= method( request ) or {}
+            response['ok']= True
+        except (ServiceError, InsufficientData, KeyError, ValueError, TypeError) as e:
+            self.errors+= 1
+            response= {'ok': False, 'error': "{}: {}".format(e.__class__.__name__, e)}
+        return response
+
+    def op_open( self, request ):
+        name= request['session']
+        with self._lock:
+            if name in self.sessions:
+                raise ServiceError("Session already open: {}".format(name))
+            if len(self.sessions)>=self.max_sessions:
+                raise ServiceBusy("Too many sessions")
+            self.sessions[name]= Session( name )
+
+    def op_close( self, request ):
+        with self._lock:
+            self._session( request )
+            del self.sessions[ request['session'] ]
+
+    def op_events( self, request ):
+        session= self._session( request )
+        events= np.array( [tuple(e) for e in request['events']], dtype=KeystrokeCaptureData.EVENT_DTYPE )
+        with session.lock:
+            if session.nevents + len(events) > self.max_session_events:
+                raise ServiceBusy("Session event limit ({}) reached".format(self.max_session_events))
+            session.extractor.on_events( events )
+            session.nevents+= len(events)
+        return {'events': session.nevents}
+
+    def _scores( self, session ):
+        request= self.batcher.submit( session.probe(), self.timeout )
+        return request.result( self.timeout )
+
+    def op_identify( self, request ):
+        scores= self._scores( self._session(request) )
+        k= int( request.get('k', 1) )
+        order= sorted( range(len(scores)), key=scores.__getitem__, reverse=True )[:k]
+        return {'matches': [[self.database.fingerprints[i].name, scores[i]] for i in order]}
+
+    def op_verify( self, request ):
+        user= request['user']
+        names= [f.name for f in self.database.fingerprints]
+        if user not in names:
+            raise ServiceError("Unknown user: {}".format(user))
+        scores= self._scores( self._session(request) )
+        score= scores[ names.index(user) ]
+        rank= sum( 1 for s in scores if s>score )
+        return {'score': score, 'rank': rank, 'match': rank==0}
+
+    def op_stats( self, request ):
+        return {
+            'sessions': len(self.sessions), 'fingerprints': len(self.database.fingerprints),
+            'requests': self.requests, 'errors': self.errors,
+            'batches': self.batcher.batches, 'scored': self.batcher.scored,
+            }
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle( self ):
+        service= self.server.service
+        while True:
+            line= self.rfile.readline()
+            if not line:
+                return
+            try:
+                request= json.loads( line )
+                if not isinstance( request, dict ):
+                    raise ValueError("Requests must be JSON objects")
+            except ValueError as e:
+                response= {'ok': False, 'error': "ValueError: {}".format(e)}
+            else:
+                response= service.handle( request )
+            self.wfile.write( json.dumps(response) + "\n" )
+            self.wfile.flush()
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads= True
+    allow_reuse_address= True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads= True
+
+def make_server( service, address ):
+    '''A (threading) socket server for service. address is a (host, port) tuple for TCP,
+    or the path of a Unix socket. Call serve_forever on it'''
+    if isinstance( address, basestring ):
+        if os.path.exists( address ):
+            os.unlink( address )
+        server= _UnixServer( address, _RequestHandler )
+    else:
+        server= _TCPServer( address, _RequestHandler )
+    server.service= service
+    return server
+
+
+class ScoringClient(object):
+    '''A (blocking) client of the scoring service. Not thread safe: use one per thread'''
+    def __init__(self, address):
+        '''address as in make_server'''
+        family= socket.AF_UNIX if isinstance( address, basestring ) else socket.AF_INET
+        self.socket= socket.socket( family, socket.SOCK_STREAM )
+        self.socket.connect( address )
+        self._file= self.socket.makefile( 'rb' )
+
+    def request( self, **request ):
+        '''sends a request, and returns the response. Raises ServiceError (or ServiceBusy) on errors'''
+        self.socket.sendall( json.dumps(request) + "\n" )
+        line= self._file.readline()
+        if not line:
+            raise ServiceError("Connection closed")
+        response= json.loads( line )
+        if not response.pop('ok'):
+            error= response['error']
+            raise (ServiceBusy if error.startswith(ServiceBusy.__name__) else ServiceError)( error )
+        return response
+
+    def open_session( self, session ):
+        self.request( op='open', session=session )
+
+    def close_session( self, session ):
+        self.request( op='close', session=session )
+
+    def send_events( self, session, events ):
+        '''events is a sequence of (key, event_type, time_ms), or a array of KeystrokeCaptureData.EVENT_DTYPE'''
+        if isinstance( events, np.ndarray ):
+            events= events.tolist()
+        return self.request( op='events', session=session, events=events )['events']
+
+    def identify( self, session, k=1 ):
+        '''Returns the k best matches of the session, as [(name, score)], best first'''
+        return [tuple(m) for m in self.request( op='identify', session=session, k=k )['matches']]
+
+    def verify( self, session, user ):
+        '''Returns (score, rank) of user for the session; rank 0 means user is the best match'''
+        response= self.request( op='verify', session=session, user=user )
+        return response['score'], response['rank']
+
+    def stats( self ):
+        return self.request( op='stats' )
+
+    def close( self ):
+        self._file.close()
+        self.socket.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.close()
+
+
+def main( argv=None ):
+    import argparse
+    parser= argparse.ArgumentParser( description="Serves identify/verify requests against a fingerprint directory" )
+    parser.add_argument( 'fingerprints', help='directory of {} files'.format(Fingerprint.FILE_EXTENSION) )
+    group= parser.add_mutually_exclusive_group( required=True )
+    group.add_argument( '--socket', help='path of the Unix socket to listen on' )
+    group.add_argument( '--port', type=int, help='TCP port to listen on (localhost)' )
+    parser.add_argument( '--max-sessions', type=int, default=1024 )
+    parser.add_argument( '--max-session-events', type=int, default=100000 )
+    args= parser.parse_args( argv )
+    database= MatrixFingerprintDatabase().load_from_dir( args.fingerprints )
+    service= ScoringService( database, args.max_sessions, args.max_session_events ).start()
+    server= make_server( service, args.socket or ('localhost', args.port) )
+    print "serving {} fingerprints on {}".format( len(database.fingerprints), server.server_address )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+if __name__=='__main__':
+    sys.exit( main() )
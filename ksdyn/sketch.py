@@ -0,0 +1,105 @@
+'''Streaming quantile sketches: summaries of a stream of numbers, of bounded size, that estimate its quantiles'''
+import numpy as np
+
+class QuantileSketch(object):
+    '''A merging t-digest (Dunning): the samples are summarized by at most compression
+    weighted centroids, kept small near the extremes so that tail quantiles stay accurate.
+    Samples are buffered, and merged into the centroids when the buffer is full.
+    Sketches of different streams can be merged, as if they summarized both'''
+    def __init__(self, compression=100, buffer_size=None):
+        self.compression= compression
+        self.buffer_size= buffer_size or 5*compression
+        self.means=   np.zeros( 0 )
+        self.weights= np.zeros( 0 )
+        self.buffer= []
+        self.min, self.max= np.inf, -np.inf
+
+    @property
+    def count( self ):
+        return int( self.weights.sum() ) + len(self.buffer)
+
+    def __len__( self ):
+        return self.count
+
+    def __repr__( self ):
+        return "{}( {} samples, {} centroids )".format( self.__class__.__name__, self.count, len(self.means) )
+
+    def append( self, x ):
+        self.buffer.append( float(x) )
+        if len(self.buffer)>=self.buffer_size:
+            self._compress()
+
+    def extend( self, samples ):
+        '''adds samples, a iterable of numbers, or another QuantileSketch (see merge)'''
+        if isinstance( samples, QuantileSketch ):
+            self.merge( samples )
+            return
+        samples= np.asarray( samples, dtype=float ).ravel()
+        for start in xrange( 0, len(samples), self.buffer_size ):
+            self.buffer.extend( samples[start:start+self.buffer_size].tolist() )
+            if len(self.buffer)>=self.buffer_size:
+                self._compress()
+
+    def merge( self, other ):
+        '''Adds the samples summarized by other. Returns self'''
+        self._compress( other.means, other.weights, other.buffer )
+        return self
+
+    def _compress( self, means=(), weights=(), buffer=() ):
+        '''merges the buffer (and other centroids) into the centroids'''
+        samples= np.array( self.buffer + list(buffer), dtype=float )
+        self.buffer= []
+        means=   np.concatenate( (self.means,   np.asarray(means, dtype=float),   samples) )
+        weights= np.concatenate( (self.weights, np.asarray(weights, dtype=float), np.ones(len(samples))) )
+        if len(means)==0:
+            return
+        order= np.argsort( means, kind='mergesort' )
+        means, weights= means[order].tolist(), weights[order].tolist()
+        self.min= min( self.min, means[0] )
+        self.max= max( self.max, means[-1] )
+        total= float( sum(weights) )
+        merged_means, merged_weights= [means[0]], [weights[0]]
+        cumulative= 0.0     #weight of the centroids before the last merged one
+        limit= self._quantile_limit( 0.0 ) * total
+        for m, w in zip( means[1:], weights[1:] ):
+            proposed= merged_weights[-1] + w
+            if cumulative + proposed <= limit:
+                merged_means[-1]+= (m - merged_means[-1]) * w / proposed
+                merged_weights[-1]= proposed
+            else:
+                cumulative+= merged_weights[-1]
+                limit= self._quantile_limit( cumulative/total ) * total
+                merged_means.append( m )
+                merged_weights.append( w )
+        self.means=   np.array( merged_means )
+        self.weights= np.array( merged_weights )
+
+    def _quantile_limit( self, q ):
+        '''the largest quantile a centroid starting at quantile q can reach: one unit of the
+        scale function k(q)= compression/(2 pi) * asin(2q-1), which bounds the number of centroids'''
+        k= self.compression / (2*np.pi) * np.arcsin( 2*q - 1 ) + 1
+        return (np.sin( min(k * 2*np.pi / self.compression, np.pi/2) ) + 1) / 2
+
+    def quantiles( self, qs ):
+        '''Estimates the quantiles qs (numbers in [0,1]) of the samples, interpolating between centroids.
+        Returns a array. Raises ValueError if there are no samples'''
+        if self.buffer:
+            self._compress()
+        if len(self.means)==0:
+            raise ValueError("No samples in sketch")
+        total= self.weights.sum()
+        centers= np.cumsum( self.weights ) - self.weights/2
+        positions= np.concatenate( ([0], centers, [total]) )
+        values= np.concatenate( ([self.min], self.means, [self.max]) )
+        return np.interp( np.asarray(qs, dtype=float)*total, positions, values )
+
+    def quantile( self, q ):
+        return float( self.quantiles( [q] )[0] )
+
+    def __getstate__( self ):
+        if self.buffer:
+            self._compress()
+        return self.__dict__
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
@@ -0,0 +1,173 @@
+from ksdyn.model import Fingerprint
+
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''A dict-like cache that holds at most maxsize items, evicting the least recently used'''
+    def __init__(self, maxsize=1024):
+        self.maxsize= maxsize
+        self._items= OrderedDict()
+        self.hits= self.misses= 0
+
+    def get( self, key, default=None ):
+        try:
+            value= self._items.pop( key )
+        except KeyError:
+            self.misses+= 1
+            return default
+        self._items[key]= value
+        self.hits+= 1
+        return value
+
+    def put( self, key, value ):
+        self._items.pop( key, None )
+        self._items[key]= value
+        while len(self._items)>self.maxsize:
+            self._items.popitem( last=False )
+
+    def discard( self, key ):
+        self._items.pop( key, None )
+
+    def clear( self ):
+        self._items.clear()
+
+    def __len__( self ):
+        return len(self._items)
+
+    def __contains__( self, key ):
+        return key in self._items
+
+
+class FingerprintStore(object):
+    '''Many fingerprints in a single (SQLite) file, with random access by user name
+    and iteration in storage order. An alternative to one .fingerprint file per user'''
+    FILE_EXTENSION=".fingerprints"
+
+    def __init__(self, filename):
+        self.filename= filename
+        self._db= sqlite3.connect( filename )
+        self._db.execute( 'CREATE TABLE IF NOT EXISTS fingerprints (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, data BLOB NOT NULL)' )
+        self._db.commit()
+
+    def close( self ):
+        self._db.close()
+
+    def put( self, fingerprint, commit=True ):
+        '''Stores a fingerprint, replacing (in place) any with the same name'''
+        assert isinstance( fingerprint, Fingerprint )
+        data= sqlite3.Binary( pickle.dumps(fingerprint, pickle.HIGHEST_PROTOCOL) )
+        cursor= self._db.execute( 'UPDATE fingerprints SET data=? WHERE name=?', (data, fingerprint.name) )
+        if cursor.rowcount==0:
+            self._db.execute( 'INSERT INTO fingerprints (name, data) VALUES (?,?)', (fingerprint.name, data) )
+        if commit:
+            self._db.commit()
+
+    def put_many( self, fingerprints ):
+        for f in fingerprints:
+            self.put( f, commit=False )
+        self._db.commit()
+
+    def _load( self, data ):
+        fingerprint= pickle.loads( str(data) )
+        Fingerprint._check_loaded( fingerprint, self.filename )
+        return fingerprint
+
+    def get( self, name ):
+        row= self._db.execute( 'SELECT data FROM fingerprints WHERE name=?', (name,) ).fetchone()
+        if row is None:
+            raise KeyError( name )
+        return self._load( row[0] )
+
+    def delete( self, name ):
+        self._db.execute( 'DELETE FROM fingerprints WHERE name=?', (name,) )
+        self._db.commit()
+
+    def names( self ):
+        '''user names, in storage order'''
+        return [name for (name,) in self._db.execute( 'SELECT name FROM fingerprints ORDER BY id' )]
+
+    def __iter__( self ):
+        '''iterates over the fingerprints in storage order, loading them one at a time'''
+        for (data,) in self._db.execute( 'SELECT data FROM fingerprints ORDER BY id' ):
+            yield self._load( data )
+
+    def __len__( self ):
+        return self._db.execute( 'SELECT COUNT(*) FROM fingerprints' ).fetchone()[0]
+
+    def __contains__( self, name ):
+        return self._db.execute( 'SELECT 1 FROM fingerprints WHERE name=?', (name,) ).fetchone() is not None
+
+    def import_dir( self, directory ):
+        '''Stores every .fingerprint file in directory'''
+        self.put_many( Fingerprint.load_from_dir(directory).values() )
+        return self
+
+
+class FingerprintDirectory(object):
+    '''A directory of .fingerprint files, with the same read interface as FingerprintStore'''
+    def __init__(self, directory):
+        self.directory= directory
+
+    def filename( self, name ):
+        return os.path.join( self.directory, name+Fingerprint.FILE_EXTENSION )
+
+    def names( self ):
+        '''user names, sorted'''
+        ext= Fingerprint.FILE_EXTENSION
+        return sorted( f[:-len(ext)] for f in os.listdir(self.directory) if f.endswith(ext) )
+
+    def get( self, name ):
+        if not os.path.exists( self.filename(name) ):
+            raise KeyError( name )
+        return Fingerprint.load_from_file( self.filename(name) )
+
+    def put( self, fingerprint ):
+        fingerprint.save_to_file( os.path.join(self.directory, fingerprint.name) )
+
+    def __contains__( self, name ):
+        return os.path.exists( self.filename(name) )
+
+    def __iter__( self ):
+        for name in self.names():
+            yield self.get( name )
+
+    def __len__( self ):
+        return len(self.names())
+
+
+class LazyFingerprintList(object):
+    '''A read-only sequence of the fingerprints of a FingerprintStore (or FingerprintDirectory), in storage order.
+    Fingerprints are only loaded when accessed, and at most cache_size of them are kept in memory.
+    names, if given, are the user names to use (e.g.: as listed earlier), instead of those in the store'''
+    def __init__(self, store, cache_size=1024, names=None):
+        self.store= store
+        self.names= store.names() if names is None else list(names)
+        self.cache= LRUCache( cache_size )
+
+    def __len__( self ):
+        return len(self.names)
+
+    def __getitem__( self, i ):
+        if isinstance( i, slice ):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        name= self.names[i]
+        fingerprint= self.cache.get( name )
+        if fingerprint is None:
+            fingerprint= self.store.get( name )
+            self.cache.put( name, fingerprint )
+        return fingerprint
+
+    def __iter__( self ):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append( self, fingerprint ):
+        '''Adds a new fingerprint at the end, saving it to the store'''
+        if fingerprint.name in self.store:
+            raise ValueError("There's already a fingerprint named {}".format(fingerprint.name))
+        self.store.put( fingerprint )
+        self.names.append( fingerprint.name )
+        self.cache.put( fingerprint.name, fingerprint )
@@ -2,9 +2,17 @@ from ksdyn.core import KeystrokeCaptureData
 from ksdyn.features import FeatureExtractor
 from ksdyn.model import Fingerprint
 
-def create_fingerprint_from_capture_data( name, capture_data ):
+def extract_features_from_capture_data( capture_data, max_digraphs=0, sketch_compression=0 ):
+    '''the raw features of capture_data, which can be scored without fitting a Fingerprint (see FingerprintComparer.similarity)'''
     assert isinstance( capture_data, KeystrokeCaptureData )
-    fe= FeatureExtractor()
-    capture_data.feed( fe )
-    features= fe.extract_features()
-    return Fingerprint.from_features( name, features ) 
+    fe= FeatureExtractor( max_digraphs=max_digraphs, sketch_compression=sketch_compression )
+    fe.on_events( capture_data.events )
+    return fe.extract_features()
+
+def create_fingerprint_from_capture_data( name, capture_data, max_digraphs=0, sketch_compression=0 ):
+    '''If sketch_compression, fits RobustAnomalyModels to sketches of the samples (see FeatureExtractor).
+    max_digraphs also bounds the digraphs kept by later updates (see Fingerprint.update)'''
+    features= extract_features_from_capture_data( capture_data, max_digraphs, sketch_compression )
+    fingerprint= Fingerprint.from_features( name, features )
+    fingerprint.max_digraphs= max_digraphs
+    return fingerprint
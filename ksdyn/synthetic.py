@@ -0,0 +1,59 @@
+'''Synthetic keystroke data, for tests and benchmarks'''
+from ksdyn.core import KeystrokeCaptureData, KeypressEventReceiver
+
+import numpy as np
+
+KEYS= np.arange( 24, 62 )  #the X keycodes of most letters, digits and punctuation
+
+class SyntheticTypist(object):
+    '''A typist with its own (normal) dwell and flight time distribution for each key.
+    All randomness comes from seed, so the same seed always gives the same typist and events'''
+    def __init__(self, seed, key_frequencies=None):
+        rng= np.random.RandomState( seed )
+        n= len(KEYS)
+        self.seed= seed
+        self.key_frequencies= key_frequencies if key_frequencies is not None else np.ones(n)/n
+        self.dwell_mean=   np.clip( rng.normal(100, 20) + rng.normal(0, 15, n), 20, None )
+        self.dwell_stddev= rng.uniform( 8, 25, n )
+        self.flight_mean=  np.clip( rng.normal(150, 40) + rng.normal(0, 30, n), 30, None )
+        self.flight_stddev= rng.uniform( 20, 60, n )
+
+    def events( self, nkeypresses, seed=0, start_time=0 ):
+        '''Returns the (KeystrokeCaptureData.EVENT_DTYPE) events of nkeypresses key presses and releases, ordered by time.
+        Different seeds give different samples from the same typist'''
+        rng= np.random.RandomState( np.hstack((self.seed, seed)).astype(np.uint32) )
+        k= rng.choice( len(KEYS), nkeypresses, p=self.key_frequencies )
+        flight= np.maximum( 1, rng.normal(self.flight_mean[k], self.flight_stddev[k]) ).astype( np.int64 )
+        dwell=  np.maximum( 1, rng.normal(self.dwell_mean[k],  self.dwell_stddev[k]) ).astype( np.int64 )
+        press= start_time + np.cumsum( flight )
+        events= np.empty( 2*nkeypresses, dtype=KeystrokeCaptureData.EVENT_DTYPE )
+        events['key']= np.concatenate( (KEYS[k], KEYS[k]) )
+        events['event_type']= np.repeat( [KeypressEventReceiver.KEY_DOWN, KeypressEventReceiver.KEY_UP], nkeypresses )
+        events['time']= np.concatenate( (press, press+dwell) )
+        return events[ np.lexsort( (events['event_type'], events['time']) ) ]
+
+    def capture_data( self, nkeypresses, seed=0 ):
+        return KeystrokeCaptureData( self.events(nkeypresses, seed) )
+
+
+class SyntheticPopulation(object):
+    '''A sequence of nusers distinct SyntheticTypists, created on demand (so it scales to any nusers).
+    The population shares a (Zipf-like) key frequency distribution'''
+    def __init__(self, nusers, seed=0):
+        self.nusers= nusers
+        self.seed= seed
+        rng= np.random.RandomState( seed )
+        ranks= rng.permutation( len(KEYS) ) + 1
+        self.key_frequencies= (1.0/ranks) / np.sum(1.0/ranks)
+
+    def __len__( self ):
+        return self.nusers
+
+    def __getitem__( self, i ):
+        if not 0<=i<self.nusers:
+            raise IndexError( i )
+        return SyntheticTypist( [self.seed, i], self.key_frequencies )
+
+    def __iter__( self ):
+        for i in range(self.nusers):
+            yield self[i]
@@ -1,10 +1,36 @@
 import unittest
 import random
+import os
+import shutil
+import tempfile
+import struct
+import pickle
+import threading
+import subprocess
+import sys
+import time
+import math
+import numpy as np
 
-from ksdyn.core import KeystrokeCaptureData, KeypressEventReceiver as KER
-from ksdyn.sugar import create_fingerprint_from_capture_data
-from ksdyn.model import FingerprintDatabase
-from ksdyn import example
+from ksdyn import core
+from ksdyn.core import KeystrokeCaptureData, InsufficientData, DictTree, KeypressEventReceiver as KER
+from ksdyn.features import FeatureExtractor
+from ksdyn.sugar import create_fingerprint_from_capture_data, extract_features_from_capture_data
+from ksdyn.model import Fingerprint, FingerprintDatabase, FingerprintComparer, GaussianAnomalyModel, RobustAnomalyModel
+from ksdyn.matrix import FingerprintMatrix, MatrixFingerprintDatabase
+from ksdyn.index import IndexedFingerprintDatabase
+from ksdyn.continuous import SlidingWindowScorer
+from ksdyn.compact import CompactFingerprint
+from ksdyn.sketch import QuantileSketch
+from ksdyn.store import FingerprintStore, FingerprintDirectory
+from ksdyn.cache import ScoringCache
+from ksdyn.parallel import ParallelFingerprintDatabase, parallel_extract
+from ksdyn.capture_stream import CaptureStreamWriter, CaptureStreamReader
+from ksdyn.capture_buffer import RecordDecoder, KeycodeTable, EventRingBuffer, BufferedDispatcher
+from ksdyn.synthetic import SyntheticPopulation
+from ksdyn.pairwise import pairwise_similarities
+from ksdyn.service import ScoringService, ScoringClient, ServiceError, ServiceBusy, make_server
+from ksdyn import example, enroll, benchmark, instrumentation
 
 random.seed(0) #reproducible tests, at least for the same python version
 
@@ -33,6 +59,926 @@ class SystemTest(unittest.TestCase):
         self.assertEqual( db.best_match(f1), f1)
         self.assertEqual( db.best_match(f2), f2)
 
+class MatrixTest(unittest.TestCase):
+    def test_matrix_matches_comparer(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(5)]
+        for reducer in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            comparer= FingerprintComparer( reducer )
+            matrix= FingerprintMatrix( fs, reducer )
+            for probe in fs:
+                expected= [comparer.similarity(f, probe) for f in fs]
+                self.assertTrue( np.allclose( matrix.score(probe), expected, rtol=1e-12, atol=0 ) )
+        db= MatrixFingerprintDatabase( fingerprints=fs )
+        self.assertEqual( db.best_match(fs[3]), fs[3])
+
+    def test_growth(self):
+        f= create_fingerprint_from_capture_data( 'f', SyntheticKeystrokes() )
+        matrix= FingerprintMatrix()
+        for i in range(2000):
+            matrix.append( f )
+        rows, cols= matrix._means.shape
+        self.assertLessEqual( rows, 2*len(matrix) )
+        self.assertLessEqual( cols, 2*len(matrix.keys) )
+
+class IndexTest(unittest.TestCase):
+    def test_best_match_k(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(12)]
+        full= FingerprintDatabase( fingerprints=fs[:10] )
+        db= IndexedFingerprintDatabase( fingerprints=fs[:10], nlist=3 )
+        self.assertEqual( db.best_match_k(fs[4], k=3, nprobe=3), full.best_match_k(fs[4], k=3) )
+        self.assertEqual( db.best_match(fs[7]), fs[7] )
+        for f in fs[10:]:
+            db.enroll( f )
+        self.assertEqual( db.best_match(fs[11]), fs[11] )
+        self.assertEqual( db.best_match_k(fs[11], k=20, nprobe=3), FingerprintDatabase(fs).best_match_k(fs[11], k=20) )
+
+    def test_recall(self):
+        population= SyntheticPopulation( 1500, seed=2 )
+        fs= [Fingerprint.from_features( str(i), benchmark.extract_features(t, 1000) ) for i,t in enumerate(population)]
+        db= IndexedFingerprintDatabase( fingerprints=fs, nlist=39, nprobe=8 )
+        probes= [Fingerprint.from_features( 'p', benchmark.extract_features(population[i], 300, seed=1) ) for i in range(0, 1500, 15)]
+        candidates= [len(db.index.candidates(p)) for p in probes]
+        self.assertLess( np.mean(candidates), len(fs)/3 )
+        self.assertEqual( len(db.index.candidates( probes[0], nprobe=39 )), len(fs) )
+        recall= np.mean( [db.best_match(p) is fs[np.argmax(db.matrix.score(p))] for p in probes] )
+        self.assertGreaterEqual( recall, 0.95 )
+
+    def test_raw_probe(self):
+        keystrokes= [SyntheticKeystrokes() for _ in range(12)]
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks ) for i,ks in enumerate(keystrokes)]
+        db= IndexedFingerprintDatabase( fingerprints=fs, nlist=3, nprobe=1 )
+        for f, ks in zip( fs, keystrokes ):
+            probe= extract_features_from_capture_data( ks )
+            self.assertLess( len(db.index.candidates(probe)), len(fs) )
+            self.assertEqual( db.best_match_k( probe, k=3, nprobe=3 ), MatrixFingerprintDatabase(fs).best_match_k( probe, k=3 ) )
+
+class CaptureDataFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.filename= os.path.join( self.dir, 'user' )
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_binary_roundtrip(self):
+        ks= SyntheticKeystrokes()
+        ks.save_to_file( self.filename )
+        loaded= KeystrokeCaptureData.load_from_file( self.filename )
+        self.assertIsInstance( loaded.log, np.memmap )
+        self.assertEqual( loaded.log.tolist(), ks.log )
+        f1= create_fingerprint_from_capture_data( 'f', ks )
+        f2= create_fingerprint_from_capture_data( 'f', loaded )
+        self.assertEqual( sorted(f1.keys()), sorted(f2.keys()) )
+        self.assertEqual( [f1[k].mean for k in f1], [f2[k].mean for k in f1] )
+
+    def test_save_over_source(self):
+        ks= SyntheticKeystrokes()
+        ks.save_to_file( self.filename )
+        loaded= KeystrokeCaptureData.load_from_file( self.filename )
+        loaded.save_to_file( self.filename )
+        self.assertEqual( KeystrokeCaptureData.load_from_file( self.filename ).log.tolist(), ks.log )
+        self.assertEqual( os.listdir(self.dir), ['user'+KeystrokeCaptureData.FILE_EXTENSION] )
+
+    def test_legacy_format(self):
+        ks= SyntheticKeystrokes()
+        with open( self.filename+KeystrokeCaptureData.FILE_EXTENSION, 'wb' ) as f:
+            f.write( str(ks.log) )
+        self.assertEqual( KeystrokeCaptureData.load_from_file( self.filename ).log, ks.log )
+
+class FeatureExtractorChecks(object):
+    '''helpers of the FeatureExtractor tests (not a TestCase, so its subclasses don't run each other's tests)'''
+    def random_events(self, n=2000):
+        '''overlapping presses, repeated presses, releases without presses and long pauses'''
+        time= 0
+        events= []
+        for _ in range(n):
+            time+= random.choice( (0, random.randint(1,200), random.randint(400,700)) )
+            events.append( (random.randint(20,30), random.choice((KER.KEY_DOWN, KER.KEY_UP)), time) )
+        return events
+
+    def assertSameState(self, a, b):
+        for attr in ('dwell_times', 'flight_times_before', 'flight_times_after'):
+            self.assertEqual( dict(getattr(a, attr)), dict(getattr(b, attr)) )
+        self.assertEqual( (a.pt, a.pk, a.press_time), (b.pt, b.pk, b.press_time) )
+
+class BatchFeatureExtractorTest(FeatureExtractorChecks, unittest.TestCase):
+    def test_matches_on_key(self):
+        ks= KeystrokeCaptureData( self.random_events() )
+        sequential= ks.feed( FeatureExtractor() )
+        batch= FeatureExtractor()
+        batch.on_events( ks.events )
+        self.assertSameState( sequential, batch )
+        chunked= FeatureExtractor()
+        for i in range(0, len(ks.log), 333):
+            chunked.on_events( ks.events[i:i+333] )
+        self.assertSameState( sequential, chunked )
+
+class OnlineFitTest(unittest.TestCase):
+    def assertSameModels(self, f1, f2):
+        self.assertEqual( sorted(f1.keys()), sorted(f2.keys()) )
+        for k in f1:
+            self.assertEqual( f1[k].nsamples, f2[k].nsamples )
+            self.assertTrue( np.allclose( (f1[k].mean, f1[k].stddev), (f2[k].mean, f2[k].stddev), rtol=1e-12 ) )
+
+    def test_update(self):
+        ks= SyntheticKeystrokes()
+        half= len(ks.log)//2
+        first, second= KeystrokeCaptureData(ks.log[:half]), KeystrokeCaptureData(ks.log[half:])
+        full= create_fingerprint_from_capture_data( 'f', ks )
+        updated= create_fingerprint_from_capture_data( 'f', first )
+        updated.update( second.feed( FeatureExtractor() ).extract_features() )
+        self.assertSameModels( full, updated )
+
+    def test_merge(self):
+        a, b= GaussianAnomalyModel('a'), GaussianAnomalyModel('b')
+        a.fit( [10, 20, 30] )
+        b.fit( [40, 50] )
+        a.merge( b )
+        c= GaussianAnomalyModel.from_features( 'c', [10, 20, 30, 40, 50] )
+        self.assertEqual( a.nsamples, 5 )
+        self.assertAlmostEqual( a.mean, c.mean )
+        self.assertAlmostEqual( a.stddev, c.stddev )
+        a.partial_fit( [1] )
+        self.assertEqual( a.nsamples, 6 )
+        self.assertRaises( InsufficientData, GaussianAnomalyModel('d').partial_fit, [1] )
+
+class BatchPredictTest(unittest.TestCase):
+    @staticmethod
+    def reference(mean, stddev, x):
+        '''2*cdf(-|x-mean|/stddev) of the standard normal distribution, one sample at a time'''
+        return math.erfc( abs(x-mean) / (stddev*math.sqrt(2)) )
+
+    def test_predict_array(self):
+        models= [GaussianAnomalyModel.from_features( i, [random.randint(40,120) for _ in range(10)] ) for i in range(3)]
+        samples= np.array( [50, 80, 110, 2000] )
+        expected= [[self.reference(m.mean, m.stddev, x) for x in samples] for m in models]
+        for m, e in zip( models, expected ):
+            self.assertTrue( np.allclose( m.predict_array(samples), e, rtol=1e-12, atol=0 ) )
+            self.assertTrue( np.allclose( m.predict(samples), e, rtol=1e-12, atol=0 ) )
+        means, stddevs= np.array([m.mean for m in models]), np.array([m.stddev for m in models])
+        many= GaussianAnomalyModel.similarities( means[:,None], stddevs[:,None], samples[None,:] )
+        self.assertEqual( many.shape, (3, 4) )
+        self.assertTrue( np.allclose( many, expected, rtol=1e-12, atol=0 ) )
+        logs= models[0].predict_array( samples, log=True )
+        self.assertTrue( np.allclose( logs[:3], np.log(expected[0][:3]), rtol=1e-12, atol=0 ) )
+        self.assertEqual( models[0].predict(samples)[3], 0.0 )
+        self.assertTrue( np.isfinite( logs[3] ) )
+
+class SlidingWindowScorerTest(unittest.TestCase):
+    def test_matches_window_fingerprint(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(3)]
+        for reducer in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            emitted= []
+            scorer= SlidingWindowScorer( fs, emitted.append, window_size=60, emit_every=25, reducer=reducer )
+            SyntheticKeystrokes().feed( scorer )
+            self.assertEqual( len(emitted), 4 )
+            self.assertEqual( len(scorer.window), 60 )
+            window= FeatureExtractor()
+            for key, dwell_time in scorer.window:
+                window.dwell_times[key].append( dwell_time )
+            probe= Fingerprint.from_features( 'probe', window.extract_features() )
+            comparer= FingerprintComparer( reducer )
+            expected= [comparer.similarity(f, probe) for f in fs]
+            self.assertTrue( np.allclose( scorer.scores(), expected, rtol=1e-9 ) )
+
+class FingerprintStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.filename= os.path.join( self.dir, 'db'+FingerprintStore.FILE_EXTENSION )
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_store(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(4)]
+        store= FingerprintStore( self.filename )
+        store.put_many( fs )
+        store.put( fs[1] )
+        self.assertEqual( store.names(), ['f0', 'f1', 'f2', 'f3'] )
+        self.assertEqual( sorted(store.get('f2').keys()), sorted(fs[2].keys()) )
+        self.assertEqual( [f.name for f in store], store.names() )
+        self.assertRaises( KeyError, store.get, 'nobody' )
+        store.close()
+        db= FingerprintDatabase().load_from_store( self.filename, cache_size=2 )
+        self.assertEqual( db.best_match(fs[3]).name, 'f3' )
+        self.assertEqual( len(db.fingerprints.cache), 2 )
+
+    def test_matrix_from_store(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(20)]
+        FingerprintStore( self.filename ).put_many( fs )
+        db= MatrixFingerprintDatabase().load_from_store( self.filename, cache_size=5 )
+        matrix= db.matrix
+        self.assertEqual( db.best_match(fs[7]).name, 'f7' )
+        db.score( fs[12] )
+        self.assertIs( db.matrix, matrix )  #not rebuilt on cache misses
+
+class ParallelDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_same_as_serial(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(7)]
+        serial= FingerprintDatabase( fingerprints=fs )
+        with ParallelFingerprintDatabase( fs[:5], workers=3, chunk_size=2 ) as db:
+            for f in fs[5:]:
+                db.enroll( f )
+            self.assertEqual( db.score(fs[2]), serial.score(fs[2]) )
+        for f in fs:
+            f.save_to_file( os.path.join(self.dir, f.name) )
+        with ParallelFingerprintDatabase( workers=2, chunk_size=3 ).load_from_dir( self.dir ) as db:
+            self.assertEqual( db.score(fs[6]), serial.score(fs[6]) )
+            self.assertEqual( db.best_match(fs[6]).name, 'f6' )
+
+    def test_file_added_while_loading(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(4)]
+        for f in fs:
+            f.save_to_file( os.path.join(self.dir, f.name) )
+        names= FingerprintDirectory.names
+        def names_then_add( fingerprint_dir ):
+            result= names( fingerprint_dir )
+            fs[0].save_to_file( os.path.join(self.dir, 'a') )   #sorts before the others
+            return result
+        FingerprintDirectory.names= names_then_add
+        try:
+            db= ParallelFingerprintDatabase( workers=2, chunk_size=1 ).load_from_dir( self.dir )
+        finally:
+            FingerprintDirectory.names= names
+        with db:
+            self.assertEqual( [f.name for f in db.fingerprints], ['f0', 'f1', 'f2', 'f3'] )
+            self.assertEqual( db.best_match(fs[2]).name, 'f2' )
+
+    def test_concurrent_scoring(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(6)]
+        expected= FingerprintDatabase( fingerprints=fs ).score
+        results= []
+        with ParallelFingerprintDatabase( fs, workers=2, chunk_size=2 ) as db:
+            def score( f ):
+                for _ in range(20):
+                    results.append( db.score(f)==expected(f) )
+            threads= [threading.Thread( target=score, args=(f,) ) for f in fs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual( results, [True]*120 )
+
+class BulkEnrollmentTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_enroll(self):
+        for i in range(3):
+            SyntheticKeystrokes().save_to_file( os.path.join(self.dir, 'u{}'.format(i)) )
+        with open( os.path.join(self.dir, 'broken'+KeystrokeCaptureData.FILE_EXTENSION), 'wb' ) as f:
+            f.write( 'garbage' )
+        report= enroll.enroll( enroll.capture_filenames(self.dir), self.dir, workers=2 )
+        self.assertEqual( (report.enrolled, report.skipped, list(report.failed)), (3, 0, ['broken']) )
+        self.assertEqual( sorted(Fingerprint.load_from_dir(self.dir)), ['u0', 'u1', 'u2'] )
+        report= enroll.enroll( enroll.capture_filenames(self.dir), self.dir, workers=2 )
+        self.assertEqual( (report.enrolled, report.skipped), (0, 3) )
+
+class SyntheticPopulationTest(unittest.TestCase):
+    def test_population(self):
+        population= SyntheticPopulation( 20, seed=1 )
+        self.assertEqual( population[3].events(50).tolist(), SyntheticPopulation( 20, seed=1 )[3].events(50).tolist() )
+        events= population[3].events( 500 )
+        self.assertEqual( len(events), 1000 )
+        self.assertTrue( np.all( np.diff(events['time'])>=0 ) )
+        fingerprints= [Fingerprint.from_features( i, benchmark.extract_features(t, 500) ) for i,t in enumerate(population)]
+        db= MatrixFingerprintDatabase( fingerprints )
+        for i in (0, 7, 19):
+            probe= Fingerprint.from_features( 'probe', benchmark.extract_features(population[i], 500, seed=1) )
+            self.assertEqual( db.best_match(probe), fingerprints[i] )
+
+class InstrumentationTest(unittest.TestCase):
+    def test_snapshot(self):
+        original= FeatureExtractor.__dict__['on_key']
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(3)]
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            self.assertIsNot( FeatureExtractor.__dict__['on_key'], original )
+            SyntheticKeystrokes().feed( FeatureExtractor() )
+            FingerprintDatabase( fs ).best_match( fs[1] )
+        finally:
+            instrumentation.disable()
+        self.assertIs( FeatureExtractor.__dict__['on_key'], original )
+        snapshot= instrumentation.snapshot()
+        self.assertEqual( snapshot['histograms']['features.on_key']['count'], 200 )
+        self.assertEqual( snapshot['counters']['comparer.fingerprint_similarity'], 3 )
+        for name in ('core.intersect', 'core.map', 'core.similarity', 'comparer.reducer', 'database.score'):
+            self.assertIn( name, snapshot['histograms'] )
+        SyntheticKeystrokes().feed( FeatureExtractor() )
+        self.assertEqual( instrumentation.snapshot(), snapshot )
+
+class CaptureBufferTest(unittest.TestCase):
+    class FakeEvent(object):
+        format= struct.Struct( '<BBI' )   #type, detail (keycode), time
+        def __init__(self, data):
+            self.type, self.detail, self.time= self.format.unpack( data[:self.format.size] )
+
+        @classmethod
+        def parse(cls, data):
+            return cls(data), data[cls.format.size:]
+
+    class FakeReply(object):
+        category, client_swapped= 0, False
+        def __init__(self, events):
+            self.data= ''.join( CaptureBufferTest.FakeEvent.format.pack(*e) for e in events )
+
+    def test_decoder(self):
+        decoder= RecordDecoder( self.FakeEvent.parse )
+        reply= self.FakeReply( [(2, 25, 10), (6, 0, 11), (3, 25, 50), (2, 9, 60), (3, 26, 70)] )
+        events, stop= decoder.decode( reply )
+        self.assertEqual( events, [(25, KER.KEY_DOWN, 10), (25, KER.KEY_UP, 50)] )
+        self.assertTrue( stop )
+        self.assertEqual( decoder.decode( self.FakeReply( [(3, 26, 70)] ) ), ([(26, KER.KEY_UP, 70)], False) )
+
+    def test_keycode_table(self):
+        class FakeXK(object):
+            XK_a, XK_A, XK_b= 97, 97, 98
+        class FakeDisplay(object):
+            def keycode_to_keysym(self, keycode, index):
+                return {38: 97, 56: 98, 57: 12345}.get( keycode, 0 )
+        table= KeycodeTable.from_display( FakeDisplay(), FakeXK )
+        self.assertEqual( [table.lookup(k) for k in (38, 56, 57, 10)], ['A', 'b', '[12345]', None] )
+
+    def test_ring_buffer(self):
+        buffer= EventRingBuffer( 4 )
+        for i in range(6):
+            buffer.push( 25, i%2, i )
+        self.assertEqual( buffer.overflows, 2 )
+        self.assertEqual( buffer.pop_batch( 3 )['time'].tolist(), [0, 1, 2] )
+        buffer.push( 25, 0, 10 )
+        self.assertEqual( buffer.pop_batch( timeout=0 )['time'].tolist(), [3, 10] )
+        self.assertEqual( len(buffer.pop_batch( timeout=0 )), 0 )
+
+    def test_dispatcher(self):
+        capture= SyntheticKeystrokes()
+        buffer= EventRingBuffer( len(capture.log) )
+        fe, reference= FeatureExtractor(), FeatureExtractor()
+        dispatcher= BufferedDispatcher( buffer, [fe], batch_size=7 )
+        dispatcher.start()
+        for event in capture.log:
+            buffer.push( *event )
+        dispatcher.stop()
+        capture.feed( reference )
+        self.assertEqual( dispatcher.delivered, len(capture.log) )
+        self.assertEqual( fe.dwell_times, reference.dwell_times )
+
+
+class CaptureStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.filename= os.path.join( self.dir, 'user' )
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_stream(self):
+        ks= SyntheticKeystrokes()
+        half= len(ks.log)//2
+        with CaptureStreamWriter( self.filename, chunk_size=16 ) as writer:
+            ks.feed( writer )
+            self.assertEqual( writer.chunks, len(ks.log)//16 )
+        #a crash in the middle of a chunk
+        with open( writer.filename, 'ab' ) as f:
+            f.write( 'KSCK\x10\x00' )
+        reader= CaptureStreamReader( self.filename )
+        self.assertEqual( list(reader), ks.log )
+        self.assertEqual( reader.feed( FeatureExtractor() ).dwell_times, ks.feed( FeatureExtractor() ).dwell_times )
+        with CaptureStreamWriter( self.filename, chunk_size=16 ) as writer:
+            writer.on_events( ks.events[:half] )
+        self.assertEqual( reader.to_capture_data().log.tolist(), ks.log+ks.log[:half] )
+
+    def test_idle_flush(self):
+        ks= SyntheticKeystrokes()
+        with CaptureStreamWriter( self.filename, chunk_size=4096, flush_interval=0.2 ) as writer:
+            for event in ks.log[:10]:
+                writer.on_key( *event )
+            writer.on_events( ks.events[10:20] )
+            self.assertEqual( writer.written, 0 )
+            for _ in range(200):    #no more events: the timer flushes them
+                if writer.written:
+                    break
+                time.sleep( 0.01 )
+            self.assertEqual( writer.written, 20 )
+            self.assertEqual( list(CaptureStreamReader( self.filename )), ks.log[:20] )
+
+class CompactFingerprintTest(unittest.TestCase):
+    def test_roundtrip_and_similarity(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(4)]
+        compact= [CompactFingerprint.from_fingerprint( f ) for f in fs]
+        c= compact[0]
+        self.assertEqual( sorted(c.keys.tolist()), c.keys.tolist() )
+        self.assertEqual( CompactFingerprint.from_fingerprint( c.to_fingerprint() ), c )
+        self.assertEqual( pickle.loads( pickle.dumps(c, pickle.HIGHEST_PROTOCOL) ), c )
+        self.assertEqual( pickle.loads( pickle.dumps(c) ), c )
+        unpacked= c.to_fingerprint()
+        self.assertEqual( sorted(unpacked.keys()), sorted(fs[0].keys()) )
+        self.assertEqual( [unpacked[k].nsamples for k in fs[0]], [fs[0][k].nsamples for k in fs[0]] )
+        for reducer in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            comparer= FingerprintComparer( reducer )
+            for a, ca in zip(fs, compact):
+                for b, cb in zip(fs, compact):
+                    self.assertTrue( np.isclose( comparer.similarity(ca, cb), comparer.similarity(a, b), rtol=1e-5, atol=0 ) )
+        self.assertEqual( FingerprintDatabase( compact ).best_match( compact[2] ), compact[2] )
+        #mixed with plain fingerprints and raw features
+        comparer= FingerprintComparer()
+        self.assertTrue( np.isclose( comparer.similarity(compact[0], fs[1]), comparer.similarity(fs[0], fs[1]), rtol=1e-5, atol=0 ) )
+        self.assertTrue( np.isclose( comparer.similarity(fs[1], compact[0]), comparer.similarity(fs[1], fs[0]), rtol=1e-5, atol=0 ) )
+        self.assertEqual( FingerprintDatabase( compact ).best_match( fs[3] ), compact[3] )
+        raw= extract_features_from_capture_data( SyntheticKeystrokes() )
+        self.assertTrue( np.isclose( comparer.similarity(compact[0], raw), comparer.similarity(fs[0], raw), rtol=1e-4, atol=0 ) )
+        self.assertRaises( TypeError, comparer.similarity, "f0", fs[0] )
+
+class DigraphTest(unittest.TestCase):
+    @staticmethod
+    def capture(keys, n_keypresses=200):
+        '''random keypresses of a few keys, so that digraphs repeat'''
+        ks= KeystrokeCaptureData()
+        time= 0
+        for _ in range(n_keypresses):
+            keycode= random.choice( keys )
+            ks.on_key( keycode, KER.KEY_DOWN, time )
+            time+= random.randint(40,120)
+            ks.on_key( keycode, KER.KEY_UP, time )
+            time+= random.randint(0,80)
+        return ks
+
+    def test_bounded_store(self):
+        fe= FeatureExtractor( max_digraphs=5, max_digraph_samples=3 )
+        for previous_key, key in [(1,2)]*10 + [(3,4), (5,6), (7,8), (9,10), (11,12), (13,14)]:
+            fe.digraphs.add( previous_key, key, 100 )
+        self.assertEqual( len(fe.digraphs.counts), 5 )
+        self.assertEqual( fe.digraphs.evictions, 2 )
+        self.assertEqual( fe.digraphs.counts[(1,2)], 10 )
+        self.assertEqual( len(fe.digraphs.times[(1,2)]), 3 )
+        #the least frequent digraph is evicted, the oldest one among ties
+        for previous_key, key in [(3,4), (5,6), (5,6), (15,16)]:
+            fe.digraphs.add( previous_key, key, 100 )
+        self.assertEqual( sorted(fe.digraphs.counts), [(1,2), (3,4), (5,6), (13,14), (15,16)] )
+        self.assertEqual( sorted(fe.digraphs.counts.values()), [2, 2, 3, 3, 10] )
+
+    def test_fingerprints(self):
+        captures= [self.capture( range(25,29) ) for i in range(4)]
+        batch, sequential= FeatureExtractor( max_digraphs=20 ), FeatureExtractor( max_digraphs=20 )
+        batch.on_events( captures[0].events )
+        captures[0].feed( sequential )
+        self.assertEqual( batch.digraphs.times, sequential.digraphs.times )
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks, max_digraphs=20 ) for i,ks in enumerate(captures)]
+        digraphs= [path for path,_ in fs[0].leaves() if path[0]=='digraphs']
+        self.assertTrue( 0 < len(digraphs) <= 20 )
+        flat= create_fingerprint_from_capture_data( 'flat', captures[0] )
+        comparer= FingerprintComparer()
+        self.assertEqual( comparer.similarity(flat, fs[0]), comparer.similarity(flat, flat) )
+        common, _= DictTree.intersect( fs[0], fs[0] )
+        self.assertEqual( sorted(common['digraphs'].keys()), sorted(fs[0]['digraphs'].keys()) )
+        self.assertNotIn( 'digraphs', DictTree.intersect( fs[0], flat )[0] )
+        matrix= FingerprintMatrix( fs )
+        expected= [comparer.similarity(f, fs[1]) for f in fs]
+        self.assertTrue( np.allclose( matrix.score(fs[1]), expected, rtol=1e-12, atol=0 ) )
+        compact= CompactFingerprint.from_fingerprint( fs[2] )
+        self.assertEqual( sorted(p for p,_ in compact.to_fingerprint().leaves()), sorted(p for p,_ in fs[2].leaves()) )
+        self.assertEqual( FingerprintDatabase( fs ).best_match( fs[3] ), fs[3] )
+
+    def test_update_budget(self):
+        fingerprint= create_fingerprint_from_capture_data( 'f', self.capture( range(25,31) ), max_digraphs=8 )
+        for _ in range(5):
+            fingerprint.update( extract_features_from_capture_data( self.capture( range(25,31) ), max_digraphs=8 ) )
+            modelled= fingerprint.get( 'digraphs', {} ).keys()
+            pending= [path for path in fingerprint.pending_moments if path[0]=='digraphs']
+            self.assertTrue( 0 < len(modelled) )
+            self.assertLessEqual( len(modelled) + len(pending), 8 )
+        #no empty parents for paths that never got a model
+        fingerprint= Fingerprint.from_features( 'g', extract_features_from_capture_data( self.capture( range(25,31) ) ) )
+        fingerprint.update( extract_features_from_capture_data( KeystrokeCaptureData( self.capture( range(25,31) ).log[:6] ), max_digraphs=8 ) )
+        self.assertNotIn( 'digraphs', fingerprint )
+
+class ScoringServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.captures= [SyntheticKeystrokes() for i in range(5)]
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks ) for i,ks in enumerate(self.captures)]
+        self.db= MatrixFingerprintDatabase( fs )
+        self.service= ScoringService( self.db, max_sessions=2, max_session_events=300 ).start()
+        self.server= make_server( self.service, os.path.join(self.dir, 'socket') )
+        thread= threading.Thread( target=self.server.serve_forever )
+        thread.daemon= True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.stop()
+        shutil.rmtree( self.dir )
+
+    def test_score_many(self):
+        fs= self.db.fingerprints
+        self.assertTrue( np.allclose( self.db.score_many(fs[:3]), [self.db.score(f) for f in fs[:3]], rtol=1e-12, atol=0 ) )
+
+    def test_sessions(self):
+        with ScoringClient( self.server.server_address ) as client:
+            client.open_session( 'a' )
+            client.open_session( 'b' )
+            self.assertRaises( ServiceBusy, client.open_session, 'c' )
+            self.assertRaises( ServiceError, client.identify, 'a' )
+            self.assertEqual( client.send_events( 'a', self.captures[3].log ), 200 )
+            client.send_events( 'b', self.captures[1].events )
+            self.assertEqual( client.identify( 'a', k=2 )[0][0], 'f3' )
+            self.assertEqual( client.verify( 'b', 'f1' )[1], 0 )
+            self.assertNotEqual( client.verify( 'b', 'f3' )[1], 0 )
+            self.assertRaises( ServiceBusy, client.send_events, 'a', self.captures[3].log[:201] )
+            client.close_session( 'a' )
+            self.assertEqual( client.stats()['sessions'], 1 )
+
+class PairwiseSimilaritiesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.filename= os.path.join( self.dir, 'pairs.npy' )
+        self.fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(7)]
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_pairwise(self):
+        for reducer in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            comparer= FingerprintComparer( reducer )
+            expected= [[comparer.similarity(a, b) for b in self.fs] for a in self.fs]
+            result= pairwise_similarities( self.fs, self.filename, reducer, workers=2, block_size=3 )
+            self.assertTrue( np.allclose( result, expected, rtol=1e-12, atol=0 ) )
+            os.remove( self.filename )
+
+    def test_resume(self):
+        full= np.array( pairwise_similarities( self.fs, self.filename, workers=1, block_size=3 ) )
+        progress= np.load( self.filename+'.progress.npy', mmap_mode='r+' )
+        progress[0, 2]= progress[1, 1]= 0
+        progress.flush()
+        out= np.load( self.filename, mmap_mode='r+' )
+        out[3:6, 3:6]= out[0:3, 6:]= out[6:, 0:3]= -1
+        out.flush()
+        del progress, out
+        self.assertTrue( np.array_equal( pairwise_similarities( self.fs, self.filename, workers=1, block_size=3 ), full ) )
+        self.assertRaises( ValueError, pairwise_similarities, self.fs[:6], self.filename, block_size=3 )
+
+class BranchAndBoundTest(unittest.TestCase):
+    def test_same_as_full_scan(self):
+        population= SyntheticPopulation( 200, seed=3 )
+        fs= [Fingerprint.from_features( str(i), benchmark.extract_features(t, 1000) ) for i,t in enumerate(population)]
+        db= MatrixFingerprintDatabase( fs )
+        stats= {}
+        for user in range(0, 200, 20):
+            probe= Fingerprint.from_features( 'probe', benchmark.extract_features(population[user], 200, seed=1) )
+            for k in (0, 1, 3, 250):
+                self.assertEqual( db.best_match_k(probe, k, stats), FingerprintDatabase.best_match_k(db, probe, k) )
+            self.assertEqual( db.best_match(probe), FingerprintDatabase.best_match(db, probe) )
+        self.assertGreater( stats['pruned'], 0 )
+        self.assertLess( stats['similarities'], stats['full_similarities'] )
+        mean_db= MatrixFingerprintDatabase( fs, FingerprintComparer(FingerprintComparer._mean_reducer) )
+        self.assertEqual( mean_db.best_match_k(fs[5], 3), FingerprintDatabase.best_match_k(mean_db, fs[5], 3) )
+
+class LightImportTest(unittest.TestCase):
+    def test_lazy_import(self):
+        script= "import sys, ksdyn; assert 'ksdyn.model' not in sys.modules and 'scipy' not in sys.modules; ksdyn.model.Fingerprint"
+        subprocess.check_call( [sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(core.__file__))) )
+
+    def test_erfc_ndtr(self):
+        try:
+            import scipy.special
+        except ImportError:
+            self.skipTest( "scipy not available" )
+        x= np.concatenate( (-np.logspace(-3, 3, 500), np.linspace(-30, 10, 500), np.logspace(-3, 1.5, 100)) )
+        normal= x>-30    #not subnormal
+        self.assertTrue( np.allclose( core.erfc_ndtr(x[normal]), scipy.special.ndtr(x[normal]), rtol=1e-12, atol=0 ) )
+        negative= x<=0
+        self.assertTrue( np.allclose( core.erfc_log_ndtr(x[negative]), scipy.special.log_ndtr(x[negative]), rtol=1e-12, atol=0 ) )
+        #some scipy versions lose precision for 5<x<6
+        reference= [np.log1p( -0.5*math.erfc(v/math.sqrt(2)) ) for v in x[~negative]]
+        self.assertTrue( np.allclose( core.erfc_log_ndtr(x[~negative]), reference, rtol=1e-12, atol=0 ) )
+        self.assertTrue( np.allclose( core.erfc_ndtr(x[normal]), [0.5*math.erfc(-v/math.sqrt(2)) for v in x[normal]], rtol=1e-13, atol=0 ) )
+        self.assertEqual( core.erfc_log_ndtr(0.0), np.log(0.5) )
+        self.assertEqual( core.erfc_ndtr(np.zeros((2,3))).shape, (2,3) )
+
+class MergeFeatureExtractorTest(FeatureExtractorChecks, unittest.TestCase):
+    def chunks(self, events, n):
+        cuts= sorted( random.sample( range(1, len(events)), n-1 ) )
+        return [events[a:b] for a,b in zip( [0]+cuts, cuts+[len(events)] )]
+
+    def extractors(self, chunks, batch=True):
+        extractors= [FeatureExtractor()] + [FeatureExtractor.for_chunk() for _ in chunks[1:]]
+        for extractor, chunk in zip( extractors, chunks ):
+            if batch:
+                extractor.on_events( chunk )
+            else:
+                KeystrokeCaptureData( chunk.tolist() ).feed( extractor )
+        return extractors
+
+    def test_merge(self):
+        events= KeystrokeCaptureData( self.random_events() ).events
+        sequential= FeatureExtractor()
+        sequential.on_events( events )
+        for n in (2, 7, 50):
+            chunks= self.chunks( events, n )
+            self.assertSameState( sequential, reduce( FeatureExtractor.merge, self.extractors(chunks) ) )
+            self.assertSameState( sequential, reduce( FeatureExtractor.merge, self.extractors(chunks, batch=False) ) )
+            #merging is associative: chunks can be merged in any tree
+            extractors= self.extractors( chunks )
+            tail= reduce( FeatureExtractor.merge, extractors[n//2:] )
+            self.assertSameState( sequential, reduce( FeatureExtractor.merge, extractors[:n//2] ).merge( tail ) )
+
+    def test_merge_errors(self):
+        self.assertRaises( ValueError, FeatureExtractor().merge, FeatureExtractor() )
+        self.assertRaises( NotImplementedError, FeatureExtractor( max_digraphs=8 ).merge, FeatureExtractor.for_chunk() )
+
+    def test_parallel_extract(self):
+        events= KeystrokeCaptureData( self.random_events(5000) ).events
+        sequential= FeatureExtractor()
+        sequential.on_events( events )
+        self.assertSameState( sequential, parallel_extract( events, workers=1, nchunks=5 ) )
+        self.assertSameState( sequential, parallel_extract( events, workers=3 ) )
+
+
+class FeatureScoringTest(unittest.TestCase):
+    def test_features_match_comparer(self):
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), SyntheticKeystrokes() ) for i in range(5)]
+        probe= extract_features_from_capture_data( KeystrokeCaptureData( SyntheticKeystrokes().log[:40] ) )
+        #keys with a single sample have no model in a probe fingerprint, but are scored as features
+        single= [path for path,f in probe.leaves() if len(f.data)==1]
+        self.assertTrue( single )
+        self.assertFalse( set(single) & set( path for path,_ in Fingerprint.from_features('p', probe).leaves() ) )
+        for reducer in (FingerprintComparer._multiplication_reducer, FingerprintComparer._mean_reducer):
+            comparer= FingerprintComparer( reducer )
+            expected= [comparer.similarity(f, probe) for f in fs]
+            self.assertTrue( all( 0<e<=1 for e in expected ) )
+            matrix= FingerprintMatrix( fs, reducer )
+            self.assertTrue( np.allclose( matrix.score(probe), expected, rtol=1e-12, atol=0 ) )
+            self.assertTrue( np.allclose( matrix.score_many([fs[0], probe])[1], expected, rtol=1e-12, atol=0 ) )
+            blocked= matrix.feature_similarities( probe, max_block=1 )
+            self.assertTrue( np.allclose( blocked[0], matrix.feature_similarities(probe)[0], rtol=1e-12, atol=0 ) )
+            self.assertTrue( np.allclose( matrix.score_many([probe], max_block=50)[0], expected, rtol=1e-12, atol=0 ) )
+            self.assertTrue( np.allclose( matrix.score(probe, [3,1]), [expected[3], expected[1]], rtol=1e-12, atol=0 ) )
+        model= fs[0].values()[0]
+        self.assertAlmostEqual( FingerprintComparer.samples_similarity( model, [model.mean] ), 1.0 )
+
+    def test_identification(self):
+        keystrokes= [SyntheticKeystrokes() for _ in range(5)]
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks ) for i,ks in enumerate(keystrokes)]
+        db= MatrixFingerprintDatabase( fingerprints=fs )
+        for f, ks in zip( fs, keystrokes ):
+            self.assertEqual( db.best_match( extract_features_from_capture_data(ks) ), f )
+        self.assertEqual( FingerprintComparer().similarity( fs[0], extract_features_from_capture_data(KeystrokeCaptureData()) ), 0.0 )
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def test_sketch(self):
+        samples= np.random.RandomState(0).lognormal( 4.5, 0.4, 100000 )
+        qs= (0.01, 0.25, 0.5, 0.75, 0.99)
+        expected= np.percentile( samples, [q*100 for q in qs] )
+        sketch= QuantileSketch()
+        sketch.extend( samples )
+        self.assertEqual( sketch.count, len(samples) )
+        self.assertTrue( np.allclose( sketch.quantiles(qs), expected, rtol=0.01 ) )
+        self.assertLessEqual( len(sketch.means), sketch.compression )
+        #merging sketches of parts of the samples
+        merged= QuantileSketch()
+        for part in np.array_split( samples, 7 ):
+            other= QuantileSketch()
+            for x in part[:100]:
+                other.append( x )
+            other.extend( part[100:] )
+            merged.merge( other )
+        self.assertEqual( merged.count, len(samples) )
+        self.assertTrue( np.allclose( merged.quantiles(qs), expected, rtol=0.01 ) )
+        restored= pickle.loads( pickle.dumps(merged, 2) )
+        self.assertTrue( np.array_equal( restored.quantiles(qs), merged.quantiles(qs) ) )
+        small= QuantileSketch()
+        small.extend( [3, 1, 2] )
+        self.assertEqual( (small.quantile(0), small.quantile(0.5), small.quantile(1)), (1, 2, 3) )
+        self.assertRaises( ValueError, QuantileSketch().quantile, 0.5 )
+
+    def test_robust_model(self):
+        samples= list( np.random.RandomState(1).normal( 100, 10, 2000 ) )
+        gaussian= GaussianAnomalyModel.from_features( 'k', samples + [5000]*20 )
+        robust= RobustAnomalyModel.from_features( 'k', samples + [5000]*20 )
+        self.assertAlmostEqual( robust.mean, 100, delta=1 )
+        self.assertAlmostEqual( robust.stddev, 10, delta=1 )
+        self.assertGreater( gaussian.stddev, 50 )
+        half= RobustAnomalyModel.from_features( 'k', samples[:1000] )
+        half.merge( RobustAnomalyModel.from_features( 'k', samples[1000:] ) )
+        self.assertEqual( half.nsamples, len(samples) )
+        self.assertAlmostEqual( half.mean, np.median(samples), delta=0.5 )
+        self.assertRaises( InsufficientData, RobustAnomalyModel.from_features, 'k', [1] )
+
+    def test_sketched_fingerprint(self):
+        ks= SyntheticKeystrokes()
+        extractor= FeatureExtractor( sketch_compression=20 )
+        extractor.on_events( ks.events )
+        exact= FeatureExtractor()
+        exact.on_events( ks.events )
+        for key, times in exact.dwell_times.items():
+            self.assertEqual( extractor.dwell_times[key].count, len(times) )
+            self.assertAlmostEqual( extractor.dwell_times[key].quantile(0.5), np.median(times) )
+        full= create_fingerprint_from_capture_data( 'f', ks, sketch_compression=20 )
+        self.assertTrue( all( isinstance(m, RobustAnomalyModel) for _,m in full.leaves() ) )
+        #updating with the features of later sessions
+        half= len(ks.log)//2
+        updated= create_fingerprint_from_capture_data( 'f', KeystrokeCaptureData(ks.log[:half]), sketch_compression=20 )
+        updated.update( extract_features_from_capture_data( KeystrokeCaptureData(ks.log[half:]), sketch_compression=20 ) )
+        self.assertEqual( sorted( (p, m.nsamples) for p,m in full.leaves() ), sorted( (p, m.nsamples) for p,m in updated.leaves() ) )
+        self.assertEqual( FingerprintDatabase( [full, create_fingerprint_from_capture_data('g', SyntheticKeystrokes())] ).best_match( updated ), full )
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.dir= tempfile.mkdtemp()
+        self.fingerprints= [create_fingerprint_from_capture_data( 'u{}'.format(i), SyntheticKeystrokes() ) for i in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def save(self, fingerprint, mtime):
+        fingerprint.save_to_file( os.path.join(self.dir, fingerprint.name) )
+        os.utime( os.path.join(self.dir, fingerprint.name+Fingerprint.FILE_EXTENSION), (mtime, mtime) )
+
+    def assertSameScores(self, db):
+        expected= MatrixFingerprintDatabase( db.fingerprints )
+        for probe in self.fingerprints:
+            self.assertTrue( np.allclose( db.score(probe), expected.score(probe), rtol=1e-12, atol=0 ) )
+
+    def test_refresh(self):
+        for f in self.fingerprints[:4]:
+            self.save( f, 1000 )
+        for db in (FingerprintDatabase(), MatrixFingerprintDatabase(), IndexedFingerprintDatabase( nlist=2, nprobe=2 )):
+            db.load_from_dir( self.dir )
+            matrix= getattr( db, 'matrix', None )
+            self.assertEqual( sorted(f.name for f in db.fingerprints), ['u0', 'u1', 'u2', 'u3'] )
+            self.assertEqual( db.refresh(self.dir), {'added': [], 'updated': [], 'removed': [], 'failed': []} )
+            self.assertEqual( len(db.fingerprints), 4 )
+            db.enroll( self.fingerprints[5] )   #not from the directory: kept
+            #re-enrollment, new user, deleted user and a file being written
+            replacement= create_fingerprint_from_capture_data( 'u1', SyntheticKeystrokes() )
+            self.save( replacement, 2000 )
+            self.save( self.fingerprints[4], 1000 )
+            os.remove( os.path.join(self.dir, 'u2'+Fingerprint.FILE_EXTENSION) )
+            with open( os.path.join(self.dir, 'partial'+Fingerprint.FILE_EXTENSION), 'wb' ) as f:
+                f.write( pickle.dumps(replacement)[:100] )
+            report= db.refresh( self.dir )
+            self.assertEqual( report, {'added': ['u4'+Fingerprint.FILE_EXTENSION], 'updated': ['u1'+Fingerprint.FILE_EXTENSION],
+                'removed': ['u2'+Fingerprint.FILE_EXTENSION], 'failed': ['partial'+Fingerprint.FILE_EXTENSION]} )
+            self.assertEqual( [f.name for f in db.fingerprints], ['u0', 'u1', 'u3', 'u5', 'u4'] )
+            self.assertIs( db.fingerprints[1], db.best_match( replacement ) )
+            if matrix is not None:
+                self.assertIs( db.matrix, matrix )  #updated in place
+                self.assertSameScores( db )
+            if isinstance( db, IndexedFingerprintDatabase ):
+                rows= sorted( r for rows in db.index.lists + [db.index.unassigned] for r in rows )
+                self.assertEqual( rows, range(len(db.fingerprints)) )
+            #restore the directory for the next database
+            self.save( self.fingerprints[1], 1000 )
+            self.save( self.fingerprints[2], 1000 )
+            os.remove( os.path.join(self.dir, 'u4'+Fingerprint.FILE_EXTENSION) )
+            os.remove( os.path.join(self.dir, 'partial'+Fingerprint.FILE_EXTENSION) )
+        db= IndexedFingerprintDatabase( self.fingerprints, nlist=2, nprobe=2 )
+        index= db.index
+        db.remove( [1, 3] )
+        db.replace( 0, self.fingerprints[1] )
+        self.assertIs( db.index, index )
+        self.assertEqual( sorted( r for rows in index.lists for r in rows ), range(4) )
+        self.assertEqual( [db.best_match(f).name for f in self.fingerprints[4:]], ['u4', 'u5'] )
+        self.assertSameScores( db )
+
+    def test_indexed_load(self):
+        for i in range(30):
+            self.save( create_fingerprint_from_capture_data( 'v{}'.format(i), SyntheticKeystrokes() ), 1000 )
+        db= IndexedFingerprintDatabase( nprobe=1 ).load_from_dir( self.dir )
+        self.assertEqual( len(db.index.centroids), 6 )
+        self.assertEqual( db.index.unassigned, [] )
+        self.assertLess( len(db.index.candidates(db.fingerprints[0])), len(db.fingerprints) )
+        index= db.index
+        for f in self.fingerprints:
+            db.enroll( f )
+        self.assertIs( db.index, index )
+        self.assertEqual( len(index.centroids), 6 )     #not retrained
+        self.assertEqual( sorted( r for rows in index.lists for r in rows ), range(36) )
+
+    def test_unsupported(self):
+        for f in self.fingerprints[:3]:
+            self.save( f, 1000 )
+        with ParallelFingerprintDatabase( workers=2 ).load_from_dir( self.dir ) as db:
+            self.assertRaises( NotImplementedError, db.refresh, self.dir )
+            self.assertEqual( len(db.fingerprints), 3 )
+        filename= os.path.join( self.dir, 'db'+FingerprintStore.FILE_EXTENSION )
+        FingerprintStore( filename ).put_many( self.fingerprints[3:] )
+        for cls in (FingerprintDatabase, MatrixFingerprintDatabase):
+            db= cls().load_from_store( filename )
+            self.assertRaises( NotImplementedError, db.refresh, self.dir )
+            self.assertEqual( [f.name for f in db.fingerprints], ['u3', 'u4', 'u5'] )
+
+    def test_several_directories(self):
+        other= tempfile.mkdtemp()
+        try:
+            for f in self.fingerprints[:3]:
+                self.save( f, 1000 )
+            self.fingerprints[3].name= 'u0'     #same file name, other user
+            self.fingerprints[3].save_to_file( os.path.join(other, 'u0') )
+            db= FingerprintDatabase().load_from_dir( self.dir ).load_from_dir( other )
+            self.assertEqual( [f.name for f in db.fingerprints], ['u0', 'u1', 'u2', 'u0'] )
+            self.assertEqual( db.refresh(self.dir), {'added': [], 'updated': [], 'removed': [], 'failed': []} )
+            os.remove( os.path.join(self.dir, 'u1'+Fingerprint.FILE_EXTENSION) )
+            self.assertEqual( db.refresh(self.dir)['removed'], ['u1'+Fingerprint.FILE_EXTENSION] )
+            self.assertEqual( db.refresh(other)['removed'], [] )
+            hashes= lambda fs: [f.content_hash() for f in fs]
+            self.assertEqual( hashes(db.fingerprints), hashes(self.fingerprints[i] for i in (0,2,3)) )
+        finally:
+            shutil.rmtree( other )
+
+    def test_concurrent_refresh(self):
+        db= MatrixFingerprintDatabase().load_from_dir( self.dir )
+        db.enroll( self.fingerprints[0] )
+        errors= []
+        done= threading.Event()
+        def match():
+            while not done.is_set():
+                try:
+                    self.assertEqual( db.best_match( self.fingerprints[0] ).name, 'u0' )
+                except Exception as e:
+                    errors.append( e )
+        thread= threading.Thread( target=match )
+        thread.start()
+        try:
+            for i in range(30):
+                f= self.fingerprints[1 + i%5]
+                self.save( f, 1000+i )
+                db.refresh( self.dir )
+                os.remove( os.path.join(self.dir, f.name+Fingerprint.FILE_EXTENSION) )
+                db.refresh( self.dir )
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual( errors, [] )
+        self.assertEqual( [f.name for f in db.fingerprints], ['u0'] )
+
+
+class ScoringCacheTest(unittest.TestCase):
+    def test_content_hash(self):
+        ks= SyntheticKeystrokes()
+        self.assertEqual( ks.content_hash(), KeystrokeCaptureData( ks.events ).content_hash() )
+        self.assertNotEqual( ks.content_hash(), KeystrokeCaptureData( ks.log[1:] ).content_hash() )
+        f= create_fingerprint_from_capture_data( 'f', ks )
+        self.assertEqual( f.content_hash(), pickle.loads( pickle.dumps(f) ).content_hash() )
+        self.assertEqual( f.content_hash(), create_fingerprint_from_capture_data( 'f', KeystrokeCaptureData(ks.events) ).content_hash() )
+
+    def test_cache(self):
+        keystrokes= [SyntheticKeystrokes() for _ in range(4)]
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks ) for i,ks in enumerate(keystrokes)]
+        db= MatrixFingerprintDatabase( fs[:3] )
+        now= [0.0]
+        cache= ScoringCache( db, maxsize=2, ttl=10, clock=lambda: now[0] )
+        capture= KeystrokeCaptureData( keystrokes[1].log )
+        self.assertEqual( cache.score( capture ), db.score( create_fingerprint_from_capture_data('probe', capture) ) )
+        self.assertIs( cache.best_match( KeystrokeCaptureData(keystrokes[1].events) ), fs[1] )
+        stats= cache.stats()
+        self.assertEqual( (stats['hits'], stats['misses']),
+            ({'features': 0, 'probe': 1, 'score': 0, 'best': 0}, {'features': 1, 'probe': 1, 'score': 1, 'best': 1}) )
+        self.assertIs( cache.best_match( capture ), fs[1] )
+        self.assertEqual( cache.stats()['hits']['best'], 1 )
+        #database changes invalidate the scores, but not the probes
+        db.enroll( fs[3] )
+        self.assertEqual( len(cache.score( capture )), 4 )
+        self.assertEqual( cache.stats()['misses']['score'], 2 )
+        self.assertEqual( cache.stats()['invalidations'], 1 )
+        self.assertEqual( cache.stats()['hits']['probe'], 3 )
+        #expiry and size limits
+        now[0]= 10
+        cache.probe( capture )
+        self.assertEqual( cache.stats()['misses']['probe'], 2 )
+        for ks in keystrokes:
+            cache.score( ks )
+        self.assertEqual( cache.stats()['captures'], 2 )
+        self.assertEqual( cache.stats()['scores'], 2 )
+
+    def test_database_settings(self):
+        keystrokes= [SyntheticKeystrokes() for _ in range(12)]
+        fs= [create_fingerprint_from_capture_data( 'f{}'.format(i), ks, sketch_compression=20 ) for i,ks in enumerate(keystrokes)]
+        cache= ScoringCache( FingerprintDatabase(fs), sketch_compression=20, timing_threshold=300 )
+        self.assertIsInstance( cache.probe( keystrokes[0] ).values()[0], RobustAnomalyModel )
+        extractor= FeatureExtractor( 300, sketch_compression=20 )
+        extractor.on_events( keystrokes[0].events )
+        self.assertEqual( cache.probe( keystrokes[0] ).content_hash(), Fingerprint.from_features( 'probe', extractor.extract_features() ).content_hash() )
+        #best matches are the database's own
+        db= IndexedFingerprintDatabase( fs, nlist=4, nprobe=1 )
+        cache= ScoringCache( db, sketch_compression=20 )
+        for ks in keystrokes:
+            probe= create_fingerprint_from_capture_data( 'probe', ks, sketch_compression=20 )
+            self.assertIs( cache.best_match( ks ), db.best_match( probe ) )
+        self.assertEqual( cache.stats()['misses']['score'], 0 )
+
 
 if __name__ == '__main__':
     unittest.main()